@@ -0,0 +1,636 @@
+"""
+Annealing of electron configurations by parallel tempering (replica exchange Monte Carlo).
+
+A ladder of replicas at temperatures T_0 < T_1 < ... < T_M is sampled with Metropolis moves. The moves use the
+thermal kick of the solvers (thermal_kick, or thermal_kick_x for the ResonatorSolver) as the scale of the electron
+displacements. Periodically, replicas at neighbouring temperatures attempt to swap configurations, such that
+configurations found at high temperature diffuse down the ladder. Finally, the lowest configurations are quenched with
+scipy.optimize.minimize. Each replica runs on its own worker of a SolverPool.
+
+MonteCarloSampler samples the canonical ensemble at a fixed temperature with single-electron moves, e.g. for thermal
+position spreads or melting of the electron crystal. BasinHopping collects the distinct low-lying minima.
+"""
+import os, copy
+import numpy as np
+from scipy.optimize import minimize
+from scipy.spatial import cKDTree
+from termcolor import cprint
+from .solver_pool import SolverPool, resolve
+
+
+def geometric_temperatures(T_min, T_max, N_replicas):
+    """
+    Temperature ladder with a constant ratio between neighbouring temperatures.
+    :param T_min: Lowest temperature in K
+    :param T_max: Highest temperature in K
+    :param N_replicas: Number of replicas
+    :return: 1D array of temperatures
+    """
+    return T_min * (T_max / T_min) ** (np.arange(N_replicas) / max(N_replicas - 1, 1))
+
+
+def thermal_kick(solver, r, T, maximum_kick=None):
+    """
+    Thermal kick for each coordinate of r = [x0, y0, x1, y1, ...]. See the thermal_kick functions of the solvers.
+    :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+    :param r: Electron positions
+    :param T: Temperature in K
+    :param maximum_kick: Maximum kick in m, for electrons in regions with a small curvature of the potential.
+    :return: 1D array with the same length as r
+    """
+    xi, yi = r[::2], r[1::2]
+    if hasattr(solver, 'thermal_kick'):
+        kick_x, kick_y = solver.thermal_kick(xi, yi, T)
+    else:
+        kick_x = kick_y = solver.thermal_kick_x(xi, yi, T)
+
+    kick = np.zeros(len(r))
+    kick[::2], kick[1::2] = kick_x, kick_y
+    if maximum_kick is not None:
+        kick = np.minimum(np.nan_to_num(kick, nan=maximum_kick, posinf=maximum_kick), maximum_kick)
+    return kick
+
+
+def metropolis_segment(solver, r, beta, kick, N_steps, seed):
+    """
+    Metropolis Monte Carlo on solver.Vtotal, moving all electrons by a normally distributed displacement.
+    :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+    :param r: Initial electron positions
+    :param beta: Inverse temperature in 1/eV
+    :param kick: Standard deviation of the displacement for each coordinate of r
+    :param N_steps: Number of Metropolis steps
+    :param seed: Seed or np.random.SeedSequence for the random number generator
+    :return: final positions, final energy, acceptance ratio, lowest positions visited, lowest energy visited
+    """
+    rng = np.random.default_rng(seed)
+    E = solver.Vtotal(r)
+    r_low, E_low = r, E
+    accepted = 0
+    for n in range(N_steps):
+        r_new = r + kick * rng.standard_normal(len(r))
+        E_new = solver.Vtotal(r_new)
+        if E_new <= E or rng.random() < np.exp(-beta * (E_new - E)):
+            r, E = r_new, E_new
+            accepted += 1
+            if E < E_low:
+                r_low, E_low = r, E
+    return r, E, accepted / float(N_steps), r_low, E_low
+
+
+def quench(solver, r, cost_function, minimizer_dict):
+    minimizer_dict = dict((key, resolve(value)) for key, value in minimizer_dict.items())
+    return minimize(resolve(cost_function), r, **minimizer_dict)
+
+
+class ParallelTempering:
+
+    def __init__(self, solver, temperatures, pool=None, seed=None, maximum_kick=1E-6, target_acceptance=0.3):
+        """
+        Parallel tempering for the solvers in artificial_anneal.py.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param temperatures: Temperature ladder in K, e.g. from geometric_temperatures. One replica per temperature.
+        :param pool: SolverPool instance for solver. If None, a pool with one worker per replica is started for each
+        call to run.
+        :param seed: Seed for the Metropolis moves and the replica swaps
+        :param maximum_kick: Maximum standard deviation of an electron displacement in m
+        :param target_acceptance: The displacements of each replica are scaled to reach this acceptance ratio
+        """
+        self.solver = solver
+        self.temperatures = np.sort(np.asarray(temperatures, dtype=np.float64))
+        self.pool = pool
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.rng = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+        self.maximum_kick = maximum_kick
+        self.target_acceptance = target_acceptance
+
+        # Constants
+        self.qe = 1.602E-19
+        self.kB = 1.38E-23
+
+        self.history = None
+
+    def run(self, r0, N_exchanges, N_steps=100, cost_function=None, minimizer_dict=None, N_quench=None, verbose=True):
+        """
+        Run the replicas from the initial condition r0 and quench the lowest configurations that were found.
+        :param r0: Initial electron positions r = [x0, y0, x1, y1, ...], e.g. the output x of scipy.optimize.minimize
+        :param N_exchanges: Number of rounds of Metropolis sampling followed by replica swaps
+        :param N_steps: Number of Metropolis steps per replica between swaps
+        :param cost_function: Cost function for the quench. Defaults to solver.Vtotal.
+        :param minimizer_dict: Dictionary with optimizer options for the quench, see scipy.optimize.minimize
+        :param N_quench: Number of configurations to quench. Defaults to the number of replicas.
+        :param verbose: Print the acceptance and swap ratios and the result of the quench
+        :return: output of minimize with the lowest energy. All quenched results are in self.history['quenched']
+        """
+        N_replicas = len(self.temperatures)
+        if minimizer_dict is None:
+            minimizer_dict = {'method' : 'CG', 'jac' : self.solver.grad_total}
+        if cost_function is None:
+            cost_function = self.solver.Vtotal
+        if N_quench is None:
+            N_quench = N_replicas
+
+        beta = self.qe / (self.kB * self.temperatures)
+        r = [np.array(r0, dtype=np.float64) for T in self.temperatures]
+        E = np.array([self.solver.Vtotal(r0)] * N_replicas)
+        # The displacements start at the thermal kick divided by sqrt(N), which keeps the energy change ~ kB T
+        scale = np.ones(N_replicas) / np.sqrt(len(r0) / 2)
+        candidates = [(E[0], r[0])]
+
+        self.history = {'E' : list(), 'acceptance' : list(), 'swap_acceptance' : np.zeros(N_replicas - 1)}
+        swap_attempts = np.zeros(N_replicas - 1)
+
+        pool = self.pool if self.pool is not None else SolverPool(self.solver, processes=N_replicas)
+        try:
+            for n in range(N_exchanges):
+                tasks = list()
+                for k in range(N_replicas):
+                    kick = scale[k] * thermal_kick(self.solver, r[k], self.temperatures[k], self.maximum_kick)
+                    tasks.append((r[k], beta[k], kick, N_steps, self.seed_sequence.spawn(1)[0]))
+                results = pool.map(metropolis_segment, tasks)
+
+                acceptance = np.zeros(N_replicas)
+                for k, (r_k, E_k, acceptance[k], r_low, E_low) in enumerate(results):
+                    r[k], E[k] = r_k, E_k
+                    candidates.append((E_low, r_low))
+
+                # Adapt the step size between segments, such that each segment satisfies detailed balance
+                scale *= np.where(acceptance > self.target_acceptance, 1.2, 1 / 1.2)
+
+                # Attempt swaps between neighbouring temperatures, alternating between even and odd pairs
+                for k in range(n % 2, N_replicas - 1, 2):
+                    swap_attempts[k] += 1
+                    if self.rng.random() < np.exp(min(0, (beta[k] - beta[k + 1]) * (E[k] - E[k + 1]))):
+                        r[k], r[k + 1] = r[k + 1], r[k]
+                        E[k], E[k + 1] = E[k + 1], E[k]
+                        self.history['swap_acceptance'][k] += 1
+
+                self.history['E'].append(E.copy())
+                self.history['acceptance'].append(acceptance)
+
+            # Keep the lowest configurations, they are the most likely to relax into the ground state
+            candidates.sort(key=lambda c: c[0])
+            minimizer_dict = dict((key, pool.encode(value)) for key, value in minimizer_dict.items())
+            quenched = pool.map(quench, [(c[1], pool.encode(cost_function), minimizer_dict)
+                                         for c in candidates[:N_quench]])
+        finally:
+            if self.pool is None:
+                pool.close()
+
+        self.history['E'] = np.array(self.history['E'])
+        self.history['acceptance'] = np.array(self.history['acceptance'])
+        self.history['swap_acceptance'] /= np.maximum(swap_attempts, 1)
+        self.history['quenched'] = sorted(quenched, key=lambda res: res['fun'])
+
+        best_result = self.history['quenched'][0]
+        if verbose:
+            cprint("Acceptance ratio per replica: %s" % np.array2string(np.mean(self.history['acceptance'], axis=0),
+                                                                        precision=2), "white")
+            cprint("Swap acceptance ratio: %s" % np.array2string(self.history['swap_acceptance'], precision=2),
+                   "white")
+            cprint("Lowest energy after quenching: %.6f eV (status %d)" % (best_result['fun'], best_result['status']),
+                   "green")
+        return best_result
+
+
+class KnownBasin(Exception):
+    """
+    Raised by BasinHopping to abandon a minimization that is relaxing into a minimum that is already known.
+    """
+    def __init__(self, index):
+        Exception.__init__(self, "Minimization is relaxing into known minimum %d" % index)
+        self.index = index
+
+
+class MinimaCache:
+
+    def __init__(self, solver, energy_tolerance=1E-6, distance_tolerance=5E-9, cutoff=None):
+        """
+        Hash table of distinct minima. Minima are hashed by their energy, rounded to energy_tolerance. Minima in the
+        same or neighbouring bins are the same if their fingerprints (sorted pair distances) agree to within
+        distance_tolerance. The fingerprint doesn't change when electrons are relabeled.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance, used for its pair_list
+        :param energy_tolerance: Energy tolerance in eV
+        :param distance_tolerance: Maximum difference between the sorted pair distances in m
+        :param cutoff: Only use pair distances up to cutoff for the fingerprint. None uses all pairs.
+        """
+        self.solver = solver
+        self.energy_tolerance = energy_tolerance
+        self.distance_tolerance = distance_tolerance
+        self.cutoff = cutoff
+
+        self.buckets = dict()
+        self.fingerprints = list()
+        self.minima = list()
+
+    def fingerprint(self, r):
+        """
+        :param r: Electron positions r = [x0, y0, x1, y1, ...]
+        :return: Sorted pair distances
+        """
+        return np.sort(self.solver.pair_list(r[::2], r[1::2], cutoff=self.cutoff)[-1])
+
+    def lookup(self, E, fingerprint, energy_above=0, distance_tolerance=None):
+        """
+        Find a known minimum with an energy between E - energy_above and E, within energy_tolerance, and the same
+        fingerprint.
+        :param E: Energy in eV
+        :param fingerprint: Output of fingerprint
+        :param energy_above: Also match minima up to this much below E (in eV), e.g. for an unconverged configuration
+        :param distance_tolerance: Tolerance on the fingerprint in m. Defaults to self.distance_tolerance.
+        :return: Index in self.minima or None
+        """
+        if distance_tolerance is None:
+            distance_tolerance = self.distance_tolerance
+        first = int(np.round((E - energy_above) / self.energy_tolerance)) - 1
+        last = int(np.round(E / self.energy_tolerance)) + 1
+        for key in range(first, last + 1):
+            for index in self.buckets.get(key, list()):
+                known = self.fingerprints[index]
+                if E - energy_above - self.energy_tolerance <= self.minima[index]['fun'] <= E + self.energy_tolerance \
+                        and len(known) == len(fingerprint) \
+                        and np.max(np.abs(known - fingerprint), initial=0) < distance_tolerance:
+                    return index
+        return None
+
+    def add(self, res):
+        """
+        Add the output of scipy.optimize.minimize to the cache, or count another visit to a known minimum. A copy of res
+        is stored, res itself is not modified.
+        :param res: output of scipy.optimize.minimize
+        :return: index in self.minima, True if the minimum is new
+        """
+        fingerprint = self.fingerprint(res['x'])
+        index = self.lookup(res['fun'], fingerprint)
+        if index is not None:
+            self.minima[index]['visits'] += 1
+            return index, False
+
+        res = copy.copy(res)
+        res['visits'] = 1
+        self.minima.append(res)
+        self.fingerprints.append(fingerprint)
+        self.buckets.setdefault(int(np.round(res['fun'] / self.energy_tolerance)), list()).append(len(self.minima) - 1)
+        return len(self.minima) - 1, True
+
+    def lowest(self, N=None):
+        """
+        :param N: Number of minima to return. None returns all distinct minima.
+        :return: The N distinct minima with the lowest energy, sorted by energy
+        """
+        return sorted(self.minima, key=lambda res: res['fun'])[:N]
+
+
+class BasinHopping:
+
+    def __init__(self, solver, T, T_accept=None, seed=None, maximum_kick=1E-6, cache=None, abandon_energy=1E-4,
+                 abandon_distance=20E-9, check_every=10):
+        """
+        Basin hopping: the current minimum is perturbed with a thermal kick at temperature T and minimized again. The
+        new minimum is accepted as the starting point for the next hop with the Metropolis criterion at T_accept.
+        Distinct minima are stored in a MinimaCache. Minimizations whose iterates come within abandon_energy and
+        abandon_distance of a known minimum are abandoned, because they will most likely relax into that minimum.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param T: Temperature in K for the thermal kicks
+        :param T_accept: Temperature in K for accepting a hop. Defaults to T.
+        :param seed: Seed for the kicks and the acceptance of hops
+        :param maximum_kick: Maximum standard deviation of an electron displacement in m
+        :param cache: MinimaCache instance. Defaults to a new MinimaCache.
+        :param abandon_energy: Energy in eV above a known minimum below which a minimization may be abandoned
+        :param abandon_distance: Tolerance on the fingerprint in m for abandoning a minimization
+        :param check_every: Compare the iterates with the known minima every check_every iterations. None never
+        abandons a minimization.
+        """
+        self.solver = solver
+        self.T = T
+        self.T_accept = T if T_accept is None else T_accept
+        self.rng = np.random.default_rng(seed)
+        self.maximum_kick = maximum_kick
+        self.cache = MinimaCache(solver) if cache is None else cache
+        self.abandon_energy = abandon_energy
+        self.abandon_distance = abandon_distance
+        self.check_every = check_every
+
+        # Constants
+        self.qe = 1.602E-19
+        self.kB = 1.38E-23
+
+        self.statistics = None
+
+    def abandon_known_basins(self, cost_function):
+        """
+        Callback for scipy.optimize.minimize that raises KnownBasin when the iterate is close to a known minimum.
+        """
+        iterations = [0]
+
+        def callback(xk):
+            iterations[0] += 1
+            if iterations[0] % self.check_every:
+                return
+            E = cost_function(xk)
+            index = self.cache.lookup(E, self.cache.fingerprint(xk), energy_above=self.abandon_energy,
+                                      distance_tolerance=self.abandon_distance)
+            if index is not None:
+                raise KnownBasin(index)
+
+        return callback
+
+    def run(self, solution_data_reference, N_hops, cost_function=None, minimizer_dict=None, N_minima=None,
+            verbose=True):
+        """
+        This function is to be run after a minimization by scipy.optimize.minimize has already occured.
+        :param solution_data_reference: output of scipy.optimize.minimize, the starting point of the first hop
+        :param N_hops: Number of hops
+        :param cost_function: A function that takes the electron positions and returns the total energy. Defaults to
+        solver.Vtotal.
+        :param minimizer_dict: Dictionary with optimizer options. See scipy.optimize.minimize
+        :param N_minima: Number of minima to return. None returns all distinct minima.
+        :param verbose: Print a message for every new minimum and a summary at the end
+        :return: List of distinct minima (outputs of minimize) sorted by energy. The number of times each minimum was
+        found is stored with the key 'visits'.
+        """
+        if cost_function is None:
+            cost_function = self.solver.Vtotal
+        if minimizer_dict is None:
+            minimizer_dict = {'method' : 'CG', 'jac' : self.solver.grad_total}
+
+        current = solution_data_reference
+        self.cache.add(current)
+        self.statistics = {'new' : 0, 'duplicate' : 0, 'abandoned' : 0, 'not converged' : 0, 'accepted' : 0}
+
+        for n in range(N_hops):
+            kick = thermal_kick(self.solver, current['x'], self.T, self.maximum_kick)
+            r0 = current['x'] + kick * self.rng.standard_normal(len(kick))
+
+            options = dict(minimizer_dict)
+            if self.check_every is not None:
+                options['callback'] = self.abandon_known_basins(cost_function)
+            try:
+                res = minimize(cost_function, r0, **options)
+            except KnownBasin as known:
+                self.statistics['abandoned'] += 1
+                self.cache.minima[known.index]['visits'] += 1
+                res = self.cache.minima[known.index]
+            else:
+                if res['status'] != 0:
+                    self.statistics['not converged'] += 1
+                index, new = self.cache.add(res)
+                if new:
+                    self.statistics['new'] += 1
+                    if verbose:
+                        cprint("\tNew minimum %d found with energy %.6f eV" % (index, res['fun']), "green")
+                else:
+                    self.statistics['duplicate'] += 1
+                    res = self.cache.minima[index]
+
+            # Metropolis criterion for the next starting point
+            delta = (res['fun'] - current['fun']) * self.qe / (self.kB * self.T_accept)
+            if delta <= 0 or self.rng.random() < np.exp(-delta):
+                current = res
+                self.statistics['accepted'] += 1
+
+        if verbose:
+            cprint("%d hops: %d new minima, %d duplicates, %d abandoned early" % (N_hops, self.statistics['new'],
+                   self.statistics['duplicate'], self.statistics['abandoned']), "white")
+        return self.cache.lowest(N_minima)
+
+
+def load_samples(filename):
+    """
+    Load the samples streamed to disk by MonteCarloSampler.run
+    :param filename: Path of the samples file
+    :return: sweeps (1D array), energies in eV (1D array), positions (2D array, one configuration r per row). The arrays
+    are empty if the file doesn't exist or contains no samples.
+    """
+    records = list()
+    if not os.path.isfile(filename):
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, 0))
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                records.append(np.load(f))
+            except (EOFError, ValueError):
+                break
+    if not records:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, 0))
+    records = np.array(records)
+    return records[:, 0].astype(int), records[:, 1], records[:, 2:]
+
+
+class MonteCarloSampler:
+
+    def __init__(self, solver, T, r0, seed=None, cutoff=None, skin=None, maximum_kick=1E-6, target_acceptance=0.4):
+        """
+        Metropolis Monte Carlo with single-electron moves. The interaction energy of each electron with all others is
+        kept up to date, such that a move is scored in O(N), or in O(number of neighbors) if a cutoff is given.
+        The proposed displacement of electron i is a normal distribution with the thermal kick of the solver at its
+        position as standard deviation (thermal_kick_x/thermal_kick_y), times a common scale that is adapted in
+        equilibrate.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param T: Temperature in K
+        :param r0: Initial electron positions r = [x0, y0, x1, y1, ...], e.g. the output x of scipy.optimize.minimize
+        :param seed: Seed for the random number generator
+        :param cutoff: Neglect interactions between electrons further apart than cutoff (in m). Only use this with
+        include_screening=True, where the interaction decays exponentially. None includes all pairs.
+        :param skin: Extra distance for the neighbor lists, such that they only need to be rebuilt after an electron has
+        moved more than skin / 2. Defaults to cutoff / 5.
+        :param maximum_kick: Maximum standard deviation of the displacement of an electron in m
+        :param target_acceptance: Acceptance ratio that equilibrate aims for
+        """
+        self.solver = solver
+        self.T = T
+        self.rng = np.random.default_rng(seed)
+        self.cutoff = cutoff
+        self.skin = None if cutoff is None else (cutoff / 5. if skin is None else skin)
+        self.maximum_kick = maximum_kick
+        self.target_acceptance = target_acceptance
+
+        # Constants
+        self.qe = 1.602E-19
+        self.kB = 1.38E-23
+        self.beta = self.qe / (self.kB * T)
+
+        self.periodic_length = getattr(solver, 'box_y_length', None)
+        self.periodic_kernel = getattr(solver, 'periodic_kernel', None)
+        r0 = np.array(r0, dtype=np.float64)
+        self.x, self.y = r0[::2].copy(), r0[1::2].copy()
+        self.N = len(self.x)
+        self.scale = 1.
+        self.update_kicks()
+
+        self.neighbors = None
+        if self.cutoff is not None:
+            self.build_neighbors()
+
+        # External potential and interaction energy of each electron in eV
+        self.Vext = self.external_potential(self.x, self.y)
+        self.Vint = np.array([np.sum(self.pair_energies(i, self.x[i], self.y[i])) for i in range(self.N)])
+
+        self.accepted, self.proposed = 0, 0
+
+    @property
+    def r(self):
+        r = np.zeros(2 * self.N)
+        r[::2], r[1::2] = self.x, self.y
+        return r
+
+    @property
+    def energy(self):
+        """
+        Total energy in eV, equal to solver.Vtotal(self.r) up to the neglected pairs beyond the cutoff. With a
+        sorted_band ResonatorSolver, the solver approximates the distant pairs on a mesh, whereas they are summed
+        exactly here.
+        """
+        return np.sum(self.Vext) + 0.5 * np.sum(self.Vint)
+
+    def external_potential(self, x, y):
+        V = self.solver.V(x, y)
+        if hasattr(self.solver, 'background_potential'):
+            V = V + np.reshape(self.solver.background_potential(np.atleast_1d(x), np.atleast_1d(y), order=0)[0],
+                               np.shape(x))
+        return V
+
+    def update_kicks(self):
+        kick = self.scale * thermal_kick(self.solver, self.r, self.T, self.maximum_kick)
+        self.kick_x, self.kick_y = kick[::2], kick[1::2]
+
+    def build_neighbors(self):
+        """
+        Verlet neighbor lists: all electrons within cutoff + skin of each electron.
+        """
+        if self.periodic_length is None:
+            tree = cKDTree(np.column_stack((self.x, self.y)))
+        else:
+            y = (self.y + self.periodic_length / 2.) % self.periodic_length
+            tree = cKDTree(np.column_stack((self.x, y)), boxsize=[0, self.periodic_length])
+        neighbors = tree.query_ball_point(np.column_stack((self.x, self.y if self.periodic_length is None else y)),
+                                          self.cutoff + self.skin)
+        self.neighbors = [np.array([j for j in n if j != i], dtype=int) for i, n in enumerate(neighbors)]
+        self.x_build, self.y_build = self.x.copy(), self.y.copy()
+
+    def partners(self, i):
+        if self.neighbors is None:
+            return np.delete(np.arange(self.N), i)
+        return self.neighbors[i]
+
+    def pair_energies(self, i, xi, yi, j=None):
+        """
+        Interaction energies (eV) of electron i at position (xi, yi) with its partners j.
+        """
+        if j is None:
+            j = self.partners(i)
+        dx, dy = xi - self.x[j], yi - self.y[j]
+        if self.periodic_length is not None:
+            dy -= self.periodic_length * np.round(dy / self.periodic_length)
+        Rij = np.sqrt(dx ** 2 + dy ** 2)
+        phi = self.solver.pair_potential(Rij, order=0)[0]
+        if self.periodic_kernel is not None:
+            # Interaction with all other periodic images, see ResonatorSolver(periodic_images=True)
+            phi = phi + self.periodic_kernel.evaluate(dx, dy)[0]
+        if self.cutoff is not None:
+            phi[Rij > self.cutoff] = 0
+        return phi
+
+    def sweep(self):
+        """
+        Propose one move for every electron, in random order.
+        :return: Number of accepted moves
+        """
+        accepted = 0
+        for i in self.rng.permutation(self.N):
+            j = self.partners(i)
+            x_new = self.x[i] + self.kick_x[i] * self.rng.standard_normal()
+            y_new = self.y[i] + self.kick_y[i] * self.rng.standard_normal()
+
+            Vext_new = self.external_potential(x_new, y_new)
+            phi_old = self.pair_energies(i, self.x[i], self.y[i], j)
+            phi_new = self.pair_energies(i, x_new, y_new, j)
+            delta = Vext_new - self.Vext[i] + np.sum(phi_new) - np.sum(phi_old)
+
+            if delta <= 0 or self.rng.random() < np.exp(-self.beta * delta):
+                self.x[i], self.y[i] = x_new, y_new
+                self.Vext[i] = Vext_new
+                self.Vint[j] += phi_new - phi_old
+                self.Vint[i] = np.sum(phi_new)
+                accepted += 1
+
+                if self.neighbors is not None and \
+                        (self.x[i] - self.x_build[i]) ** 2 + (self.y[i] - self.y_build[i]) ** 2 > (self.skin / 2.) ** 2:
+                    self.build_neighbors()
+
+        self.accepted += accepted
+        self.proposed += self.N
+        return accepted
+
+    def equilibrate(self, N_sweeps, verbose=True):
+        """
+        Equilibrate at temperature T and adapt the step size to the target acceptance ratio. The proposal
+        distribution changes during equilibration, therefore no samples should be taken here.
+        :param N_sweeps: Number of sweeps
+        :param verbose: Print the acceptance ratio and step scale at the end
+        :return: None
+        """
+        for n in range(N_sweeps):
+            acceptance = self.sweep() / float(self.N)
+            self.scale *= 1.1 if acceptance > self.target_acceptance else 1 / 1.1
+            self.update_kicks()
+        if verbose:
+            cprint("Equilibrated at %.3f K: acceptance ratio %.2f, step scale %.3f" % (self.T, acceptance, self.scale),
+                   "white")
+
+    def run(self, N_sweeps, sample_every=1, save_path=None, observables=None, verbose=True):
+        """
+        Sample the canonical ensemble. The step sizes are kept fixed, such that the samples satisfy detailed balance.
+        :param N_sweeps: Number of sweeps, each consisting of N single-electron moves
+        :param sample_every: Take a sample every sample_every sweeps
+        :param save_path: Directory to stream the samples to. Positions and energies are appended to samples.npy
+        (read with load_samples), observables to observables.txt. None keeps the samples in memory only.
+        :param observables: Dictionary of functions that take the electron positions r and return a float
+        :param verbose: Print the acceptance ratio at the end
+        :return: Dictionary with the sampled energies, observables and the mean and standard deviation of each
+        coordinate of r over all samples.
+        """
+        if observables is None:
+            observables = dict()
+        names = sorted(observables.keys())
+        results = dict([('E', list())] + [(name, list()) for name in names])
+        samples, observable_log = None, None
+        if save_path is not None:
+            samples = open(os.path.join(save_path, 'samples.npy'), 'ab')
+            observable_log = open(os.path.join(save_path, 'observables.txt'), 'a')
+            # Only a new file gets a header, a run that continues an earlier one appends to its columns
+            if observable_log.tell() == 0:
+                observable_log.write("\t".join(['sweep', 'E'] + names) + "\n")
+
+        r_sum, r2_sum = np.zeros(2 * self.N), np.zeros(2 * self.N)
+        accepted, proposed = self.accepted, self.proposed
+        try:
+            for n in range(1, N_sweeps + 1):
+                self.sweep()
+                if n % sample_every:
+                    continue
+
+                r, E = self.r, self.energy
+                r_sum += r
+                r2_sum += r ** 2
+                values = [E] + [observables[name](r) for name in names]
+                for name, value in zip(['E'] + names, values):
+                    results[name].append(value)
+
+                if samples is not None:
+                    np.save(samples, np.concatenate(([n, E], r)))
+                    observable_log.write("\t".join(["%d" % n] + ["%.10e" % value for value in values]) + "\n")
+                    observable_log.flush()
+        finally:
+            if samples is not None:
+                samples.close()
+                observable_log.close()
+
+        N_samples = max(len(results['E']), 1)
+        results = dict((name, np.array(value)) for name, value in results.items())
+        results['r_mean'] = r_sum / N_samples
+        results['r_std'] = np.sqrt(np.maximum(r2_sum / N_samples - results['r_mean'] ** 2, 0))
+        results['acceptance'] = (self.accepted - accepted) / float(max(self.proposed - proposed, 1))
+        if verbose:
+            cprint("%d sweeps at %.3f K: acceptance ratio %.2f, <E> = %.6f eV" % (N_sweeps, self.T,
+                   results['acceptance'], np.mean(results['E'])), "white")
+        return results
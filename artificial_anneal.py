@@ -2,11 +2,153 @@ import numpy as np
 from matplotlib import pyplot as plt
 from scipy.optimize import approx_fprime, minimize
 from scipy.interpolate import RectBivariateSpline, UnivariateSpline
-import os, time, functools, multiprocessing, dxfgrabber
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.signal import fftconvolve
+import os, functools, subprocess, dxfgrabber
+from collections import OrderedDict
 from termcolor import cprint
 from Common import common
 from BEMHelper import interpolate_slow
 from .import_data import load_dsp
+from .interpolation import SplineEvaluator1D, SplineEvaluator2D, PolynomialEvaluator2D
+from .solver_pool import SolverPool
+from .rendering import FrameRenderer
+from .results_store import ResultsStore
+from .solution_cache import fingerprint
+from .pair_kernels import PeriodicKernel, SortedBandInteraction, closed_form_potential
+from .parallel_forces import ThreadedInteraction
+
+class TrajectoryRecorder:
+    def __init__(self, fun, grad=None, fun_and_grad=None, capacity=1000, ring=False, keep_gradients=True,
+                 save_path=None):
+        """
+        Records the energy, gradient norm, positions and gradients along a minimization. Pass the caching wrappers
+        self.fun and self.jac (or self.fun_and_grad with jac=True) to scipy.optimize.minimize, such that record can
+        reuse the values the optimizer has already computed instead of evaluating the cost function again.
+        Samples are written into preallocated buffers. In memory, the buffers double in size when they are full, unless
+        ring is True. With a save_path, positions and gradients are written to memory-mapped .npy files of fixed
+        capacity, which behave as a ring buffer.
+        :param fun: Cost function, e.g. solver.Vtotal
+        :param grad: Gradient of fun, e.g. solver.grad_total
+        :param fun_and_grad: Optional function that returns fun and grad in one call, e.g. solver.Vtotal_and_grad
+        :param capacity: Number of samples to allocate for
+        :param ring: Keep only the last capacity samples
+        :param keep_gradients: Also store the full gradient for each sample
+        :param save_path: Directory for positions.npy and gradients.npy. None keeps everything in memory.
+        """
+        self.Uopt = fun
+        self.grad_Uopt = grad
+        self.Uopt_and_grad = fun_and_grad
+        self.capacity = capacity
+        self.ring = ring or save_path is not None
+        self.keep_gradients = keep_gradients
+        self.save_path = save_path
+
+        # Last evaluated point, see fun, jac and fun_and_grad
+        self.cached_x, self.cached_fun, self.cached_grad = None, None, None
+
+        self.N_samples = 0
+        self.buffers = None
+
+    def is_cached(self, x):
+        return self.cached_x is not None and np.array_equal(x, self.cached_x)
+
+    def cache(self, x, f=None, g=None):
+        if not self.is_cached(x):
+            self.cached_x, self.cached_fun, self.cached_grad = np.array(x, dtype=np.float64), None, None
+        if f is not None:
+            self.cached_fun = f
+        if g is not None:
+            self.cached_grad = g
+
+    def fun(self, x):
+        if not (self.is_cached(x) and self.cached_fun is not None):
+            self.cache(x, f=self.Uopt(x))
+        return self.cached_fun
+
+    def jac(self, x):
+        if not (self.is_cached(x) and self.cached_grad is not None):
+            self.cache(x, g=self.grad_Uopt(x))
+        return self.cached_grad
+
+    def fun_and_grad(self, x):
+        if self.Uopt_and_grad is not None and not (self.is_cached(x) and self.cached_fun is not None
+                                                   and self.cached_grad is not None):
+            f, g = self.Uopt_and_grad(x)
+            self.cache(x, f=f, g=g)
+        return self.fun(x), self.jac(x)
+
+    def allocate(self, size):
+        if self.save_path is not None:
+            open_memmap = np.lib.format.open_memmap
+            return {'positions' : open_memmap(os.path.join(self.save_path, 'positions.npy'), mode='w+',
+                                              dtype=np.float64, shape=(self.capacity, size)),
+                    'gradients' : open_memmap(os.path.join(self.save_path, 'gradients.npy'), mode='w+',
+                                              dtype=np.float64, shape=(self.capacity, size)) \
+                                  if self.keep_gradients else None,
+                    'iterations' : np.zeros(self.capacity, dtype=int),
+                    'energies' : np.zeros(self.capacity),
+                    'gradient_norms' : np.zeros(self.capacity)}
+        return {'positions' : np.zeros((self.capacity, size)),
+                'gradients' : np.zeros((self.capacity, size)) if self.keep_gradients else None,
+                'iterations' : np.zeros(self.capacity, dtype=int),
+                'energies' : np.zeros(self.capacity),
+                'gradient_norms' : np.zeros(self.capacity)}
+
+    def record(self, xk, iteration=None):
+        """
+        Store a sample. Can be used directly as a callback for scipy.optimize.minimize.
+        :param xk: Electron positions
+        :param iteration: Iteration number to store with the sample. Defaults to the number of samples.
+        :return: energy, gradient at xk
+        """
+        f, g = self.fun_and_grad(xk)
+
+        if self.buffers is None:
+            self.buffers = self.allocate(len(xk))
+        elif self.N_samples == self.capacity and not self.ring:
+            # Grow the buffers, such that the cost of recording is constant on average
+            for key, buffer in self.buffers.items():
+                if buffer is not None:
+                    self.buffers[key] = np.concatenate((buffer, np.zeros_like(buffer)))
+            self.capacity *= 2
+
+        index = self.N_samples % self.capacity
+        self.buffers['iterations'][index] = self.N_samples if iteration is None else iteration
+        self.buffers['energies'][index] = f
+        # Here we use the L-inf norm (the maximum)
+        self.buffers['gradient_norms'][index] = np.max(np.abs(g))
+        self.buffers['positions'][index] = xk
+        if self.keep_gradients:
+            self.buffers['gradients'][index] = g
+        self.N_samples += 1
+        return f, g
+
+    def get(self, key):
+        """
+        :param key: 'iterations', 'energies', 'gradient_norms', 'positions' or 'gradients'
+        :return: Recorded samples in chronological order
+        """
+        if self.buffers is None or self.buffers[key] is None:
+            return np.array([])
+        buffer = self.buffers[key]
+        if self.N_samples <= self.capacity:
+            return buffer[:self.N_samples]
+        start = self.N_samples % self.capacity
+        return np.concatenate((buffer[start:], buffer[:start]))
+
+    def flush(self):
+        """
+        Write the memory-mapped buffers to disk and save the energies and gradient norms to trajectory.npz
+        """
+        if self.save_path is not None and self.buffers is not None:
+            for key in ['positions', 'gradients']:
+                if self.buffers[key] is not None:
+                    self.buffers[key].flush()
+            np.savez(os.path.join(self.save_path, 'trajectory.npz'), iterations=self.get('iterations'),
+                     energies=self.get('energies'), gradient_norms=self.get('gradient_norms'),
+                     N_samples=self.N_samples)
 
 class ConvergenceMonitor:
     def __init__(self, Uopt, grad_Uopt, N, Uext=None, xext=None, yext=None, verbose=True, eps=1E-12, save_path=None,
@@ -26,14 +168,16 @@ class ConvergenceMonitor:
         :param verbose: Whether to print the status when monitor_convergence is called.
         :param eps: Step size used to numerically approximate the gradient with scipy.optimize.approx_fprime
         :param save_path: Directory in which to save figures when self.save_pictures is called. None by default.
+        The history of the positions and gradients is kept in self.recorder, see TrajectoryRecorder. iter, curr_fun,
+        curr_grad_norm, curr_xk and jac are read-only views of the recorder and can't be assigned to. To avoid
+        evaluating the cost function again in monitor_convergence, use
+        minimize(CM.recorder.fun, r0, jac=CM.recorder.jac, callback=CM.monitor_convergence)
         """
         self.clim = clim
         self.call_every = N
         self.call_counter = 0
         self.verbose = verbose
-        self.curr_grad_norm = list()
-        self.curr_fun = list()
-        self.iter = list()
+        self.recorder = TrajectoryRecorder(Uopt, grad_Uopt)
         self.epsilon = eps
         self.save_path = save_path
         self.Uopt = Uopt
@@ -42,6 +186,7 @@ class ConvergenceMonitor:
         self.figsize = figsize
         self.coordinate_transformation = coordinate_transformation
         self.electrode_outline_filename = None
+        self.renderer = None
 
     def monitor_convergence(self, xk):
         """
@@ -50,70 +195,94 @@ class ConvergenceMonitor:
         :return: None
         """
         if not (self.call_counter % self.call_every):
-            self.iter.append(self.call_counter)
-            self.curr_fun.append(self.Uopt(xk))
-
-            # Here we use the L-inf norm (the maximum)
-            self.curr_grad_norm.append(np.max(np.abs(self.grad_Uopt(xk))))
-
-            if self.call_counter == 0:
-                self.curr_xk = xk
-                self.jac = self.grad_Uopt(xk)
-                #self.approx_fprime = approx_fprime(xk, self.Uopt, self.epsilon)
-            else:
-                self.curr_xk = np.vstack((self.curr_xk, xk))
-                self.jac = np.vstack((self.jac, self.grad_Uopt(xk)))
-                #self.approx_fprime = np.vstack((self.approx_fprime, approx_fprime(xk, self.Uopt, self.epsilon)))
+            f, g = self.recorder.record(xk, iteration=self.call_counter)
 
             if self.verbose:
-                print("%d\tUopt: %.8f eV\tNorm of gradient: %.2e eV/m" \
-                      % (self.call_counter, self.curr_fun[-1], self.curr_grad_norm[-1]))
+                # Here we use the L-inf norm (the maximum)
+                print("%d\tUopt: %.8f eV\tNorm of gradient: %.2e eV/m" % (self.call_counter, f, np.max(np.abs(g))))
 
         self.call_counter += 1
 
-    def save_pictures(self, xk):
-        """
-        Plots the current value of the electron position array xk and saves a picture in self.save_path.
-        :param xk: Electron position pairs
+    # The history is read from the recorder without copying. These attributes are read-only: the scalars are 1D arrays,
+    # and positions and gradients are 1D for a single sample and 2D for more samples.
+    @property
+    def iter(self):
+        return self.recorder.get('iterations')
+
+    @property
+    def curr_fun(self):
+        return self.recorder.get('energies')
+
+    @property
+    def curr_grad_norm(self):
+        return self.recorder.get('gradient_norms')
+
+    @property
+    def curr_xk(self):
+        positions = self.recorder.get('positions')
+        return positions[0] if len(positions) == 1 else positions
+
+    @property
+    def jac(self):
+        gradients = self.recorder.get('gradients')
+        return gradients[0] if len(gradients) == 1 else gradients
+
+    def start_rendering(self, filename_out=None, fps=10, dpi=150, max_queued=1000):
+        """
+        Start a FrameRenderer for save_pictures. The background potential and the electrode outline
+        (self.electrode_outline_filename) are rasterized here, once. Call this after setting the electrode outline.
+        :param filename_out: File name of the movie, e.g. "movie.mp4". Frames are piped into ffmpeg directly and no
+        pictures are saved. If None, save_pictures saves a PNG for every frame.
+        :param fps: Frames per second of the movie
+        :param dpi: Resolution of the frames
+        :param max_queued: Maximum number of frames waiting to be rendered, see FrameRenderer
         :return: None
         """
-        xext, yext = self.xext, self.yext
-        Uext = self.Uext
-
-        fig = plt.figure(figsize=self.figsize)
-        try:
-            common.configure_axes(12)
-        except:
-            pass
+        self.stop_rendering()
+        xext, yext, Uext = self.xext, self.yext, self.Uext
 
+        background = None
         if (Uext is not None) and (xext is not None) and (yext is not None):
             Xext, Yext = np.meshgrid(xext, yext)
-            plt.pcolormesh(xext * 1E6, yext * 1E6, Uext(Xext, Yext), cmap=plt.cm.RdYlBu, vmax=self.clim[1], vmin=self.clim[0])
-            plt.xlim(np.min(xext) * 1E6, np.max(xext) * 1E6)
-            plt.ylim(np.min(yext) * 1E6, np.max(yext) * 1E6)
+            background = Uext(Xext, Yext)
 
-        if self.coordinate_transformation is None:
-            electrons_x, electrons_y = xk[::2], xk[1::2]
-        else:
-            r_new = self.coordinate_transformation(xk)
-            electrons_x, electrons_y = r2xy(r_new)
+        outline = None
+        if self.electrode_outline_filename is not None:
+            outline = get_dxf_polylines(self.electrode_outline_filename)
 
-        plt.plot(electrons_x*1E6, electrons_y*1E6, 'o', color='deepskyblue')
-        plt.xlabel("$x$ ($\mu$m)")
-        plt.ylabel("$y$ ($\mu$m)")
-        plt.colorbar()
+        self.renderer = FrameRenderer(self.save_path, xext=xext, yext=yext, background=background, outline=outline,
+                                      filename_out=filename_out, fps=fps, figsize=self.figsize, dpi=dpi,
+                                      clim=self.clim, max_queued=max_queued)
 
-        if self.electrode_outline_filename is not None:
-            PP = PostProcess(save_path=self.save_path)
-            PP.draw_from_dxf(filename=self.electrode_outline_filename, color='black', alpha=0.6, lw=0.5)
+    def stop_rendering(self):
+        """
+        Wait until all frames of save_pictures are rendered and stop the renderer.
+        :return: None
+        """
+        if self.renderer is not None:
+            self.renderer.close()
+            self.renderer = None
 
-        if self.save_path is not None:
-            common.save_figure(fig, save_path=self.save_path)
-            #fig.savefig(os.path.join(self.save_path, '%.5d.png' % (self.call_counter)), bbox_inches='tight', dpi=300)
-        else:
+    def save_pictures(self, xk):
+        """
+        Plots the current value of the electron position array xk and saves a picture in self.save_path.
+        The frame is rendered in a separate process, see start_rendering, such that the optimizer doesn't wait for it.
+        :param xk: Electron position pairs
+        :return: None
+        """
+        if self.save_path is None:
             print("Please specify a save path when initiating ConvergenceMonitor")
+        else:
+            if self.renderer is None:
+                self.start_rendering()
+
+            if self.coordinate_transformation is None:
+                electrons_x, electrons_y = xk[::2], xk[1::2]
+            else:
+                r_new = self.coordinate_transformation(xk)
+                electrons_x, electrons_y = r2xy(r_new)
 
-        plt.close(fig)
+            self.renderer.render(electrons_x, electrons_y, frame=self.call_counter)
 
         self.monitor_convergence(xk)
 
@@ -122,15 +291,18 @@ class ConvergenceMonitor:
         Generate a movie from the pictures generated by save_pictures. Movie gets saved in self.save_path
         For filenames of the type 00000.png etc use filenames_in="%05d.png".
         Files must all have the save extension and resolution.
+        If the frames were piped into ffmpeg directly (start_rendering with filename_out), this only finishes the movie.
         :param fps: frames per second (integer).
         :param filenames_in: Signature of series of file names in Unix style. Ex: "%05d.png"
         :param filename_out: File name of the output video. Ex: "movie.mp4"
         :return: None
         """
-        curr_dir = os.getcwd()
-        os.chdir(self.save_path)
-        os.system(r"ffmpeg -r {} -b 1800 -i {} {}".format(int(fps), filenames_in, filename_out))
-        os.chdir(curr_dir)
+        streaming = self.renderer is not None and self.renderer.filename_out is not None
+        self.stop_rendering()
+        if streaming:
+            return
+        subprocess.call(["ffmpeg", "-y", "-r", "%d" % int(fps), "-i", filenames_in, "-pix_fmt", "yuv420p",
+                         filename_out], cwd=self.save_path)
 
 class PostProcess:
     def __init__(self, save_path=None, res_pinw=0.9, edge_gapw=0.5, center_gapw=0.7, box_length=40):
@@ -140,6 +312,7 @@ class PostProcess:
         """
         self.save_path = save_path
         self.trapped_electrons = None
+        self.results = None
         self.res_pinw = res_pinw
         self.edge_gapw = edge_gapw
         self.center_gapw = center_gapw
@@ -247,21 +420,14 @@ class PostProcess:
 
     def write2file(self, **kwargs):
         """
-        Write simulation results to an npz file in self.save_path
+        Append simulation results to the ResultsStore in self.save_path. Scalar parameters can be queried later, e.g.
+        PP.results.query(order_by='energy', N=200), and arrays are loaded with PP.results.load.
         :param kwargs: Dictionary of parameters to be saved to the file.
-        :return: None
+        :return: id of the result in self.results
         """
-
-        number = 0
-        file_name = "%.5d.npz"%number
-
-        while file_name in os.listdir(self.save_path):
-            file_name = "%.5d.npz"%(number)
-            number += 1
-
-        #print("Saving file to %s ..."%(os.path.join(self.save_path, file_name)))
-
-        np.savez(os.path.join(self.save_path, file_name), **kwargs)
+        if self.results is None:
+            self.results = ResultsStore(self.save_path)
+        return self.results.append(**kwargs)
 
     def get_trapped_electrons(self, r, trap_area_x=(-4E-6, -1.8E-6)):
         """
@@ -272,10 +438,124 @@ class PostProcess:
         """
         return len(np.where(np.logical_and(r[::2] > trap_area_x[0], r[::2] < trap_area_x[1]))[0])
 
-class TrapAreaSolver:
+class SolverMixin:
+    """
+    Batched evaluation and Hessian of Vtotal, shared by TrapAreaSolver, ResonatorSolver and CombinedModelSolver.
+    A solver provides external_potential, external_hessian, pair_list and pair_potential, and initializes
+    self.hessian_cache = None. Periodic solvers override nearest_image.
+    """
+
+    def nearest_image(self, dy):
+        """
+        Separation in the y-direction of the pairs. Without periodic boundary conditions this is dy itself.
+        """
+        return dy
+
+    def batch_evaluate(self, R, order=1):
+        """
+        Total energy and gradient of a batch of K configurations. The potential is evaluated for all electrons of all
+        configurations in one pass and the pairwise interactions are broadcast over the batch. Memory scales as
+        K * N**2, which makes this suitable for moderate numbers of electrons.
+        :param R: 2D array of shape (K, 2N). Each row is r = np.array([x0, y0, x1, y1, ... , xN, yN])
+        :param order: 0 for the energies only, 1 for energies and gradients
+        :return: (Vtotal,) or (Vtotal, grad_total): 1D array of K energies (eV) and 2D array (K, 2N) of gradients (eV/m)
+        """
+        R = np.asarray(R, dtype=np.float64)
+        xi, yi = R[:, ::2], R[:, 1::2]
+        V = self.external_potential(xi, yi, order=order)
+        interaction = batch_interaction(xi[:, :, np.newaxis] - xi[:, np.newaxis, :],
+                                        self.nearest_image(yi[:, :, np.newaxis] - yi[:, np.newaxis, :]),
+                                        self.pair_potential, order=order)
+        energy = np.sum(V[0], axis=1) + interaction[0]
+        if order == 0:
+            return (energy,)
+        gradient = np.zeros(R.shape)
+        gradient[:, ::2] = V[1] + interaction[1]
+        gradient[:, 1::2] = V[2] + interaction[2]
+        return energy, gradient
+
+    def Vtotal_batch(self, R):
+        """
+        Vtotal for a batch of configurations, see batch_evaluate
+        :param R: 2D array of shape (K, 2N)
+        :return: 1D array of K energies
+        """
+        return self.batch_evaluate(R, order=0)[0]
+
+    def grad_total_batch(self, R):
+        """
+        grad_total for a batch of configurations, see batch_evaluate
+        :param R: 2D array of shape (K, 2N)
+        :return: 2D array of shape (K, 2N)
+        """
+        return self.batch_evaluate(R, order=1)[1]
+
+    def Vtotal_and_grad_batch(self, R):
+        """
+        Vtotal and grad_total for a batch of configurations, see batch_evaluate. Use with minimizers.fire_batch.
+        :param R: 2D array of shape (K, 2N)
+        :return: 1D array of K energies, 2D array of shape (K, 2N)
+        """
+        return self.batch_evaluate(R, order=1)
+
+    def hessian_terms(self, r, cutoff=None):
+        """
+        Building blocks of the Hessian of Vtotal: the Hessian of the external potential for each electron and the
+        2x2 interaction blocks for each pair of electrons. The result for the last r is cached, such that repeated
+        Hessian-vector products at the same r (e.g. in Newton-CG) don't recompute the pairs.
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :param cutoff: Only include pairs closer than cutoff (neighbor-list mode). None includes all pairs.
+        :return: (Vxx, Vxy, Vyy), (i, j), (Bxx, Bxy, Byy)
+        """
+        key = (r.tobytes(), cutoff)
+        if self.hessian_cache is not None and self.hessian_cache[0] == key:
+            return self.hessian_cache[1]
+
+        xi, yi = r[::2], r[1::2]
+        i, j, dx, dy, Rij = self.pair_list(xi, yi, cutoff=cutoff)
+        phi, dphi, d2phi = self.pair_potential(Rij, order=2)
+        terms = (self.external_hessian(xi, yi), (i, j), pair_hessian_blocks(dx, dy, Rij, dphi, d2phi))
+        self.hessian_cache = (key, terms)
+        return terms
+
+    def hessian(self, r, cutoff=None):
+        """
+        Analytic Hessian of Vtotal. Use as scipy.optimize.minimize(..., method='trust-exact', hess=solver.hessian)
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :param cutoff: If not None, only pairs closer than cutoff are included and a scipy.sparse matrix is returned.
+        :return: 2N x 2N array in eV/m**2
+        """
+        return assemble_hessian(*self.hessian_terms(r, cutoff=cutoff), sparse_output=cutoff is not None)
+
+    def hessp(self, r, p, cutoff=None):
+        """
+        Product of the analytic Hessian of Vtotal with a vector p, without constructing the Hessian.
+        Use as scipy.optimize.minimize(..., method='Newton-CG' or 'trust-krylov', hessp=solver.hessp). Since positions
+        are in m, Newton-CG requires a small step tolerance, e.g. options={'xtol' : 1E-14}.
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :param p: 1D array of length len(r)
+        :param cutoff: Only include pairs closer than cutoff. None includes all pairs.
+        :return: 1D array of length len(r) in eV/m**2
+        """
+        return hessian_vector_product(*self.hessian_terms(r, cutoff=cutoff), p=p)
+
+    def normal_modes(self, r, cutoff=None):
+        """
+        Normal modes of the electron ensemble from the Hessian at a minimum r of Vtotal.
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :param cutoff: Only include pairs closer than cutoff. None includes all pairs.
+        :return: Frequencies in Hz (sorted, unstable modes have negative frequencies), eigenvectors in the columns
+        """
+        H = self.hessian(r, cutoff=cutoff)
+        if cutoff is not None:
+            H = H.toarray()
+        return hessian_to_normal_modes(H)
+
+class TrapAreaSolver(SolverMixin):
 
     def __init__(self, grid_data_x, grid_data_y, potential_data, spline_order_x=3, spline_order_y=3, smoothing=0,
-                 include_screening=True, screening_length=2*0.8E-6):
+                 include_screening=True, screening_length=2*0.8E-6, reduced_model=None, reduced_domain=None,
+                 pair_kernel=None, threads=None):
         """
         This class is used for constructing the functional forms required for scipy.optimize.minimize.
         It deals with the Maxwell input data, as well as constructs the cost function used in the optimizer.
@@ -286,17 +566,45 @@ class TrapAreaSolver:
         :param spline_order_x: Order of the interpolation in the x-direction (1 = linear, 3 = cubic)
         :param spline_order_y: Order of the interpolation in the y-direction (1 = linear, 3 = cubic)
         :param smoothing: Absolute smoothing. Effect depends on scale of potential_data.
-        """
-        self.interpolator = RectBivariateSpline(grid_data_x, grid_data_y, potential_data,
-                                                kx=spline_order_x, ky=spline_order_y, s=smoothing)
+        :param reduced_model: Use a polynomial instead of a spline for the potential. Either the degree of a polynomial
+        that is fitted to potential_data, or a PolynomialEvaluator2D instance for the energy landscape, e.g. combined
+        from fits to each electrode with PolynomialEvaluator2D.combine. No spline is constructed in this case.
+        :param reduced_domain: ((xmin, xmax), (ymin, ymax)) of the region in which the polynomial is fitted, e.g. the
+        trap. Only used if reduced_model is a degree. Defaults to the whole grid.
+        :param pair_kernel: TabulatedKernel instance for the interaction between electrons, e.g. the screening by a
+        ground plane or a helium film. If None, the interaction is exp(-R/screening_length)/R or 1/R, depending on
+        include_screening.
+        :param threads: Number of threads for the interaction energy and gradient, see ThreadedInteraction. Vtotal then
+        evaluates the energy only, and grad_total uses Vtotal_and_grad. None evaluates the full N x N matrices on a
+        single thread.
+        """
+        if reduced_model is None:
+            self.interpolator = RectBivariateSpline(grid_data_x, grid_data_y, potential_data,
+                                                    kx=spline_order_x, ky=spline_order_y, s=smoothing)
+            self.evaluator = SplineEvaluator2D(self.interpolator)
+        else:
+            if not isinstance(reduced_model, PolynomialEvaluator2D):
+                reduced_model = PolynomialEvaluator2D(grid_data_x, grid_data_y, potential_data, degree=reduced_model,
+                                                      domain=reduced_domain)
+                cprint("Reduced model of degree %d: rms residual %.2e, max. residual %.2e"
+                       % (reduced_model.degree, reduced_model.rms_residual, reduced_model.max_residual), "white")
+            self.interpolator = None
+            self.evaluator = reduced_model
 
         # Constants
         self.include_screening = include_screening
         self.screening_length = screening_length
+        self.pair_kernel = pair_kernel
         self.qe = 1.602E-19
         self.eps0 = 8.85E-12
         self.kB = 1.38E-23
 
+        # Thread-parallel evaluation of the interaction for large numbers of electrons
+        self.threaded = None if threads is None else ThreadedInteraction(self.pair_potential, threads=threads)
+
+        # Hessian building blocks for the last evaluated configuration, see hessian_terms
+        self.hessian_cache = None
+
     def V(self, xi, yi):
         """
         Evaluate the electrostatic potential at coordinates xi, yi
@@ -304,7 +612,7 @@ class TrapAreaSolver:
         :param yi: a 1D array or float
         :return: Interpolated value(s) of the data supplied to __init__ at values (xi, yi)
         """
-        return self.interpolator.ev(xi, yi)
+        return self.evaluator.evaluate(xi, yi, order=0)[0]
 
     def Velectrostatic(self, xi, yi):
         """
@@ -330,7 +638,9 @@ class TrapAreaSolver:
         Rij = np.sqrt((Xi - Xj) ** 2 + (Yi - Yj) ** 2)
         np.fill_diagonal(Rij, eps)
 
-        if self.include_screening:
+        if self.pair_kernel is not None:
+            return + 1 / 2. * self.qe * self.pair_kernel.evaluate(Rij, order=0)[0]
+        elif self.include_screening:
             return + 1 / 2. * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij/self.screening_length) / Rij
         else:
             return + 1 / 2. * self.qe ** 2 / (4 * np.pi * self.eps0) * 1 / Rij
@@ -346,6 +656,8 @@ class TrapAreaSolver:
         :return: Scalar with the total energy of the system.
         """
         xi, yi = r[::2], r[1::2]
+        if self.threaded is not None:
+            return np.sum(self.evaluator.evaluate(xi, yi, order=0)[0]) + self.threaded.Vee(xi, yi)
         Vtot = self.Velectrostatic(xi, yi)
         interaction_matrix = self.Vee(xi, yi)
         np.fill_diagonal(interaction_matrix, 0)
@@ -359,7 +671,7 @@ class TrapAreaSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=1, dy=0)
+        return self.evaluator.evaluate(xi, yi, order=1)[1]
 
     def ddVdx(self, xi, yi):
         """
@@ -368,7 +680,7 @@ class TrapAreaSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=2, dy=0)
+        return self.evaluator.evaluate(xi, yi, order=2)[3]
 
     def dVdy(self, xi, yi):
         """
@@ -377,7 +689,7 @@ class TrapAreaSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=0, dy=1)
+        return self.evaluator.evaluate(xi, yi, order=1)[2]
 
     def ddVdy(self, xi, yi):
         """
@@ -386,7 +698,7 @@ class TrapAreaSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=0, dy=2)
+        return self.evaluator.evaluate(xi, yi, order=2)[5]
 
     def grad_Vee(self, xi, yi, eps=1E-15):
         """
@@ -406,7 +718,11 @@ class TrapAreaSolver:
         grady_matrix = np.zeros(np.shape(Rij))
         gradient = np.zeros(2 * len(xi))
 
-        if self.include_screening:
+        if self.pair_kernel is not None:
+            dphi = self.qe * self.pair_kernel.evaluate(Rij, order=1)[1]
+            gradx_matrix = dphi * (Xi - Xj)
+            grady_matrix = -dphi * (Yi - Yj)
+        elif self.include_screening:
             gradx_matrix = -1 * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij/self.screening_length) * \
                            (Xi - Xj) * (Rij + self.screening_length) / (self.screening_length * Rij ** 3)
             grady_matrix = +1 * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij/self.screening_length) * \
@@ -430,13 +746,132 @@ class TrapAreaSolver:
         :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
         :return: 1D array of length len(r), where grad_total = np.array([dV/dx|r0, dV/dy|r0, ...])
         """
+        if self.threaded is not None:
+            return self.Vtotal_and_grad(r)[1]
         xi, yi = r[::2], r[1::2]
+        V, dVdx, dVdy = self.evaluator.evaluate(xi, yi, order=1)
         gradient = np.zeros(len(r))
-        gradient[::2] = self.dVdx(xi, yi)
-        gradient[1::2] = self.dVdy(xi, yi)
+        gradient[::2] = dVdx
+        gradient[1::2] = dVdy
         gradient += self.grad_Vee(xi, yi) / self.qe
         return gradient
 
+    def pair_potential(self, Rij, order=2, out=None):
+        """
+        Interaction energy of two electrons separated by Rij and its derivatives.
+        :param Rij: array of pair distances
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :param out: Optional tuple of order + 1 C-contiguous arrays with the shape of Rij, in which the results are
+        written without temporary arrays, e.g. the preallocated buffers of ThreadedInteraction
+        :return: (phi,), (phi, 1/R dphi/dR) or (phi, 1/R dphi/dR, d2phi/dR2). Units eV, eV/m**2 and eV/m**2.
+        """
+        if self.pair_kernel is not None:
+            return self.pair_kernel.evaluate(Rij, order=order, out=out)
+        if out is not None:
+            return closed_form_potential(Rij, out[:order + 1],
+                                         self.screening_length if self.include_screening else None)
+        if self.include_screening:
+            phi = self.qe / (4 * np.pi * self.eps0) * np.exp(-Rij / self.screening_length) / Rij
+            dphi = -phi * (Rij + self.screening_length) / (self.screening_length * Rij ** 2)
+            d2phi = phi * (Rij ** 2 + 2 * self.screening_length * Rij + 2 * self.screening_length ** 2) / \
+                    (self.screening_length * Rij) ** 2
+        else:
+            phi = self.qe / (4 * np.pi * self.eps0) / Rij
+            dphi = -phi / Rij ** 2
+            d2phi = 2 * phi / Rij ** 2
+        return (phi, dphi, d2phi)[:order + 1]
+
+    def Vee_and_grad(self, xi, yi, eps=1E-15):
+        """
+        Electron-electron interaction energy and its gradient, from a single evaluation of the pairwise distances.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param eps: A small but non-zero number to avoid triggering Warning message. Exact value is irrelevant.
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        if self.threaded is not None:
+            return self.threaded.Vee_and_grad(xi, yi)
+
+        XiXj = xi[:, np.newaxis] - xi[np.newaxis, :]
+        YiYj = yi[:, np.newaxis] - yi[np.newaxis, :]
+        Rij = np.sqrt(XiXj ** 2 + YiYj ** 2)
+        np.fill_diagonal(Rij, eps)
+
+        phi, dphi = self.pair_potential(Rij, order=1)
+        np.fill_diagonal(phi, 0)
+        np.fill_diagonal(dphi, 0)
+
+        gradient = np.zeros(2 * len(xi))
+        gradient[::2] = np.sum(dphi * XiXj, axis=1)
+        gradient[1::2] = np.sum(dphi * YiYj, axis=1)
+        return 0.5 * np.sum(phi), gradient
+
+    def Vtotal_and_grad(self, r):
+        """
+        Total energy and its gradient, evaluated with one interpolation pass. This is faster than calling Vtotal and
+        grad_total separately, use as scipy.optimize.minimize(solver.Vtotal_and_grad, r0, jac=True, ...)
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :return: Vtotal(r), grad_total(r)
+        """
+        xi, yi = r[::2], r[1::2]
+        V, dVdx, dVdy = self.evaluator.evaluate(xi, yi, order=1)
+        Vint, gradient = self.Vee_and_grad(xi, yi)
+        gradient[::2] += dVdx
+        gradient[1::2] += dVdy
+        return np.sum(V) + Vint, gradient
+
+    def thermal_kick(self, x, y, T, maximum_dx=None, maximum_dy=None):
+        """
+        Thermal kicks in the x and y direction from a single evaluation of the potential curvature.
+        See thermal_kick_x and thermal_kick_y.
+        :param x: a 1D array
+        :param y: a 1D array
+        :param T: Temperature in K
+        :return: kick in the x-direction, kick in the y-direction
+        """
+        ddVdx, ddVdy = self.evaluator.evaluate(x, y, order=2)[3::2]
+        kick_x = np.sqrt(2 * self.kB * T / np.abs(self.qe * ddVdx))
+        kick_y = np.sqrt(2 * self.kB * T / np.abs(self.qe * ddVdy))
+        if maximum_dx is not None:
+            kick_x[kick_x > maximum_dx] = maximum_dx
+        if maximum_dy is not None:
+            kick_y[kick_y > maximum_dy] = maximum_dy
+        return kick_x, kick_y
+
+    def external_hessian(self, xi, yi):
+        """
+        Second derivatives of the electrostatic potential at the electron positions.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: d2V/dx2, d2V/dxdy, d2V/dy2
+        """
+        return self.evaluator.evaluate(xi, yi, order=2)[3:]
+
+    def pair_list(self, xi, yi, cutoff=None):
+        """
+        Separations of all electron pairs i < j, or of the pairs within a distance cutoff.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param cutoff: None for all pairs, or the maximum pair distance (neighbor-list mode)
+        :return: i, j, xi - xj, yi - yj, Rij
+        """
+        if cutoff is None:
+            i, j = np.triu_indices(len(xi), k=1)
+        else:
+            i, j = cKDTree(np.column_stack((xi, yi))).query_pairs(cutoff, output_type='ndarray').T
+        dx, dy = xi[i] - xi[j], yi[i] - yi[j]
+        return i, j, dx, dy, np.sqrt(dx ** 2 + dy ** 2)
+
+    def external_potential(self, xi, yi, order=1):
+        """
+        Electrostatic potential and its gradient at the electron positions, for arrays of any shape.
+        :param xi: array of x-coordinates
+        :param yi: array of y-coordinates with the shape of xi
+        :param order: 0 or 1. Highest derivative order to return.
+        :return: (V,) or (V, dV/dx, dV/dy), each with the shape of xi
+        """
+        return self.evaluator.evaluate(xi, yi, order=order)
+
     def thermal_kick_x(self, x, y, T, maximum_dx=None):
         ktrapx = np.abs(self.qe * self.ddVdx(x, y))
         ret = np.sqrt(2 * self.kB * T / ktrapx)
@@ -455,16 +890,9 @@ class TrapAreaSolver:
         else:
             return ret
 
-    def single_thread(self, iteration, electron_initial_positions, T, cost_function, minimizer_dict, maximum_dx, maximum_dy):
-        xi, yi = r2xy(electron_initial_positions)
-        np.random.seed(np.int(time.time()) + iteration)
-        xi_prime = xi + self.thermal_kick_x(xi, yi, T, maximum_dx=maximum_dx) * np.random.randn(len(xi))
-        yi_prime = yi + self.thermal_kick_y(xi, yi, T, maximum_dy=maximum_dy) * np.random.randn(len(yi))
-        electron_perturbed_positions = xy2r(xi_prime, yi_prime)
-        return minimize(cost_function, electron_perturbed_positions, **minimizer_dict)
-
     def parallel_perturb_and_solve(self, cost_function, N_perturbations, T, solution_data_reference, minimizer_dict,
-                                   maximum_dx=None, maximum_dy=None):
+                                   maximum_dx=None, maximum_dy=None, pool=None, time_budget=None, patience=None,
+                                   seed=None):
         """
         This function is to be run after a minimization by scipy.optimize.minimize has already occured.
         It takes the output of that function in solution_data_reference and tries to find a lower energy state
@@ -475,25 +903,26 @@ class TrapAreaSolver:
         :param T: Temperature to perturb the system at. This is used to convert to a motion.
         :param solution_data_reference: output of scipy.optimize.minimize
         :param minimizer_dict: Dictionary with optimizer options. See scipy.optimize.minimize
+        :param pool: SolverPool instance for this solver. Reusing a pool avoids starting the worker processes on
+        every call. If None, a pool is started and closed again for this call.
+        :param time_budget: Maximum wall-clock time in seconds. See SolverPool.perturb_and_solve
+        :param patience: Stop after this many consecutive trials that did not lower the energy
+        :param seed: Seed for the random kicks if no pool is given
         :return: output of minimize with the lowest evaluated cost function
         """
-        electron_initial_positions = solution_data_reference['x']
-        best_result = solution_data_reference
-        pool = multiprocessing.Pool()
-
-        tasks = []
-        iteration = 0
-        while iteration < N_perturbations:
-            iteration += 1
-            tasks.append((iteration, electron_initial_positions, T, cost_function, minimizer_dict, maximum_dx, maximum_dy,))
-
-        results = [pool.apply_async(self.single_thread, t) for t in tasks]
-        for result in results:
-            res = result.get()
+        xi, yi = r2xy(solution_data_reference['x'])
+        kick_x, kick_y = self.thermal_kick(xi, yi, T, maximum_dx=maximum_dx, maximum_dy=maximum_dy)
 
-            if res['status'] == 0 and res['fun'] < best_result['fun']:
-                #cprint("\tNew minimum was found after perturbing!", "green")
-                best_result = res
+        own_pool = pool is None
+        if own_pool:
+            pool = SolverPool(self, seed=seed)
+        try:
+            best_result = pool.perturb_and_solve(cost_function, solution_data_reference, xy2r(kick_x, kick_y),
+                                                 N_perturbations, minimizer_dict, time_budget=time_budget,
+                                                 patience=patience)
+        finally:
+            if own_pool:
+                pool.close()
 
         # Nothing has changed by perturbing the reference solution
         if (best_result['x'] == solution_data_reference['x']).all():
@@ -523,10 +952,12 @@ class TrapAreaSolver:
         electron_initial_positions = solution_data_reference['x']
         best_result = solution_data_reference
 
+        xi, yi = r2xy(electron_initial_positions)
+        kick_x, kick_y = self.thermal_kick(xi, yi, T, maximum_dx=maximum_dx, maximum_dy=maximum_dy)
+
         for n in range(N_perturbations):
-            xi, yi = r2xy(electron_initial_positions)
-            xi_prime = xi + self.thermal_kick_x(xi, yi, T, maximum_dx=maximum_dx) * np.random.randn(len(xi))
-            yi_prime = yi + self.thermal_kick_y(xi, yi, T, maximum_dy=maximum_dy) * np.random.randn(len(yi))
+            xi_prime = xi + kick_x * np.random.randn(len(xi))
+            yi_prime = yi + kick_y * np.random.randn(len(yi))
             electron_perturbed_positions = xy2r(xi_prime, yi_prime)
 
             res = minimize(cost_function, electron_perturbed_positions, **minimizer_options)
@@ -556,22 +987,68 @@ class TrapAreaSolver:
 
         return np.array(mu)
 
-class ResonatorSolver:
+class ResonatorSolver(SolverMixin):
 
     def __init__(self, grid_data, potential_data, efield_data=None, box_length=40E-6, spline_order_x=3, smoothing=0,
-                 include_screening=True, screening_length=2 * 0.8E-6):
+                 include_screening=True, screening_length=2 * 0.8E-6, periodic_images=False, sorted_band=False,
+                 band_window=5E-6, pair_kernel=None, threads=None):
+        """
+        Solver for electrons on the resonator, with a potential that only depends on x and periodic boundary
+        conditions with period box_length in the y-direction.
+        :param grid_data: 1D array of x-data
+        :param potential_data: Energy land scape, - e V_ext, at grid_data
+        :param box_length: Period in the y-direction
+        :param periodic_images: If True, the electrons interact with all periodic images, see PeriodicKernel. This
+        matters for the unscreened interaction, where the interaction with the images is long ranged. If False, only
+        the nearest image is included. The Hessian and the batch functions only include the nearest image and raise a
+        ValueError with periodic_images or sorted_band, whereas MonteCarloSampler includes the periodic images.
+        Looking up the images in the table of PeriodicKernel makes the interaction several times slower than without.
+        :param sorted_band: If True, the interaction is evaluated with SortedBandInteraction instead of the dense N x N
+        matrices, which makes loadings of 10**4 - 10**5 electrons feasible. Pairs within band_window along y are summed
+        directly, pairs beyond the window are approximated on a 1D mesh along the channel.
+        :param band_window: Width of the window in m. It should be a few times the width of the electron channel.
+        :param pair_kernel: TabulatedKernel instance for the interaction between electrons, see TrapAreaSolver. With
+        periodic_images, the sum over the images of the kernel must converge.
+        :param threads: Number of threads for the interaction energy and gradient, see ThreadedInteraction and
+        TrapAreaSolver. Not used with sorted_band.
+        """
         self.interpolator = UnivariateSpline(grid_data, potential_data, k=spline_order_x, s=smoothing, ext=3)
         self.derivative = self.interpolator.derivative(n=1)
         self.second_derivative = self.interpolator.derivative(n=2)
+        self.evaluator = SplineEvaluator1D(self.interpolator)
         self.box_y_length = box_length
 
         self.screening_length = screening_length
         self.include_screening = include_screening
+        self.pair_kernel = pair_kernel
 
         # Constants
         self.qe = 1.602E-19
         self.eps0 = 8.85E-12
 
+        # Hessian building blocks for the last evaluated configuration, see hessian_terms
+        self.hessian_cache = None
+
+        # Tabulated interaction with all periodic images beyond the nearest one
+        self.periodic_kernel = None
+        if periodic_images:
+            self.periodic_kernel = PeriodicKernel(self.pair_potential, box_length,
+                                                  max(np.ptp(grid_data), 2 * box_length),
+                                                  regularize=not include_screening and pair_kernel is None)
+
+        # Sorted-band interaction engine for large numbers of electrons
+        self.sorted_band = None
+        if sorted_band:
+            self.sorted_band = SortedBandInteraction(self.pair_potential, box_length,
+                                                     min(band_window, 0.49 * box_length),
+                                                     periodic_kernel=self.periodic_kernel)
+
+        # Thread-parallel evaluation of the interaction for large numbers of electrons
+        self.threaded = None
+        if threads is not None:
+            self.threaded = ThreadedInteraction(self.pair_potential, threads=threads, period=box_length,
+                                                periodic_kernel=self.periodic_kernel)
+
         if efield_data is not None:
             self.Ex_interpolator = UnivariateSpline(grid_data, efield_data, k=spline_order_x, s=smoothing, ext=3)
 
@@ -610,7 +1087,7 @@ class ResonatorSolver:
         return self.Ex_interpolator(xi)
 
     def V(self, xi, yi):
-        return self.interpolator(xi)
+        return self.evaluator.evaluate(xi, order=0)[0]
 
     def Velectrostatic(self, xi, yi):
         return self.qe * np.sum(self.V(xi, yi))
@@ -620,13 +1097,19 @@ class ResonatorSolver:
         XiXj, YiYj, Rij = self.calculate_metrics(xi, yi)
         np.fill_diagonal(Rij, eps)
 
-        if self.include_screening:
+        if self.pair_kernel is not None:
+            return + 1 / 2. * self.qe * self.pair_kernel.evaluate(Rij, order=0)[0]
+        elif self.include_screening:
             return + 1 / 2. * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij / self.screening_length) / Rij
         else:
             return + 1 / 2. * self.qe ** 2 / (4 * np.pi * self.eps0) * 1 / Rij
 
     def Vtotal(self, r):
+        if self.sorted_band is not None or (self.periodic_kernel is not None and self.threaded is None):
+            return self.Vtotal_and_grad(r)[0]
         xi, yi = r[::2], r[1::2]
+        if self.threaded is not None:
+            return np.sum(self.evaluator.evaluate(xi, order=0)[0]) + self.threaded.Vee(xi, yi)
         Vtot = self.Velectrostatic(xi, yi)
         interaction_matrix = self.Vee(xi, yi)
         np.fill_diagonal(interaction_matrix, 0)
@@ -634,10 +1117,10 @@ class ResonatorSolver:
         return Vtot / self.qe
 
     def dVdx(self, xi, yi):
-        return self.derivative(xi)
+        return self.evaluator.evaluate(xi, order=1)[1]
 
     def ddVdx(self, xi, yi):
-        return self.second_derivative(xi)
+        return self.evaluator.evaluate(xi, order=2)[2]
 
     def dVdy(self, xi, yi):
         return np.zeros(len(xi))
@@ -655,7 +1138,11 @@ class ResonatorSolver:
         grady_matrix = np.zeros(np.shape(Rij))
         gradient = np.zeros(2 * len(xi))
 
-        if self.include_screening:
+        if self.pair_kernel is not None:
+            dphi = self.qe * self.pair_kernel.evaluate(Rij, order=1)[1]
+            gradx_matrix = dphi * XiXj
+            grady_matrix = -dphi * YiYj
+        elif self.include_screening:
             gradx_matrix = -1 * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij/self.screening_length) * \
                            XiXj * (Rij + self.screening_length) / (self.screening_length * Rij ** 3)
             grady_matrix = +1 * self.qe ** 2 / (4 * np.pi * self.eps0) * np.exp(-Rij/self.screening_length) * \
@@ -678,28 +1165,167 @@ class ResonatorSolver:
         :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
         :return: 1D array of length len(r)
         """
+        if self.periodic_kernel is not None or self.sorted_band is not None or self.threaded is not None:
+            return self.Vtotal_and_grad(r)[1]
         xi, yi = r[::2], r[1::2]
         gradient = np.zeros(len(r))
         gradient[::2] = self.dVdx(xi, yi)
-        gradient[1::2] = self.dVdy(xi, yi)
         gradient += self.grad_Vee(xi, yi) / self.qe
         return gradient
 
+    def pair_potential(self, Rij, order=2, out=None):
+        """
+        Interaction energy of two electrons separated by Rij and its derivatives.
+        :param Rij: array of pair distances
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :param out: Optional tuple of order + 1 C-contiguous arrays with the shape of Rij, in which the results are
+        written without temporary arrays, e.g. the preallocated buffers of ThreadedInteraction
+        :return: (phi,), (phi, 1/R dphi/dR) or (phi, 1/R dphi/dR, d2phi/dR2). Units eV, eV/m**2 and eV/m**2.
+        """
+        if self.pair_kernel is not None:
+            return self.pair_kernel.evaluate(Rij, order=order, out=out)
+        if out is not None:
+            return closed_form_potential(Rij, out[:order + 1],
+                                         self.screening_length if self.include_screening else None)
+        if self.include_screening:
+            phi = self.qe / (4 * np.pi * self.eps0) * np.exp(-Rij / self.screening_length) / Rij
+            dphi = -phi * (Rij + self.screening_length) / (self.screening_length * Rij ** 2)
+            d2phi = phi * (Rij ** 2 + 2 * self.screening_length * Rij + 2 * self.screening_length ** 2) / \
+                    (self.screening_length * Rij) ** 2
+        else:
+            phi = self.qe / (4 * np.pi * self.eps0) / Rij
+            dphi = -phi / Rij ** 2
+            d2phi = 2 * phi / Rij ** 2
+        return (phi, dphi, d2phi)[:order + 1]
+
+    def Vee_and_grad(self, xi, yi, eps=1E-15):
+        """
+        Electron-electron interaction energy and its gradient, from a single evaluation of the pairwise distances.
+        The separation in the y-direction is that of the nearest periodic image. If periodic_images is set, the
+        interaction with all other images is added from the table of the PeriodicKernel.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param eps: A small but non-zero number to avoid triggering Warning message. Exact value is irrelevant.
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        if self.sorted_band is not None:
+            return self.sorted_band.Vee_and_grad(xi, yi)
+        if self.threaded is not None:
+            return self.threaded.Vee_and_grad(xi, yi)
+
+        XiXj = xi[:, np.newaxis] - xi[np.newaxis, :]
+        YiYj = yi[:, np.newaxis] - yi[np.newaxis, :]
+        YiYj -= self.box_y_length * np.round(YiYj / self.box_y_length)
+        Rij = np.sqrt(XiXj ** 2 + YiYj ** 2)
+        np.fill_diagonal(Rij, eps)
+
+        phi, dphi = self.pair_potential(Rij, order=1)
+        np.fill_diagonal(phi, 0)
+        np.fill_diagonal(dphi, 0)
+        Fx, Fy = dphi * XiXj, dphi * YiYj
+
+        if self.periodic_kernel is not None:
+            psi, dpsi_dx, dpsi_dy = self.periodic_kernel.evaluate(XiXj, YiYj)
+            # The interaction of an electron with its own images is a constant
+            for matrix in [psi, dpsi_dx, dpsi_dy]:
+                np.fill_diagonal(matrix, 0)
+            phi += psi
+            Fx += dpsi_dx
+            Fy += dpsi_dy
+
+        gradient = np.zeros(2 * len(xi))
+        gradient[::2] = np.sum(Fx, axis=1)
+        gradient[1::2] = np.sum(Fy, axis=1)
+        return 0.5 * np.sum(phi), gradient
+
+    def Vtotal_and_grad(self, r):
+        """
+        Total energy and its gradient, evaluated with one interpolation pass. This is faster than calling Vtotal and
+        grad_total separately, use as scipy.optimize.minimize(solver.Vtotal_and_grad, r0, jac=True, ...)
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :return: Vtotal(r), grad_total(r)
+        """
+        xi, yi = r[::2], r[1::2]
+        V, dVdx = self.evaluator.evaluate(xi, order=1)
+        Vint, gradient = self.Vee_and_grad(xi, yi)
+        gradient[::2] += dVdx
+        return np.sum(V) + Vint, gradient
+
     def thermal_kick_x(self, x, y, T):
         kB = 1.38E-23
         qe = 1.602E-19
         ktrapx = np.abs(qe * self.ddVdx(x, y))
         return np.sqrt(2 * kB * T / ktrapx)
 
-    def single_thread(self, iteration, electron_initial_positions, T, cost_function, minimizer_dict):
-        xi, yi = r2xy(electron_initial_positions)
-        np.random.seed(np.int(time.time()) + iteration)
-        xi_prime = xi + self.thermal_kick_x(xi, yi, T) * np.random.randn(len(xi))
-        yi_prime = yi + self.thermal_kick_x(xi, yi, T) * np.random.randn(len(yi))
-        electron_perturbed_positions = xy2r(xi_prime, yi_prime)
-        return minimize(cost_function, electron_perturbed_positions, method='CG', **minimizer_dict)
+    def external_hessian(self, xi, yi):
+        """
+        Second derivatives of the electrostatic potential at the electron positions.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: d2V/dx2, d2V/dxdy, d2V/dy2
+        """
+        ddVdx = self.evaluator.evaluate(xi, order=2)[2]
+        return ddVdx, np.zeros(len(xi)), np.zeros(len(xi))
+
+    def pair_list(self, xi, yi, cutoff=None):
+        """
+        Separations of all electron pairs i < j, or of the pairs within a distance cutoff. The separation in the
+        y-direction is that of the nearest periodic image.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param cutoff: None for all pairs, or the maximum pair distance (neighbor-list mode)
+        :return: i, j, xi - xj, yi - yj, Rij
+        """
+        yi = self.map_y_into_domain(yi)
+        if cutoff is None:
+            i, j = np.triu_indices(len(xi), k=1)
+        else:
+            tree = cKDTree(np.column_stack((xi, yi + self.box_y_length / 2.)), boxsize=[0, self.box_y_length])
+            i, j = tree.query_pairs(cutoff, output_type='ndarray').T
+        dx, dy = xi[i] - xi[j], yi[i] - yi[j]
+        dy -= self.box_y_length * np.round(dy / self.box_y_length)
+        return i, j, dx, dy, np.sqrt(dx ** 2 + dy ** 2)
+
+    def external_potential(self, xi, yi, order=1):
+        """
+        Electrostatic potential and its gradient at the electron positions, for arrays of any shape.
+        :param xi: array of x-coordinates
+        :param yi: array of y-coordinates with the shape of xi
+        :param order: 0 or 1. Highest derivative order to return.
+        :return: (V,) or (V, dV/dx, dV/dy), each with the shape of xi
+        """
+        V = self.evaluator.evaluate(xi, order=order)
+        return V if order == 0 else (V[0], V[1], np.zeros(np.shape(xi)))
+
+    def nearest_image(self, dy):
+        """
+        Separation in the y-direction of the nearest periodic image.
+        :param dy: array of yi - yj
+        :return: array with the shape of dy, with |dy| <= box_y_length / 2
+        """
+        return dy - self.box_y_length * np.round(dy / self.box_y_length)
 
-    def parallel_perturb_and_solve(self, cost_function, N_perturbations, T, solution_data_reference, minimizer_dict):
+    def check_nearest_image(self, name):
+        """
+        The Hessian and the batch functions only include the nearest periodic image with the dense interaction. Raise
+        if Vtotal is evaluated differently, since the results would not belong to the same energy.
+        :param name: Name of the function for the error message
+        :return: None
+        """
+        if self.periodic_kernel is not None or self.sorted_band is not None:
+            raise ValueError("%s only includes the nearest periodic image and can not be combined with "
+                             "periodic_images or sorted_band." % name)
+
+    def batch_evaluate(self, R, order=1):
+        self.check_nearest_image("batch_evaluate")
+        return super().batch_evaluate(R, order=order)
+
+    def hessian_terms(self, r, cutoff=None):
+        self.check_nearest_image("hessian_terms")
+        return super().hessian_terms(r, cutoff=cutoff)
+
+    def parallel_perturb_and_solve(self, cost_function, N_perturbations, T, solution_data_reference, minimizer_dict,
+                                   pool=None, time_budget=None, patience=None, seed=None):
         """
         This function is to be run after a minimization by scipy.optimize.minimize has already occured.
         It takes the output of that function in solution_data_reference and tries to find a lower energy state
@@ -710,33 +1336,27 @@ class ResonatorSolver:
         :param T: Temperature to perturb the system at. This is used to convert to a motion.
         :param solution_data_reference: output of scipy.optimize.minimize
         :param minimizer_dict: Dictionary with optimizer options. See scipy.optimize.minimize
+        :param pool: SolverPool instance for this solver. Reusing a pool avoids starting the worker processes on
+        every call. If None, a pool is started and closed again for this call.
+        :param time_budget: Maximum wall-clock time in seconds. See SolverPool.perturb_and_solve
+        :param patience: Stop after this many consecutive trials that did not lower the energy
+        :param seed: Seed for the random kicks if no pool is given
         :return: output of minimize with the lowest evaluated cost function
         """
-        electron_initial_positions = solution_data_reference['x']
-        best_result = solution_data_reference
-        pool = multiprocessing.Pool()
-
-        tasks = []
-        iteration = 0
-        while iteration < N_perturbations:
-            iteration += 1
-            tasks.append((iteration, electron_initial_positions, T, cost_function, minimizer_dict,))
+        minimizer_options = dict({'method' : 'CG'}, **minimizer_dict)
 
-        results = [pool.apply_async(self.single_thread, t) for t in tasks]
-        for result in results:
-            res = result.get()
+        xi, yi = r2xy(solution_data_reference['x'])
+        kick = self.thermal_kick_x(xi, yi, T)
 
-            if res['status'] == 0 and res['fun'] < best_result['fun']:
-                cprint("\tNew minimum was found after perturbing!", "green")
-                best_result = res
-            elif res['status'] == 0 and res['fun'] > best_result['fun']:
-                pass  # No new minimum was found after perturbation, this is quite common.
-            elif res['status'] != 0 and res['fun'] < best_result['fun']:
-                cprint("\tThere is a lower state, but minimizer didn't converge!", "red")
-            elif res['status'] != 0 and res['fun'] > best_result['fun']:
-                cprint("\tMinimizer didn't converge, but this is not the lowest energy state!", "magenta")
-
-        return best_result
+        own_pool = pool is None
+        if own_pool:
+            pool = SolverPool(self, seed=seed)
+        try:
+            return pool.perturb_and_solve(cost_function, solution_data_reference, xy2r(kick, kick), N_perturbations,
+                                          minimizer_options, time_budget=time_budget, patience=patience, verbose=True)
+        finally:
+            if own_pool:
+                pool.close()
 
     def sequential_perturb_and_solve(self, cost_function, N_perturbations, T, solution_data_reference, minimizer_options):
         """
@@ -753,14 +1373,17 @@ class ResonatorSolver:
 
         electron_initial_positions = solution_data_reference['x']
         best_result = solution_data_reference
+        minimizer_options = dict({'method' : 'CG'}, **minimizer_options)
+
+        xi, yi = r2xy(electron_initial_positions)
+        kick = self.thermal_kick_x(xi, yi, T)
 
         for n in range(N_perturbations):
-            xi, yi = r2xy(electron_initial_positions)
-            xi_prime = xi + self.thermal_kick_x(xi, yi, T) * np.random.randn(len(xi))
-            yi_prime = yi + self.thermal_kick_x(xi, yi, T) * np.random.randn(len(yi))
+            xi_prime = xi + kick * np.random.randn(len(xi))
+            yi_prime = yi + kick * np.random.randn(len(yi))
             electron_perturbed_positions = xy2r(xi_prime, yi_prime)
 
-            res = minimize(cost_function, electron_perturbed_positions, method='CG', **minimizer_options)
+            res = minimize(cost_function, electron_perturbed_positions, **minimizer_options)
 
             if res['status'] == 0 and res['fun'] < best_result['fun']:
                 cprint("\tNew minimum was found after perturbing!", "green")
@@ -792,24 +1415,44 @@ class ResonatorSolver:
         plt.plot([(edge_gap + pin_width + center_gap / 2.), (edge_gap + pin_width + center_gap / 2.)],
                  [-box_y_length / 2., box_y_length / 2.], **plot_kwargs)
 
-class CombinedModelSolver:
+class CombinedModelSolver(SolverMixin):
 
     def __init__(self, grid_data_x, grid_data_y, potential_data, resonator_electron_configuration,
-                 spline_order_x=3, spline_order_y=3, smoothing=0):
+                 spline_order_x=3, spline_order_y=3, smoothing=0, pair_kernel=None, threads=None):
 
         self.interpolator = RectBivariateSpline(grid_data_x, grid_data_y, potential_data,
                                                 kx=spline_order_x, ky=spline_order_y, s=smoothing)
+        self.evaluator = SplineEvaluator2D(self.interpolator)
+
+        # Keep the grid data, such that the background potential can be folded into the interpolator later
+        self.grid_data_x = grid_data_x
+        self.grid_data_y = grid_data_y
+        self.potential_data = potential_data
+        self.spline_options = {'kx' : spline_order_x, 'ky' : spline_order_y, 's' : smoothing}
 
         # Constants
         self.qe = 1.602E-19
         self.eps0 = 8.85E-12
         self.kB = 1.38E-23
 
+        # TabulatedKernel for the interaction between electrons, also with the resonator electrons. None for 1/R.
+        self.pair_kernel = pair_kernel
+
+        # Number of threads for the interaction, see ThreadedInteraction. None for a single thread.
+        self.threaded = None if threads is None else ThreadedInteraction(self.pair_potential, threads=threads)
+
         # Coordinates for the background potential due to electrons on the resonator
         x_res, y_res = r2xy(resonator_electron_configuration)
         self.x_res = x_res
         self.y_res = y_res
 
+        # See precompute_background
+        self.background_folded = False
+        self.background_evaluator = None
+
+        # Hessian building blocks for the last evaluated configuration, see hessian_terms
+        self.hessian_cache = None
+
     def V(self, xi, yi):
         """
         Evaluate the electrostatic potential at coordinates xi, yi
@@ -817,7 +1460,7 @@ class CombinedModelSolver:
         :param yi: a 1D array or float
         :return: Interpolated value(s) of the data supplied to __init__ at values (xi, yi)
         """
-        return self.interpolator.ev(xi, yi)
+        return self.evaluator.evaluate(xi, yi, order=0)[0]
 
     def Velectrostatic(self, xi, yi):
         """
@@ -853,6 +1496,8 @@ class CombinedModelSolver:
         """
         XiXj, YiYj, Rij = self.calculate_metrics(xi, yi)
         np.fill_diagonal(Rij, eps)
+        if self.pair_kernel is not None:
+            return + 1 / 2. * self.qe * self.pair_kernel.evaluate(Rij, order=0)[0]
         return + 1 / 2. * self.qe ** 2 / (4 * np.pi * self.eps0) * 1 / Rij
 
     def Vtotal(self, r):
@@ -866,7 +1511,10 @@ class CombinedModelSolver:
         :return: Scalar with the total energy of the system.
         """
         xi, yi = r[::2], r[1::2]
-        Vtot = self.Velectrostatic(xi, yi) + np.sum(self.Vbg(xi, yi))
+        if self.threaded is not None:
+            return np.sum(self.evaluator.evaluate(xi, yi, order=0)[0]) + \
+                   np.sum(self.background_potential(xi, yi, order=0)[0]) + self.threaded.Vee(xi, yi)
+        Vtot = self.Velectrostatic(xi, yi) + self.qe * np.sum(self.background_potential(xi, yi, order=0)[0])
         interaction_matrix = self.Vee(xi, yi)
         np.fill_diagonal(interaction_matrix, 0)
         Vtot += np.sum(interaction_matrix)
@@ -900,6 +1548,102 @@ class CombinedModelSolver:
         dVdy = - self.qe / (4 * np.pi * self.eps0) * (Y_i - Y_res) / Rij ** 3
         return np.sum(dVdy, axis=1)
 
+    def background_potential(self, xi, yi, order=1):
+        """
+        Potential due to the electrons on the resonator and its gradient. If precompute_background has been called,
+        this is a spline lookup. Otherwise it is a direct sum over all resonator electrons.
+        :param xi: a 1D array
+        :param yi: a 1D array (must be same length as xi)
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :return: (Vbg,), (Vbg, dVbg/dx, dVbg/dy) or (Vbg, dVbg/dx, dVbg/dy, d2Vbg/dx2, d2Vbg/dxdy, d2Vbg/dy2).
+        Vbg = Vbg(xi, yi) / qe in V, derivatives in V/m and V/m**2.
+        """
+        if self.background_folded:
+            # The background is already contained in self.V
+            return (np.zeros(np.shape(xi)),) * {0: 1, 1: 3, 2: 6}[order]
+        elif self.background_evaluator is not None:
+            return self.background_evaluator.evaluate(xi, yi, order=order)
+
+        X_res, X_i = np.meshgrid(self.x_res, xi)
+        Y_res, Y_i = np.meshgrid(self.y_res, yi)
+
+        XiXres, YiYres = X_i - X_res, Y_i - Y_res
+        Rij = np.sqrt(XiXres ** 2 + YiYres ** 2)
+        terms = self.pair_potential(Rij, order=order)
+        if order == 0:
+            return (np.sum(terms[0], axis=1),)
+        V, dphi = terms[:2]
+        if order == 1:
+            return np.sum(V, axis=1), np.sum(dphi * XiXres, axis=1), np.sum(dphi * YiYres, axis=1)
+        else:
+            # See pair_hessian_blocks
+            a = (terms[2] - dphi) / Rij ** 2
+            return np.sum(V, axis=1), np.sum(dphi * XiXres, axis=1), np.sum(dphi * YiYres, axis=1), \
+                   np.sum(dphi + a * XiXres ** 2, axis=1), np.sum(a * XiXres * YiYres, axis=1), \
+                   np.sum(dphi + a * YiYres ** 2, axis=1)
+
+    def precompute_background(self, grid_data_x=None, grid_data_y=None, test_points=None, tolerance=1E-3):
+        """
+        The resonator electrons don't move while the trap is being solved. This evaluates their potential once on a
+        grid, which turns the sum over all M resonator electrons in every iteration into a spline lookup.
+        If grid_data_x and grid_data_y are None, the background is added to the potential data on the solver's grid
+        and folded into self.interpolator, such that self.V includes the background. Otherwise a separate spline is
+        constructed on the supplied grid, which may be a refined grid around the trap.
+        Note: the grid should not contain resonator electrons, where the 1/r potential can't be interpolated.
+        :param grid_data_x: 1D array of x-data for the background grid (optional)
+        :param grid_data_y: 1D array of y-data for the background grid (optional)
+        :param test_points: Electron positions r = [x0, y0, x1, y1, ...] at which the interpolated background is compared
+        to direct summation. Defaults to the centers of the grid cells.
+        :param tolerance: A warning is printed if the relative error of the potential or its gradient exceeds this value.
+        :return: Dictionary with the maximum relative error of the potential ('V') and its gradient ('grad')
+        """
+        if self.background_folded:
+            # Remove the background of an earlier call from the interpolator, such that it is not counted twice
+            self.interpolator = RectBivariateSpline(self.grid_data_x, self.grid_data_y, self.potential_data,
+                                                    **self.spline_options)
+            self.evaluator = SplineEvaluator2D(self.interpolator)
+        self.background_folded = False
+        self.background_evaluator = None
+        fold = grid_data_x is None and grid_data_y is None
+        if fold:
+            grid_data_x, grid_data_y = self.grid_data_x, self.grid_data_y
+
+        Xgrid, Ygrid = np.meshgrid(grid_data_x, grid_data_y, indexing='ij')
+        Vbg_grid = self.background_potential(Xgrid.ravel(), Ygrid.ravel(), order=0)[0].reshape(np.shape(Xgrid))
+        background_evaluator = SplineEvaluator2D(RectBivariateSpline(grid_data_x, grid_data_y, Vbg_grid,
+                                                                     **self.spline_options))
+
+        # Compare the interpolated background to direct summation
+        if test_points is None:
+            xc = (grid_data_x[1:] + grid_data_x[:-1]) / 2.
+            yc = (grid_data_y[1:] + grid_data_y[:-1]) / 2.
+            Xc, Yc = np.meshgrid(xc, yc, indexing='ij')
+            xt, yt = Xc.ravel(), Yc.ravel()
+        else:
+            xt, yt = r2xy(test_points)
+
+        V_direct, dVdx_direct, dVdy_direct = self.background_potential(xt, yt, order=1)
+        V_interp, dVdx_interp, dVdy_interp = background_evaluator.evaluate(xt, yt, order=1)
+        grad_norm = np.max(np.sqrt(dVdx_direct ** 2 + dVdy_direct ** 2))
+        errors = {'V' : np.max(np.abs(V_interp - V_direct)) / np.max(np.abs(V_direct)),
+                  'grad' : np.max(np.sqrt((dVdx_interp - dVdx_direct) ** 2 +
+                                          (dVdy_interp - dVdy_direct) ** 2)) / grad_norm}
+
+        if errors['V'] > tolerance or errors['grad'] > tolerance:
+            cprint("Precomputed background deviates from direct summation (V: %.2e, grad: %.2e)"
+                   % (errors['V'], errors['grad']), "red")
+
+        if fold:
+            self.interpolator = RectBivariateSpline(grid_data_x, grid_data_y, self.potential_data + Vbg_grid,
+                                                    **self.spline_options)
+            self.evaluator = SplineEvaluator2D(self.interpolator)
+            self.background_folded = True
+        else:
+            self.background_evaluator = background_evaluator
+
+        self.hessian_cache = None
+        return errors
+
     def dVdx(self, xi, yi):
         """
         Derivative of the electrostatic potential in the x-direction.
@@ -907,7 +1651,7 @@ class CombinedModelSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=1, dy=0)
+        return self.evaluator.evaluate(xi, yi, order=1)[1]
 
     def ddVdx(self, xi, yi):
         """
@@ -916,7 +1660,7 @@ class CombinedModelSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=2, dy=0)
+        return self.evaluator.evaluate(xi, yi, order=2)[3]
 
     def dVdy(self, xi, yi):
         """
@@ -925,7 +1669,7 @@ class CombinedModelSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=0, dy=1)
+        return self.evaluator.evaluate(xi, yi, order=1)[2]
 
     def ddVdy(self, xi, yi):
         """
@@ -934,7 +1678,7 @@ class CombinedModelSolver:
         :param yi: a 1D array or float
         :return:
         """
-        return self.interpolator.ev(xi, yi, dx=0, dy=2)
+        return self.evaluator.evaluate(xi, yi, order=2)[5]
 
     def grad_Vee(self, xi, yi, eps=1E-15):
         """
@@ -952,10 +1696,11 @@ class CombinedModelSolver:
         grady_matrix = np.zeros(np.shape(Rij))
         gradient = np.zeros(2 * len(xi))
 
-        gradx_matrix = -1 * self.qe ** 2 / (4 * np.pi * self.eps0) * (XiXj) / Rij ** 3
+        dphi = self.qe * self.pair_potential(Rij, order=1)[1]
+        gradx_matrix = dphi * XiXj
         np.fill_diagonal(gradx_matrix, 0)
 
-        grady_matrix = +1 * self.qe ** 2 / (4 * np.pi * self.eps0) * (YiYj) / Rij ** 3
+        grady_matrix = -dphi * YiYj
         np.fill_diagonal(grady_matrix, 0)
 
         gradient[::2] = np.sum(gradx_matrix, axis=0)
@@ -969,13 +1714,72 @@ class CombinedModelSolver:
         :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
         :return: 1D array of length len(r)
         """
+        if self.threaded is not None:
+            return self.Vtotal_and_grad(r)[1]
         xi, yi = r[::2], r[1::2]
+        V, dVdx, dVdy = self.evaluator.evaluate(xi, yi, order=1)
+        Vbg, dVbgdx, dVbgdy = self.background_potential(xi, yi, order=1)
         gradient = np.zeros(len(r))
-        gradient[::2] = self.dVdx(xi, yi) + self.dVbgdx(xi, yi)
-        gradient[1::2] = self.dVdy(xi, yi) + self.dVbgdy(xi, yi)
+        gradient[::2] = dVdx + dVbgdx
+        gradient[1::2] = dVdy + dVbgdy
         gradient += self.grad_Vee(xi, yi) / self.qe
         return gradient
 
+    def pair_potential(self, Rij, order=2, out=None):
+        """
+        Interaction energy of two electrons separated by Rij and its derivatives.
+        :param Rij: array of pair distances
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :param out: Optional tuple of order + 1 C-contiguous arrays with the shape of Rij, in which the results are
+        written without temporary arrays, e.g. the preallocated buffers of ThreadedInteraction
+        :return: (phi,), (phi, 1/R dphi/dR) or (phi, 1/R dphi/dR, d2phi/dR2). Units eV, eV/m**2 and eV/m**2.
+        """
+        if self.pair_kernel is not None:
+            return self.pair_kernel.evaluate(Rij, order=order, out=out)
+        if out is not None:
+            return closed_form_potential(Rij, out[:order + 1])
+        phi = self.qe / (4 * np.pi * self.eps0) / Rij
+        return (phi, -phi / Rij ** 2, 2 * phi / Rij ** 2)[:order + 1]
+
+    def Vee_and_grad(self, xi, yi, eps=1E-15):
+        """
+        Electron-electron interaction energy and its gradient, from a single evaluation of the pairwise distances.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param eps: A small but non-zero number to avoid triggering Warning message. Exact value is irrelevant.
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        if self.threaded is not None:
+            return self.threaded.Vee_and_grad(xi, yi)
+
+        XiXj, YiYj, Rij = self.calculate_metrics(xi, yi)
+        np.fill_diagonal(Rij, eps)
+
+        phi, dphi = self.pair_potential(Rij, order=1)
+        np.fill_diagonal(phi, 0)
+        np.fill_diagonal(dphi, 0)
+
+        # Note: XiXj[i, j] = xj - xi and YiYj[i, j] = yi - yj, see calculate_metrics
+        gradient = np.zeros(2 * len(xi))
+        gradient[::2] = np.sum(dphi * XiXj, axis=0)
+        gradient[1::2] = -np.sum(dphi * YiYj, axis=0)
+        return 0.5 * np.sum(phi), gradient
+
+    def Vtotal_and_grad(self, r):
+        """
+        Total energy and its gradient, evaluated with one interpolation pass. This is faster than calling Vtotal and
+        grad_total separately, use as scipy.optimize.minimize(solver.Vtotal_and_grad, r0, jac=True, ...)
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :return: Vtotal(r), grad_total(r)
+        """
+        xi, yi = r[::2], r[1::2]
+        V, dVdx, dVdy = self.evaluator.evaluate(xi, yi, order=1)
+        Vbg, dVbgdx, dVbgdy = self.background_potential(xi, yi, order=1)
+        Vint, gradient = self.Vee_and_grad(xi, yi)
+        gradient[::2] += dVdx + dVbgdx
+        gradient[1::2] += dVdy + dVbgdy
+        return np.sum(V) + np.sum(Vbg) + Vint, gradient
+
     def calculate_metrics(self, xi, yi):
         """
         Calculate the pairwise distance between electron combinations (xi, yi)
@@ -1001,6 +1805,57 @@ class CombinedModelSolver:
         ktrapy = np.abs(self.qe * self.ddVdy(x, y))
         return np.sqrt(2 * self.kB * T / ktrapy)
 
+    def thermal_kick(self, x, y, T):
+        """
+        Thermal kicks in the x and y direction from a single evaluation of the potential curvature.
+        See thermal_kick_x and thermal_kick_y.
+        :param x: a 1D array
+        :param y: a 1D array
+        :param T: Temperature in K
+        :return: kick in the x-direction, kick in the y-direction
+        """
+        ddVdx, ddVdy = self.evaluator.evaluate(x, y, order=2)[3::2]
+        return np.sqrt(2 * self.kB * T / np.abs(self.qe * ddVdx)), np.sqrt(2 * self.kB * T / np.abs(self.qe * ddVdy))
+
+    def external_hessian(self, xi, yi):
+        """
+        Second derivatives of the electrostatic potential and the background potential at the electron positions.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: d2V/dx2, d2V/dxdy, d2V/dy2
+        """
+        ddVdx, ddVdxdy, ddVdy = self.evaluator.evaluate(xi, yi, order=2)[3:]
+        ddVbgdx, ddVbgdxdy, ddVbgdy = self.background_potential(xi, yi, order=2)[3:]
+        return ddVdx + ddVbgdx, ddVdxdy + ddVbgdxdy, ddVdy + ddVbgdy
+
+    def pair_list(self, xi, yi, cutoff=None):
+        """
+        Separations of all electron pairs i < j, or of the pairs within a distance cutoff.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :param cutoff: None for all pairs, or the maximum pair distance (neighbor-list mode)
+        :return: i, j, xi - xj, yi - yj, Rij
+        """
+        if cutoff is None:
+            i, j = np.triu_indices(len(xi), k=1)
+        else:
+            i, j = cKDTree(np.column_stack((xi, yi))).query_pairs(cutoff, output_type='ndarray').T
+        dx, dy = xi[i] - xi[j], yi[i] - yi[j]
+        return i, j, dx, dy, np.sqrt(dx ** 2 + dy ** 2)
+
+    def external_potential(self, xi, yi, order=1):
+        """
+        Electrostatic potential and the background potential of the resonator electrons, and their gradient at the
+        electron positions, for arrays of any shape.
+        :param xi: array of x-coordinates
+        :param yi: array of y-coordinates with the shape of xi
+        :param order: 0 or 1. Highest derivative order to return.
+        :return: (V,) or (V, dV/dx, dV/dy), each with the shape of xi
+        """
+        V = self.evaluator.evaluate(xi, yi, order=order)
+        Vbg = self.background_potential(np.ravel(xi), np.ravel(yi), order=order)
+        return tuple(v + np.reshape(vbg, np.shape(xi)) for v, vbg in zip(V, Vbg))
+
     def perturb_and_solve(self, cost_function, N_perturbations, T, solution_data_reference, **minimizer_options):
         """
         This function is to be run after a minimization by scipy.optimize.minimize has already occured.
@@ -1016,14 +1871,17 @@ class CombinedModelSolver:
 
         electron_initial_positions = solution_data_reference['x']
         best_result = solution_data_reference
+        minimizer_options = dict({'method' : 'CG'}, **minimizer_options)
+
+        xi, yi = r2xy(electron_initial_positions)
+        kick_x, kick_y = self.thermal_kick(xi, yi, T)
 
         for n in range(N_perturbations):
-            xi, yi = r2xy(electron_initial_positions)
-            xi_prime = xi + self.thermal_kick_x(xi, yi, T) * np.random.randn(len(xi))
-            yi_prime = yi + self.thermal_kick_y(xi, yi, T) * np.random.randn(len(yi))
+            xi_prime = xi + kick_x * np.random.randn(len(xi))
+            yi_prime = yi + kick_y * np.random.randn(len(yi))
             electron_perturbed_positions = xy2r(xi_prime, yi_prime)
 
-            res = minimize(cost_function, electron_perturbed_positions, method='CG', **minimizer_options)
+            res = minimize(cost_function, electron_perturbed_positions, **minimizer_options)
 
             if res['status'] == 0 and res['fun'] < best_result['fun']:
                 cprint("\tNew minimum was found after perturbing!", "green")
@@ -1037,6 +1895,152 @@ class CombinedModelSolver:
 
         return best_result
 
+class MirrorSymmetricSolver:
+
+    def __init__(self, solver, N_axis=0, axis_tolerance=10E-9):
+        """
+        Solver for configurations that are mirror symmetric around y = 0, for potentials that are symmetric in y, such as
+        the output of load_data(mirror_y=True). Only the electrons in the upper half plane and the x-coordinates of the
+        electrons on the axis y = 0 are optimized, i.e. q = [x0, y0, ..., xM, yM, a0, ..., aK] for N = 2M + K
+        electrons. The interactions with the mirror images are added analytically.
+        Minimize with scipy.optimize.minimize(symmetric_solver.Vtotal_and_grad, q0, jac=True), where q0 = reduce(r0),
+        then use expand or polish to get the full configuration.
+        :param solver: TrapAreaSolver or CombinedModelSolver instance
+        :param N_axis: Number of electrons on the axis y = 0. Set by reduce.
+        :param axis_tolerance: Electrons with |y| smaller than this (in m) are on the axis, see reduce
+        """
+        self.solver = solver
+        self.N_axis = N_axis
+        self.axis_tolerance = axis_tolerance
+
+    def split(self, q):
+        M = (len(q) - self.N_axis) // 2
+        return q[:2 * M:2], q[1:2 * M:2], q[2 * M:]
+
+    def reduce(self, r):
+        """
+        Reduced coordinates of a full configuration. Electrons with |y| < axis_tolerance are placed on the axis, the
+        others are represented by the electrons with y > 0. This also sets N_axis.
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :return: q = [x0, y0, ..., xM, yM, a0, ..., aK]
+        """
+        xi, yi = r2xy(np.asarray(r, dtype=np.float64))
+        axis = np.abs(yi) < self.axis_tolerance
+        upper = yi >= self.axis_tolerance
+        if np.sum(upper) != np.sum(yi <= -self.axis_tolerance):
+            cprint("Configuration is not mirror symmetric: %d electrons above and %d below the axis. Using the upper half."
+                   % (np.sum(upper), np.sum(yi <= -self.axis_tolerance)), "yellow")
+        self.N_axis = int(np.sum(axis))
+        return np.concatenate((xy2r(xi[upper], yi[upper]), xi[axis]))
+
+    def expand(self, q):
+        """
+        Full configuration from the reduced coordinates.
+        :param q: q = [x0, y0, ..., xM, yM, a0, ..., aK], or output of scipy.optimize.minimize
+        :return: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN]) with N = 2M + K
+        """
+        if isinstance(q, dict):
+            q = q['x']
+        xu, yu, a = self.split(np.asarray(q, dtype=np.float64))
+        return xy2r(np.concatenate((xu, xu, a)), np.concatenate((yu, -yu, np.zeros(len(a)))))
+
+    def Vtotal_and_grad(self, q, eps=1E-15):
+        """
+        Total energy of the full symmetric configuration and its gradient with respect to the reduced coordinates.
+        :param q: q = [x0, y0, ..., xM, yM, a0, ..., aK]
+        :param eps: A small but non-zero number to avoid triggering Warning message. Exact value is irrelevant.
+        :return: Vtotal(expand(q)), gradient (1D array of size len(q))
+        """
+        xu, yu, a = self.split(q)
+        M, K = len(xu), len(a)
+        gradient = np.zeros(len(q))
+        gx, gy, ga = gradient[:2 * M:2], gradient[1:2 * M:2], gradient[2 * M:]
+
+        # External potential at the electrons, their mirror images and the electrons on the axis
+        X, Y = np.concatenate((xu, xu, a)), np.concatenate((yu, -yu, np.zeros(K)))
+        V, dVdx, dVdy = self.solver.evaluator.evaluate(X, Y, order=1)
+        energy = np.sum(V)
+        if hasattr(self.solver, 'background_potential'):
+            Vbg, dVbgdx, dVbgdy = self.solver.background_potential(X, Y, order=1)
+            energy += np.sum(Vbg)
+            dVdx, dVdy = dVdx + dVbgdx, dVdy + dVbgdy
+        gx += dVdx[:M] + dVdx[M:2 * M]
+        gy += dVdy[:M] - dVdy[M:2 * M]
+        ga += dVdx[2 * M:]
+
+        # Pairs in the upper half plane, and the identical pairs of their mirror images
+        dx = xu[:, np.newaxis] - xu[np.newaxis, :]
+        dy = yu[:, np.newaxis] - yu[np.newaxis, :]
+        Rij = np.sqrt(dx ** 2 + dy ** 2)
+        np.fill_diagonal(Rij, eps)
+        phi, dphi = self.solver.pair_potential(Rij, order=1)
+        np.fill_diagonal(phi, 0)
+        np.fill_diagonal(dphi, 0)
+        energy += np.sum(phi)
+        gx += 2 * np.sum(dphi * dx, axis=1)
+        gy += 2 * np.sum(dphi * dy, axis=1)
+
+        # Pairs of an electron and a mirror image, including its own image at distance 2y
+        dy = yu[:, np.newaxis] + yu[np.newaxis, :]
+        phi, dphi = self.solver.pair_potential(np.maximum(np.sqrt(dx ** 2 + dy ** 2), eps), order=1)
+        energy += np.sum(phi)
+        gx += 2 * np.sum(dphi * dx, axis=1)
+        gy += 2 * np.sum(dphi * dy, axis=1)
+
+        if K > 0:
+            # Electrons in the upper half plane and their images with the electrons on the axis
+            dx = xu[:, np.newaxis] - a[np.newaxis, :]
+            phi, dphi = self.solver.pair_potential(np.maximum(np.sqrt(dx ** 2 + yu[:, np.newaxis] ** 2), eps), order=1)
+            energy += 2 * np.sum(phi)
+            gx += 2 * np.sum(dphi * dx, axis=1)
+            gy += 2 * np.sum(dphi, axis=1) * yu
+            ga -= 2 * np.sum(dphi * dx, axis=0)
+
+            # Electrons on the axis
+            dx = a[:, np.newaxis] - a[np.newaxis, :]
+            Rij = np.abs(dx)
+            np.fill_diagonal(Rij, eps)
+            phi, dphi = self.solver.pair_potential(Rij, order=1)
+            np.fill_diagonal(phi, 0)
+            np.fill_diagonal(dphi, 0)
+            energy += 0.5 * np.sum(phi)
+            ga += np.sum(dphi * dx, axis=1)
+
+        return energy, gradient
+
+    def Vtotal(self, q):
+        """
+        Total energy of the full symmetric configuration, see Vtotal_and_grad.
+        :param q: q = [x0, y0, ..., xM, yM, a0, ..., aK]
+        :return: Total energy in eV
+        """
+        return self.Vtotal_and_grad(q)[0]
+
+    def grad_total(self, q):
+        """
+        Gradient of Vtotal with respect to the reduced coordinates, see Vtotal_and_grad.
+        :param q: q = [x0, y0, ..., xM, yM, a0, ..., aK]
+        :return: 1D array of size len(q)
+        """
+        return self.Vtotal_and_grad(q)[1]
+
+    def polish(self, q, minimizer_dict=None):
+        """
+        Minimize the full configuration without the symmetry constraint, starting from expand(q). This finds a lower
+        state if the symmetric minimum is a saddle point of the full problem.
+        :param q: Reduced coordinates or output of scipy.optimize.minimize with the reduced problem
+        :param minimizer_dict: Dictionary with optimizer options. See scipy.optimize.minimize
+        :return: output of scipy.optimize.minimize for the full configuration
+        """
+        minimizer_options = dict({'method' : 'CG'}, **({} if minimizer_dict is None else minimizer_dict))
+        r = self.expand(q)
+        res = minimize(self.solver.Vtotal_and_grad, r, jac=True, **minimizer_options)
+        symmetric_energy = self.solver.Vtotal(r)
+        if res['fun'] < symmetric_energy - 1E-9 * np.abs(symmetric_energy):
+            cprint("\tBreaking the mirror symmetry lowers the energy by %.3e eV" % (symmetric_energy - res['fun']),
+                   "yellow")
+        return res
+
 ######################
 ## HELPER FUNCTIONS ##
 ######################
@@ -1058,11 +2062,221 @@ def construct_symmetric_y(ymin, N):
     return np.linspace(ymin, -dy / 2., (np.abs(ymin) - 0.5 * dy) / dy + 1)
 
 
+# Results of the stages of load_data, keyed by the fingerprint of their inputs. See cached_stage.
+load_data_cache = OrderedDict()
+load_data_cache_size = 32
+
+def cached_stage(key, function, *args):
+    """
+    Evaluate function(*args) or return the result of an earlier call with the same key. The least recently used
+    results are dropped when there are more than load_data_cache_size. Results must not be modified in place.
+    :param key: Hashable key, e.g. from solution_cache.fingerprint
+    :param function: Function that computes the stage
+    :return: Return value of function
+    """
+    if key in load_data_cache:
+        load_data_cache.move_to_end(key)
+        return load_data_cache[key]
+    result = function(*args)
+    load_data_cache[key] = result
+    while len(load_data_cache) > load_data_cache_size:
+        load_data_cache.popitem(last=False)
+    return result
+
+def interpolate_dsp_files(data_path, datafiles, xeval, yeval):
+    """
+    Load the .dsp files and interpolate the potential of each electrode on the grid xeval, yeval. This is the slow part
+    of load_data. xeval and yeval don't have to be uniform.
+    :return: x (1D), y (1D) in um, the potentials as a 3D array of shape (len(datafiles), len(y), len(x)) and the
+    coordinates (x, y) of the nodes of the FEM meshes in um
+    """
+    potentials, nodes_x, nodes_y = list(), list(), list()
+    for datafile in datafiles:
+        elements, nodes, elem_solution, bounding_box = load_dsp(os.path.join(data_path, datafile))
+        xdata, ydata, Udata = interpolate_slow.prepare_for_interpolation(elements, nodes, elem_solution)
+        xdata -= np.mean(bounding_box[0:2])
+        ydata -= bounding_box[3]
+
+        if xeval is None:
+            xeval = np.linspace(np.min(xdata), np.max(xdata), 101)
+        if yeval is None:
+            yeval = np.linspace(np.min(ydata), np.max(ydata), 101)
+
+        xinterp, yinterp, Uinterp = interpolate_slow.evaluate_on_grid(xdata, ydata, Udata, xeval=xeval, yeval=yeval,
+                                                                      clim=(0.0, 1.0), plot_axes='xy',
+                                                                      cmap=plt.cm.Spectral_r, plot_mesh=False,
+                                                                      plot_data=False)
+        potentials.append(Uinterp)
+        nodes_x.append(xdata)
+        nodes_y.append(ydata)
+
+    return np.array(xinterp[0, :], dtype=np.float64), np.array(yinterp[:, 0], dtype=np.float64), \
+           np.array(potentials, dtype=np.float64), (np.concatenate(nodes_x), np.concatenate(nodes_y))
+
+def equidistribute(x, density, N):
+    """
+    Place N points between x[0] and x[-1] such that the local spacing is inversely proportional to density.
+    :param x: 1D array of coordinates at which density is given
+    :param density: 1D array of positive point densities (arbitrary normalization)
+    :param N: Number of points
+    :return: 1D array of N increasing coordinates, including both end points
+    """
+    cumulative = np.concatenate(([0], np.cumsum(0.5 * (density[1:] + density[:-1]) * np.diff(x))))
+    return np.interp(np.linspace(0, cumulative[-1], N), cumulative, x)
+
+def adaptive_axes(x, y, U, nodes, N_points, refine_around=None, refine_factor=4., fem_weight=0.5,
+                  minimum_density=0.1):
+    """
+    Nonuniform x and y axes that are refined where the potentials are curved, where the FEM mesh is fine and around
+    the electrons. Along each axis the point density is proportional to a monitor function, see equidistribute:
+    - the square root of the largest second derivative of any (normalized) electrode potential, for which the error of
+      the interpolation is the same in every interval,
+    - the density of the nodes of the FEM meshes. The FEM solver refines its mesh where its error estimate is large,
+      and there is nothing to gain from sampling much finer than the mesh,
+    - refine_factor times more points in the region occupied by the electrons in refine_around.
+    :param x: 1D array of x-coordinates of the pilot grid in um
+    :param y: 1D array of y-coordinates of the pilot grid in um
+    :param U: 3D array of shape (electrodes, len(y), len(x)) with the potentials on the pilot grid
+    :param nodes: Tuple (x, y) of the FEM node coordinates in um, see interpolate_dsp_files
+    :param N_points: Tuple (N_x, N_y) with the number of points of the new axes
+    :param refine_around: Tuple (x, y) of electron coordinates in um, or None
+    :param refine_factor: Increase of the point density in the region of the electrons
+    :param fem_weight: Relative weight of the FEM node density and the curvature in the monitor function (0 to 1)
+    :param minimum_density: Lowest point density relative to the average, such that no region is left empty
+    :return: x, y. New 1D axes in um.
+    """
+    U = U / np.maximum(np.ptp(U, axis=(1, 2)), 1E-30)[:, np.newaxis, np.newaxis]
+    axes = list()
+    for axis, coordinates, N in [(2, x, N_points[0]), (1, y, N_points[1])]:
+        curvature = np.abs(np.gradient(np.gradient(U, coordinates, axis=axis), coordinates, axis=axis))
+        monitor = np.sqrt(np.max(np.moveaxis(curvature, axis, 0).reshape(len(coordinates), -1), axis=1))
+        monitor /= max(np.mean(monitor), 1E-30)
+
+        # Density of the FEM nodes, projected onto this axis
+        edges = np.concatenate(([coordinates[0]], 0.5 * (coordinates[1:] + coordinates[:-1]), [coordinates[-1]]))
+        counts = np.histogram(nodes[0] if axis == 2 else nodes[1], bins=edges)[0] / np.diff(edges)
+        monitor = (1 - fem_weight) * monitor + fem_weight * counts / max(np.mean(counts), 1E-30)
+
+        if refine_around is not None:
+            electrons = refine_around[0] if axis == 2 else refine_around[1]
+            # Pad the region by the typical electron spacing
+            pad = np.ptp(electrons) / max(np.sqrt(len(electrons)), 1) + np.mean(np.diff(coordinates))
+            region = np.logical_and(coordinates >= np.min(electrons) - pad, coordinates <= np.max(electrons) + pad)
+            monitor[region] *= refine_factor
+
+        monitor = np.maximum(monitor, minimum_density * np.mean(monitor))
+        axes.append(equidistribute(coordinates, monitor, N))
+
+    print("Adaptive grid: %d x %d points, spacing %.3f to %.3f um in x and %.3f to %.3f um in y"
+          % (len(axes[0]), len(axes[1]), np.min(np.diff(axes[0])), np.max(np.diff(axes[0])),
+             np.min(np.diff(axes[1])), np.max(np.diff(axes[1]))))
+    return axes[0], axes[1]
+
+def smooth_along_axis(U, width, axis, method='box'):
+    """
+    Smooth U along one axis with a box (moving average) or Gaussian filter. The data is extended with its edge values,
+    such that the filtered array has the same shape as U.
+    :param U: Array to smooth
+    :param width: Width of the filter in samples. For the Gaussian filter this is the full width at half maximum.
+    :param axis: Axis along which to smooth
+    :param method: 'box' for a moving average computed with a cumulative sum, 'gaussian' for an FFT convolution
+    :return: Smoothed array
+    """
+    half_width = int(width) // 2
+    if method == 'box':
+        # Moving average over 2 * half_width + 1 samples from the difference of a cumulative sum
+        pad_width = [(0, 0)] * U.ndim
+        pad_width[axis] = (half_width + 1, half_width)
+        padded = np.pad(U, pad_width, mode='edge')
+        cumulative = np.cumsum(padded, axis=axis)
+        n = 2 * half_width + 1
+        upper = np.take(cumulative, np.arange(n, cumulative.shape[axis]), axis=axis)
+        lower = np.take(cumulative, np.arange(0, cumulative.shape[axis] - n), axis=axis)
+        return (upper - lower) / n
+    elif method == 'gaussian':
+        sigma = width / (2 * np.sqrt(2 * np.log(2)))
+        kernel_half_width = int(np.ceil(4 * sigma))
+        kernel = np.exp(-0.5 * (np.arange(-kernel_half_width, kernel_half_width + 1) / sigma) ** 2)
+        kernel_shape = [1] * U.ndim
+        kernel_shape[axis] = len(kernel)
+        pad_width = [(0, 0)] * U.ndim
+        pad_width[axis] = (kernel_half_width, kernel_half_width)
+        padded = np.pad(U, pad_width, mode='edge')
+        return fftconvolve(padded, np.reshape(kernel / np.sum(kernel), kernel_shape), mode='valid', axes=axis)
+    else:
+        raise ValueError("Unknown smoothing method %s. Use 'box' or 'gaussian'." % method)
+
+def smooth_potentials(x, y, U, smoothen_xy, method='box'):
+    """
+    Smooth the potentials of all electrodes with separable filters along x and y. The cost does not depend on the
+    width of the filters.
+    :param x: 1D array of x-coordinates in um
+    :param y: 1D array of y-coordinates in um
+    :param U: 3D array of shape (electrodes, len(y), len(x))
+    :param smoothen_xy: Tuple with the width of the filter in the x and y direction in m
+    :param method: 'box' or 'gaussian', see smooth_along_axis
+    :return: x, y and the smoothed U
+    """
+    width_x = smoothen_xy[0] / (np.diff(x)[0] * 1E-6)
+    width_y = smoothen_xy[1] / (np.diff(y)[0] * 1E-6)
+
+    if width_x < 2:
+        print("Smoothing has no effect in x-direction, please increase sampling in x direction.")
+    else:
+        U = smooth_along_axis(U, width_x, axis=2, method=method)
+    if width_y < 2:
+        print("Smoothing has no effect in y-direction, please increase sampling in y direction.")
+    else:
+        U = smooth_along_axis(U, width_y, axis=1, method=method)
+    return x, y, U
+
+def mirror_potentials(x, y, U):
+    """
+    Mirror the potentials of all electrodes around y = 0.
+    :param x: 1D array of x-coordinates
+    :param y: 1D array of y-coordinates
+    :param U: 3D array of shape (electrodes, len(y), len(x))
+    :return: x, mirrored y and U
+    """
+    return x, np.concatenate((y, -y[::-1])), np.concatenate((U, U[:, ::-1, :]), axis=1)
+
+def extend_potentials(x, y, U, reference):
+    """
+    Draw an imaginary line at the maximum of the potential of electrode U[reference] along y = 0, and substitute the
+    data of all electrodes to the right of that line with their value on the line.
+    :return: x, y, extended U and the index of the line in x
+    """
+    left_idx = np.argmax(U[reference, common.find_nearest(y, 0), :])
+    U_extended = U.copy()
+    U_extended[:, :, left_idx:] = U[:, :, left_idx:left_idx + 1]
+    return x, y, U_extended, left_idx
+
+def insert_potentials(x, y, U, reference, inserted_length):
+    """
+    Insert inserted_length of constant cross section at the maximum of the potential of electrode U[reference] along
+    y = 0, i.e. repeat the column of all electrodes at that point. The inserted columns have the local grid spacing.
+    :return: New x, y, the new U and the indices of the first and last inserted column in x
+    """
+    left_idx = np.argmax(U[reference, common.find_nearest(y, 0), :])
+    x_spacing = x[min(left_idx + 1, len(x) - 1)] - x[min(left_idx + 1, len(x) - 1) - 1]
+    new_indices = int(inserted_length / x_spacing)
+
+    repeats = np.ones(len(x), dtype=int)
+    repeats[left_idx] += new_indices
+    U_inserted = np.repeat(U, repeats, axis=2)
+    xs = np.concatenate((x[:left_idx + 1], x[left_idx] + x_spacing * np.arange(1, new_indices + 1),
+                         x[left_idx + 1:] + new_indices * x_spacing))
+    return xs, y, U_inserted, left_idx, left_idx + new_indices
+
 def load_data(data_path, xeval=None, yeval=None, mirror_y=True, do_plot=True, extend_resonator=True,
-              inserted_trap_length=0, inserted_res_length=40, smoothen_xy=None):
+              inserted_trap_length=0, inserted_res_length=40, smoothen_xy=None, smoothing_method='box', cache=None,
+              adaptive_points=None, refine_around=None, refine_factor=4.):
     """
     Takes in the following file names: "Resonator.dsp", "Trap.dsp", "ResonatorGuard.dsp", "CenterGuard.dsp" and
     "TrapGuard.dsp" in path "data_path" and loads the data into a dictionary output.
+    The result of every stage (interpolation, adaptive grid, smoothing, mirroring, extension or insertion) is kept in
+    memory, such that calling load_data again with e.g. only a different inserted length does not interpolate the data
+    again.
     :param data_path: Data path that contains the simulation files
     :param xeval: a 1D array. Interpolate the potential data for these x-points. Units: um
     :param yeval: a 1D array. Interpolate the potential data for these y-points. Units: um
@@ -1073,15 +2287,22 @@ def load_data(data_path, xeval=None, yeval=None, mirror_y=True, do_plot=True, ex
     :param inserted_res_length:
     :param smoothen_xy: Smooth the raw data according to a window in the x and y direction window = (x,y).
     The program will calculate the window size for the moving average filter in each direction according to (x, y).
+    :param smoothing_method: 'box' for a moving average, or 'gaussian' for a Gaussian filter with a full width at half
+    maximum of smoothen_xy. See smooth_potentials.
+    :param cache: SolutionCache instance. If given, the interpolated data is also stored on disk.
+    :param adaptive_points: Tuple (N_x, N_y). If given, the data on the grid xeval, yeval is only used to construct a
+    nonuniform grid with N_x by N_y points that is refined where the potentials are curved, where the FEM mesh is fine
+    and around refine_around (see adaptive_axes), and the data is interpolated again on this grid. The splines of the
+    solvers accept nonuniform grids. Can not be combined with smoothen_xy.
+    :param refine_around: Tuple (x, y) of 1D arrays with electron coordinates in um around which the grid is refined
+    :param refine_factor: Increase of the point density around refine_around
     :return: x, y, output = [{'name' : ..., 'V' : ..., 'x' : ..., 'y' : ...}, ...]
     """
     datafiles = ["Resonator.dsp", "Trap.dsp", "ResonatorGuard.dsp", #"CenterGuard.dsp",
                  "TrapGuard.dsp"]
 
-    output = list()
     names = ['resonator', 'trap', 'resonatorguard', #'centerguard',
              'trapguard']
-    idx = 1
 
     insert_resonator = True if inserted_res_length > 0 else False
     insert_trap = True if inserted_trap_length > 0 else False
@@ -1089,158 +2310,61 @@ def load_data(data_path, xeval=None, yeval=None, mirror_y=True, do_plot=True, ex
         names = ['trap', 'resonator', 'resonatorguard', 'trapguard']
         datafiles = ["Trap.dsp", "Resonator.dsp", "ResonatorGuard.dsp", "TrapGuard.dsp"]
 
-
-    # Iterate over the data files
-    for name, datafile in zip(names, datafiles):
-        elements, nodes, elem_solution, bounding_box = load_dsp(os.path.join(data_path, datafile))
-        xdata, ydata, Udata = interpolate_slow.prepare_for_interpolation(elements, nodes, elem_solution)
-        xcenter = np.mean(bounding_box[0:2])
-        yedge = bounding_box[3]
-        xdata -= xcenter
-        ydata -= yedge
-
-        if xeval is None:
-            xeval = np.linspace(np.min(xdata), np.max(xdata), 101)
-        if yeval is None:
-            yeval = np.linspace(np.min(ydata), np.max(ydata), 101)
-
-        xinterp, yinterp, Uinterp = interpolate_slow.evaluate_on_grid(xdata, ydata, Udata, xeval=xeval, yeval=yeval,
-                                                                      clim=(0.0, 1.0), plot_axes='xy',
-                                                                      cmap=plt.cm.Spectral_r, plot_mesh=False,
-                                                                      plot_data=False)
-
+    # The source files are identified by their name, size and modification time
+    sources = list()
+    for datafile in datafiles:
+        status = os.stat(os.path.join(data_path, datafile))
+        sources.append((os.path.abspath(os.path.join(data_path, datafile)), status.st_size, status.st_mtime))
+
+    def interpolate(key, *args):
+        result = None if cache is None else cache.get(key)
+        if result is None:
+            result = interpolate_dsp_files(*args)
+            if cache is not None:
+                cache.put(key, result)
+        return result
+
+    # The stage also returns the FEM mesh nodes. The tag keeps entries written without them from being unpacked here.
+    key = fingerprint('interpolate', 'nodes', sources, xeval, yeval)
+    x, y, U, nodes = cached_stage(key, interpolate, key, data_path, datafiles, xeval, yeval)
+
+    if adaptive_points is not None:
         if smoothen_xy is not None:
-            dx = np.diff(xeval)[0] * 1E-6
-            dy = np.diff(yeval)[0] * 1E-6
-            Nrows = np.int(smoothen_xy[0]/dx)
-            Ncols = np.int(smoothen_xy[1]/dy)
-
-            if Nrows > 1 or Ncols > 1:
-                Uinterp = common.moving_average_2d(Uinterp, (Nrows, Ncols))
-            elif Nrows <= 1:
-                print("Smoothing has no effect in y-direction, please increase sampling in y direction.")
-            elif Ncols <= 1:
-                print("Smoothing has no effect in x-direction, please increase sampling in x direction.")
-
-        if mirror_y:
-            # Mirror around the y-axis
-            ysize, xsize = np.shape(Uinterp)
-            Uinterp_symmetric = np.zeros((2 * ysize, xsize))
-            Uinterp_symmetric[:ysize, :] = Uinterp
-            Uinterp_symmetric[ysize:, :] = Uinterp[::-1, :]
-
-            y_symmetric = np.zeros((2 * ysize, xsize))
-            y_symmetric[:ysize, :] = yinterp
-            y_symmetric[ysize:, :] = -yinterp[::-1, :]
-
-            x_symmetric = np.zeros((2 * ysize, xsize))
-            x_symmetric[:ysize, :] = xinterp
-            x_symmetric[ysize:, :] = xinterp
-
-            #yeval = np.append(yeval, -yeval[::-1])
-        else:
-            x_symmetric = xinterp
-            y_symmetric = yinterp
-            Uinterp_symmetric = Uinterp
-
-        if extend_resonator:
-            # Draw an imaginary line at the minimum of the resonator potential and
-            # substitute the data to the right of that line with the minimum value
-            if name == "resonator":
-                res_left_idx = np.argmax(Uinterp_symmetric[common.find_nearest(y_symmetric[:, 0], 0), :])
-                res_left_x = x_symmetric[0, res_left_idx]
-                res_right_x = x_symmetric[0, -1]
-                # Note: res_left_x and res_right_x are in units of um
-                print("Resonator data was replaced from x = %.2f um to x = %.2f um" % (res_left_x, res_right_x))
-
-                for i in range(res_left_idx, np.shape(Uinterp_symmetric)[1]):
-                    Uinterp_symmetric[:, i] = Uinterp_symmetric[:, res_left_idx]
-            else:
-                # Also change all the other potential data
-                for i in range(res_left_idx, np.shape(Uinterp_symmetric)[1]):
-                    Uinterp_symmetric[:, i] = Uinterp_symmetric[:, res_left_idx]
-
-        elif insert_resonator:
-            # Insertion is done at the minimum of the potential.
-            inserted_length = inserted_res_length
-            x_spacing = x_symmetric[0, 1] - x_symmetric[0, 0]
-            new_indices = np.int(inserted_length/x_spacing)
-            old_shape = np.shape(Uinterp_symmetric)
-            new_shape = (old_shape[0], old_shape[1] + new_indices)
-
-            #print("We start with a %d by %d array and extend it to a %d by %d array"%(old_shape[0], old_shape[1], new_shape[0], new_shape[1]))
-
-            Uinterp_symmetric_new = np.zeros(new_shape)
-
-            if name == "resonator":
-                res_left_idx = np.argmax(Uinterp_symmetric[common.find_nearest(y_symmetric[:, 0], 0), :])
-                res_left_x = x_symmetric[0, res_left_idx]
-                res_right_idx = res_left_idx + new_indices
-                res_right_x = res_left_x + new_indices * x_spacing
-
-                # Note: res_left_x and res_right_x are in units of um
-                print("Resonator data was inserted from x = %.2f um to x = %.2f um" % (res_left_x, res_right_x))
-
-            for i in range(res_left_idx, res_right_idx):
-                Uinterp_symmetric_new[:, i] = Uinterp_symmetric[:, res_left_idx]
-
-            Uinterp_symmetric_new[:, :res_left_idx] = Uinterp_symmetric[:, :res_left_idx]
-            Uinterp_symmetric_new[:, res_right_idx:] = Uinterp_symmetric[:, res_left_idx:]
-            xs = np.arange(np.min(x_symmetric), np.max(x_symmetric) + (new_indices) * x_spacing, x_spacing)
-
-            if len(xs) != new_shape[1]:
-                print("xs shapes are not correct: %d vs. %d"%(len(xs), new_shape[1]))
-
-            ys = np.linspace(np.min(y_symmetric), np.max(y_symmetric), new_shape[0])
-
-            if len(ys) != new_shape[0]:
-                print("ys shapes are not correct: %d vs. %d" % (len(ys), new_shape[0]))
-
-            x_symmetric_new, y_symmetric_new = np.meshgrid(xs, ys)
-            x_symmetric, y_symmetric = x_symmetric_new, y_symmetric_new
-            Uinterp_symmetric = Uinterp_symmetric_new
-
-        elif insert_trap:
-            # Insertion is done at the minimum of the potential.
-            inserted_length = inserted_trap_length
-            x_spacing = x_symmetric[0, 1] - x_symmetric[0, 0]
-            new_indices = np.int(inserted_length / x_spacing)
-            old_shape = np.shape(Uinterp_symmetric)
-            new_shape = (old_shape[0], old_shape[1] + new_indices)
-
-            # print("We start with a %d by %d array and extend it to a %d by %d array"%(old_shape[0], old_shape[1],
-            # new_shape[0], new_shape[1]))
-
-            Uinterp_symmetric_new = np.zeros(new_shape)
-
-            if name == "trap":
-                trap_left_idx = np.argmax(Uinterp_symmetric[common.find_nearest(y_symmetric[:, 0], 0), :])
-                trap_left_x = x_symmetric[0, trap_left_idx]
-                trap_right_idx = trap_left_idx + new_indices
-                trap_right_x = trap_left_x + new_indices * x_spacing
-
-                # Note: res_left_x and res_right_x are in units of um
-                print("Trap data was inserted from x = %.2f um to x = %.2f um" % (trap_left_x, trap_right_x))
-
-            for i in range(trap_left_idx, trap_right_idx):
-                Uinterp_symmetric_new[:, i] = Uinterp_symmetric[:, trap_left_idx]
-
-            Uinterp_symmetric_new[:, :trap_left_idx] = Uinterp_symmetric[:, :trap_left_idx]
-            Uinterp_symmetric_new[:, trap_right_idx:] = Uinterp_symmetric[:, trap_left_idx:]
-            xs = np.arange(np.min(x_symmetric), np.max(x_symmetric) + (new_indices) * x_spacing, x_spacing)
-
-            if len(xs) != new_shape[1]:
-                print("xs shapes are not correct: %d vs. %d" % (len(xs), new_shape[1]))
-
-            ys = np.linspace(np.min(y_symmetric), np.max(y_symmetric), new_shape[0])
-
-            if len(ys) != new_shape[0]:
-                print("ys shapes are not correct: %d vs. %d" % (len(ys), new_shape[0]))
-
-            x_symmetric_new, y_symmetric_new = np.meshgrid(xs, ys)
-            x_symmetric, y_symmetric = x_symmetric_new, y_symmetric_new
-            Uinterp_symmetric = Uinterp_symmetric_new
-
+            raise ValueError("Smoothing requires a uniform grid and can not be combined with adaptive_points.")
+        key = fingerprint(key, 'adapt', adaptive_points, refine_around, refine_factor)
+        xs, ys = cached_stage(key, adaptive_axes, x, y, U, nodes, adaptive_points, refine_around, refine_factor)
+        key = fingerprint('interpolate', 'nodes', sources, xs, ys)
+        x, y, U, nodes = cached_stage(key, interpolate, key, data_path, datafiles, xs, ys)
+
+    if smoothen_xy is not None:
+        key = fingerprint(key, 'smooth', smoothen_xy, smoothing_method)
+        x, y, U = cached_stage(key, smooth_potentials, x, y, U, smoothen_xy, smoothing_method)
+
+    if mirror_y:
+        key = fingerprint(key, 'mirror')
+        x, y, U = cached_stage(key, mirror_potentials, x, y, U)
+
+    if extend_resonator:
+        # Draw an imaginary line at the minimum of the resonator potential and
+        # substitute the data to the right of that line with the minimum value
+        key = fingerprint(key, 'extend')
+        x, y, U, res_left_idx = cached_stage(key, extend_potentials, x, y, U, names.index('resonator'))
+        # Note: res_left_x and res_right_x are in units of um
+        print("Resonator data was replaced from x = %.2f um to x = %.2f um" % (x[res_left_idx], x[-1]))
+
+    elif insert_resonator or insert_trap:
+        # Insertion is done at the minimum of the potential.
+        electrode = 'resonator' if insert_resonator else 'trap'
+        inserted_length = inserted_res_length if insert_resonator else inserted_trap_length
+        key = fingerprint(key, 'insert', electrode, inserted_length)
+        x, y, U, left_idx, right_idx = cached_stage(key, insert_potentials, x, y, U, names.index(electrode),
+                                                    inserted_length)
+        print("%s data was inserted from x = %.2f um to x = %.2f um" % (electrode.capitalize(), x[left_idx],
+                                                                      x[right_idx]))
+
+    x_symmetric, y_symmetric = np.meshgrid(x, y)
+    output = list()
+    for name, Uinterp_symmetric in zip(names, U):
         if do_plot:
             plt.figure(figsize=(8., 2.))
             common.configure_axes(12)
@@ -1256,13 +2380,26 @@ def load_data(data_path, xeval=None, yeval=None, mirror_y=True, do_plot=True, ex
                        'x': np.array(x_symmetric.T, dtype=np.float64),
                        'y': np.array(y_symmetric.T, dtype=np.float64)})
 
-        idx += 1
-
     if insert_trap:
         output[0], output[1] = output[1], output[0]
 
     return x_symmetric*1E-6, y_symmetric*1E-6, output
 
+def get_dxf_polylines(filename, offset=(0E-6, 0E-6)):
+    """
+    Read the polylines from a dxf file
+    :param filename: dxf file name.
+    :param offset: Tuple (x, y) that is added to all points
+    :return: List of (x, y) arrays, one for each polyline
+    """
+    dxf = dxfgrabber.readfile(filename)
+    polylines = list()
+    for o in dxf.entities:
+        if o.dxftype == "LWPOLYLINE":
+            r = np.array(o.points)
+            polylines.append((r[:,0] + offset[0], r[:,1] + offset[1]))
+    return polylines
+
 def draw_from_dxf(filename, offset=(0E-6, 0E-6), **plot_options):
     """
     Draws polylines from a dxf file into a graph
@@ -1270,14 +2407,8 @@ def draw_from_dxf(filename, offset=(0E-6, 0E-6), **plot_options):
     :param plot_options: dictionary of plot attributes, e.g. {'color':'k'}
     :return: Nones
     """
-    dxf = dxfgrabber.readfile(filename)
-    output = [entity for entity in dxf.entities]
-    for o in output:
-        if o.dxftype == "LWPOLYLINE":
-            r = np.array(o.points)
-            x = r[:,0] + offset[0]
-            y = r[:,1] + offset[1]
-            plt.plot(x, y, **plot_options)
+    for x, y in get_dxf_polylines(filename, offset=offset):
+        plt.plot(x, y, **plot_options)
 
 def factors(n):
     """
@@ -1345,6 +2476,180 @@ def get_rectangular_initial_condition(N_electrons, N_rows=None, N_cols=None,
 
     return xy2r(xinit, yinit)
 
+def project_onto_simplex(v, total):
+    """
+    Euclidean projection of v onto {n : n >= 0, sum(n) = total}
+    :param v: 1D array
+    :param total: Sum of the projected vector
+    :return: 1D array of the same length as v
+    """
+    u = np.sort(v)[::-1]
+    cumulative = np.cumsum(u) - total
+    rho = np.nonzero(u - cumulative / np.arange(1, len(u) + 1) > 0)[0][-1]
+    return np.maximum(v - cumulative[rho] / (rho + 1.), 0)
+
+def halton_sequence(N, base):
+    """
+    First N points of the van der Corput sequence in the given (prime) base, a low-discrepancy sequence in [0, 1).
+    Pairs of sequences with different bases form the 2D Halton sequence.
+    :param N: Number of points
+    :param base: Prime number
+    :return: 1D array of length N
+    """
+    sequence = np.zeros(N)
+    index = np.arange(1, N + 1)
+    fraction = 1.
+    while np.any(index > 0):
+        fraction /= base
+        sequence += fraction * (index % base)
+        index //= base
+    return sequence
+
+def get_hexagonal_lattice_in_unit_square(N, aspect=1.):
+    """
+    N points of a triangular lattice that fill the unit square. The lattice spacing is chosen such that the lattice
+    has at least N points in the square. Surplus points are removed evenly spread over the lattice.
+    :param N: Number of points
+    :param aspect: Ratio of the lattice spacing in the v direction to that in the u direction (1 for a regular lattice)
+    :return: u, v: 1D arrays of length N
+    """
+    spacing = np.sqrt(2 / (np.sqrt(3) * N * aspect))
+    while True:
+        rows = np.arange(spacing * np.sqrt(3) / 2. * aspect / 2., 1, spacing * np.sqrt(3) / 2. * aspect)
+        u, v = list(), list()
+        for k, row in enumerate(rows):
+            columns = np.arange(spacing / 2. * (1 + k % 2) / 2., 1, spacing)
+            u.append(columns)
+            v.append(row * np.ones(len(columns)))
+        u, v = np.concatenate(u), np.concatenate(v)
+        if len(u) >= N:
+            break
+        spacing *= 0.99
+    keep = np.round(np.linspace(0, len(u) - 1, N)).astype(int)
+    return u[keep], v[keep]
+
+def get_continuum_density(N_electrons, grid_data_x, grid_data_y, potential_data, N_grid=64, screening_length=None,
+                          N_iterations=500, tolerance=1E-6, refine=True):
+    """
+    Continuum (Thomas-Fermi-like) model of the electron density. Minimizes the energy of a charge density n on a
+    coarse grid, E[n] = sum_i n_i V_i + 1/2 sum_ij n_i K_ij n_j with K the Coulomb interaction between the grid cells,
+    subject to n >= 0 and sum(n) = N_electrons. The convolution with K is done by FFT and the minimization by
+    accelerated projected gradient descent.
+    :param N_electrons: Number of electrons
+    :param grid_data_x: 1D array of x-data, as for TrapAreaSolver
+    :param grid_data_y: 1D array of y-data, as for TrapAreaSolver
+    :param potential_data: Energy landscape - e V_ext in eV, with shape (len(grid_data_x), len(grid_data_y))
+    :param N_grid: Number of grid cells in each direction for the continuum model
+    :param screening_length: Screening length in m for the interaction exp(-R/screening_length)/R. None for Coulomb.
+    :param N_iterations: Maximum number of iterations
+    :param tolerance: Stop when the density changes less than tolerance * N_electrons in one iteration
+    :param refine: Solve again on a grid that only covers the region occupied by electrons
+    :return: x (cell centers), y (cell centers), n (electrons per cell, shape (len(x), len(y)))
+    """
+    qe, eps0 = 1.602E-19, 8.85E-12
+    xbounds, ybounds = (np.min(grid_data_x), np.max(grid_data_x)), (np.min(grid_data_y), np.max(grid_data_y))
+    x = np.linspace(xbounds[0], xbounds[1], N_grid + 1)
+    y = np.linspace(ybounds[0], ybounds[1], N_grid + 1)
+    x, y = (x[1:] + x[:-1]) / 2., (y[1:] + y[:-1]) / 2.
+    dx, dy = x[1] - x[0], y[1] - y[0]
+    V = RectBivariateSpline(grid_data_x, grid_data_y, potential_data, kx=1, ky=1)(x, y)
+
+    # Interaction between cells in eV. The self-interaction is the average of 1/R over a rectangular cell.
+    X, Y = np.meshgrid(np.arange(-N_grid + 1, N_grid) * dx, np.arange(-N_grid + 1, N_grid) * dy, indexing='ij')
+    R = np.sqrt(X ** 2 + Y ** 2)
+    R[N_grid - 1, N_grid - 1] = 1
+    kernel = 1 / R
+    d = np.sqrt(dx ** 2 + dy ** 2)
+    kernel[N_grid - 1, N_grid - 1] = 2 / (dx * dy) * (dx * np.log((dy + d) / dx) + dy * np.log((dx + d) / dy))
+    if screening_length is not None:
+        kernel *= np.exp(-R / screening_length)
+    kernel *= qe / (4 * np.pi * eps0)
+
+    def gradient(n):
+        return V + fftconvolve(n, kernel, mode='valid')
+
+    # Largest eigenvalue of the kernel by power iteration, which sets the step size
+    v = np.ones(V.shape)
+    for k in range(20):
+        v = fftconvolve(v, kernel, mode='valid')
+        L = np.linalg.norm(v)
+        v /= L
+
+    n = project_onto_simplex(-V.ravel(), N_electrons).reshape(V.shape)
+    n_previous, z, t = n, n, 1.
+    for k in range(N_iterations):
+        n = project_onto_simplex((z - gradient(z) / L).ravel(), N_electrons).reshape(V.shape)
+        t_next = (1 + np.sqrt(1 + 4 * t ** 2)) / 2.
+        z = n + (t - 1) / t_next * (n - n_previous)
+        change = np.sum(np.abs(n - n_previous))
+        n_previous, t = n, t_next
+        if change < tolerance * N_electrons:
+            break
+
+    if refine:
+        # Zoom in on the occupied cells, keeping one empty cell on each side
+        occupied_x, occupied_y = np.where(np.sum(n, axis=1) > 0)[0], np.where(np.sum(n, axis=0) > 0)[0]
+        x_min, x_max = x[max(occupied_x[0] - 1, 0)] - dx / 2., x[min(occupied_x[-1] + 1, N_grid - 1)] + dx / 2.
+        y_min, y_max = y[max(occupied_y[0] - 1, 0)] - dy / 2., y[min(occupied_y[-1] + 1, N_grid - 1)] + dy / 2.
+        if (x_max - x_min) < 0.75 * (xbounds[1] - xbounds[0]) or (y_max - y_min) < 0.75 * (ybounds[1] - ybounds[0]):
+            keep_x = np.logical_and(grid_data_x >= x_min - dx, grid_data_x <= x_max + dx)
+            keep_y = np.logical_and(grid_data_y >= y_min - dy, grid_data_y <= y_max + dy)
+            return get_continuum_density(N_electrons, grid_data_x[keep_x], grid_data_y[keep_y],
+                                         potential_data[keep_x][:, keep_y], N_grid=N_grid,
+                                         screening_length=screening_length, N_iterations=N_iterations,
+                                         tolerance=tolerance, refine=False)
+
+    return x, y, n
+
+def get_continuum_initial_condition(N_electrons, grid_data_x, grid_data_y, potential_data, N_grid=64,
+                                    screening_length=None, N_iterations=500, lattice='hexagonal'):
+    """
+    Initial condition that follows the equilibrium density of a continuum model of the electrons, see
+    get_continuum_density. The electron positions are obtained by mapping points that uniformly fill the unit square
+    through the inverse cumulative distribution of the density. Since the density is already close to that of the
+    discrete system, the minimizer mostly has to order the electrons locally instead of redistributing them.
+    :param N_electrons: Number of electrons
+    :param grid_data_x: 1D array of x-data, as for TrapAreaSolver
+    :param grid_data_y: 1D array of y-data, as for TrapAreaSolver
+    :param potential_data: Energy landscape - e V_ext in eV, with shape (len(grid_data_x), len(grid_data_y))
+    :param N_grid: Number of grid cells in each direction for the continuum model
+    :param screening_length: Screening length in m for the interaction exp(-R/screening_length)/R. None for Coulomb.
+    :param N_iterations: Maximum number of iterations for the continuum model
+    :param lattice: 'hexagonal' for a triangular lattice in the unit square, or 'halton' for the 2D Halton sequence
+    (bases 2 and 3)
+    :return: Electron configuration where r = [x0, y0, x1, y1, ...]
+    """
+    x, y, n = get_continuum_density(N_electrons, grid_data_x, grid_data_y, potential_data, N_grid=N_grid,
+                                    screening_length=screening_length, N_iterations=N_iterations)
+    dx, dy = x[1] - x[0], y[1] - y[0]
+    if lattice == 'halton':
+        u, v = halton_sequence(N_electrons, 2), halton_sequence(N_electrons, 3)
+    else:
+        # The map from the unit square stretches u and v by the width of the density in x and y. Compensate with the
+        # aspect ratio of the lattice, such that it is close to hexagonal after the mapping.
+        weights = n / np.sum(n)
+        width_x = np.sqrt(np.sum(weights * (x[:, np.newaxis] - np.sum(weights * x[:, np.newaxis])) ** 2))
+        width_y = np.sqrt(np.sum(weights * (y[np.newaxis, :] - np.sum(weights * y[np.newaxis, :])) ** 2))
+        u, v = get_hexagonal_lattice_in_unit_square(N_electrons, aspect=width_y / width_x)
+
+    # Invert the marginal distribution in x, then the conditional distribution in y, with linear interpolation
+    # of the cumulative distributions within each cell
+    marginal = np.sum(n, axis=1)
+    cdf_x = np.concatenate(([0], np.cumsum(marginal))) / np.sum(marginal)
+    xi = np.interp(u, cdf_x, np.append(x - dx / 2., x[-1] + dx / 2.))
+    column = np.clip(((xi - x[0] + dx / 2.) // dx).astype(int), 0, len(x) - 1)
+    # At the edge of a cell the column may have no density at all. Use the nearest column with density instead.
+    occupied = np.flatnonzero(marginal > 0)
+    column = occupied[np.argmin(np.abs(column[:, np.newaxis] - occupied[np.newaxis, :]), axis=1)]
+
+    yi = np.zeros(N_electrons)
+    for c in np.unique(column):
+        cdf_y = np.concatenate(([0], np.cumsum(n[c, :])))
+        cdf_y /= cdf_y[-1]
+        yi[column == c] = np.interp(v[column == c], cdf_y, np.append(y - dy / 2., y[-1] + dy / 2.))
+
+    return xy2r(xi, yi)
+
 def check_unbounded_electrons(ri, xdomain, ydomain):
     """
     This helper function checks if any electrons have escaped the bounds of the simulation box defined by xdomain and
@@ -1493,6 +2798,107 @@ def draw_electrode_outline(filename, x0=None, y0=None, **plot_kwargs):
             plt.plot(x, y, **plot_kwargs)
             plt.plot(mirrored_x, mirrored_y, **plot_kwargs)
 
+def batch_interaction(dx, dy, pair_potential, order=1):
+    """
+    Interaction energy and its gradient for a batch of K configurations of N electrons.
+    :param dx: 3D array of shape (K, N, N) with xi - xj
+    :param dy: 3D array of shape (K, N, N) with yi - yj
+    :param pair_potential: pair_potential method of a solver
+    :param order: 0 for the energy only, 1 for energy and gradient
+    :return: (Vint,) or (Vint, dVint/dxi, dVint/dyi). Vint has shape (K,) (eV), the gradients have shape (K, N) (eV/m)
+    """
+    Rij = np.sqrt(dx ** 2 + dy ** 2)
+    diagonal = np.arange(Rij.shape[1])
+    # Any non-zero distance will do on the diagonal, these terms are removed below
+    Rij[:, diagonal, diagonal] = 1
+    terms = pair_potential(Rij, order=order)
+    for term in terms:
+        term[:, diagonal, diagonal] = 0
+
+    if order == 0:
+        return (0.5 * np.sum(terms[0], axis=(1, 2)),)
+    return 0.5 * np.sum(terms[0], axis=(1, 2)), np.sum(terms[1] * dx, axis=2), np.sum(terms[1] * dy, axis=2)
+
+def pair_hessian_blocks(dx, dy, Rij, dphi, d2phi):
+    """
+    2x2 Hessian blocks of a central pair potential phi(Rij) with respect to the separation (dx, dy).
+    :param dx: x-separation of each pair
+    :param dy: y-separation of each pair
+    :param Rij: distance of each pair
+    :param dphi: 1/R dphi/dR for each pair
+    :param d2phi: d2phi/dR2 for each pair
+    :return: Bxx, Bxy, Byy
+    """
+    a = (d2phi - dphi) / Rij ** 2
+    return a * dx ** 2 + dphi, a * dx * dy, a * dy ** 2 + dphi
+
+def assemble_hessian(external_hessian, pairs, blocks, sparse_output=False):
+    """
+    Assemble the 2N x 2N Hessian from the output of the solvers' hessian_terms.
+    :param external_hessian: (Vxx, Vxy, Vyy), each of length N
+    :param pairs: (i, j) electron indices of each pair
+    :param blocks: (Bxx, Bxy, Byy) Hessian blocks of each pair, see pair_hessian_blocks
+    :param sparse_output: Return a scipy.sparse.csr_matrix instead of a 2D array
+    :return: Hessian with ordering r = [x0, y0, x1, y1, ...]
+    """
+    Vxx, Vxy, Vyy = external_hessian
+    i, j = pairs
+    Bxx, Bxy, Byy = blocks
+    N = len(Vxx)
+
+    # Diagonal blocks: external potential and the sum over all interaction partners
+    Dxx = Vxx + np.bincount(i, Bxx, N) + np.bincount(j, Bxx, N)
+    Dxy = Vxy + np.bincount(i, Bxy, N) + np.bincount(j, Bxy, N)
+    Dyy = Vyy + np.bincount(i, Byy, N) + np.bincount(j, Byy, N)
+
+    n = np.arange(N)
+    rows = np.concatenate((2 * n, 2 * n, 2 * n + 1, 2 * n + 1,
+                           2 * i, 2 * i, 2 * i + 1, 2 * i + 1, 2 * j, 2 * j, 2 * j + 1, 2 * j + 1))
+    cols = np.concatenate((2 * n, 2 * n + 1, 2 * n, 2 * n + 1,
+                           2 * j, 2 * j + 1, 2 * j, 2 * j + 1, 2 * i, 2 * i + 1, 2 * i, 2 * i + 1))
+    data = np.concatenate((Dxx, Dxy, Dxy, Dyy, -Bxx, -Bxy, -Bxy, -Byy, -Bxx, -Bxy, -Bxy, -Byy))
+
+    if sparse_output:
+        return sparse.csr_matrix((data, (rows, cols)), shape=(2 * N, 2 * N))
+    else:
+        H = np.zeros((2 * N, 2 * N))
+        H[rows, cols] = data
+        return H
+
+def hessian_vector_product(external_hessian, pairs, blocks, p):
+    """
+    Product of the Hessian with a vector p, from the output of the solvers' hessian_terms. Equivalent to
+    assemble_hessian(...).dot(p), but without constructing the 2N x 2N matrix.
+    :param external_hessian: (Vxx, Vxy, Vyy), each of length N
+    :param pairs: (i, j) electron indices of each pair
+    :param blocks: (Bxx, Bxy, Byy) Hessian blocks of each pair, see pair_hessian_blocks
+    :param p: 1D array of length 2N with ordering [px0, py0, px1, py1, ...]
+    :return: 1D array of length 2N
+    """
+    Vxx, Vxy, Vyy = external_hessian
+    i, j = pairs
+    Bxx, Bxy, Byy = blocks
+    N = len(Vxx)
+    px, py = p[::2], p[1::2]
+
+    dpx, dpy = px[i] - px[j], py[i] - py[j]
+    fx = Bxx * dpx + Bxy * dpy
+    fy = Bxy * dpx + Byy * dpy
+
+    Hp = np.zeros(2 * N)
+    Hp[::2] = Vxx * px + Vxy * py + np.bincount(i, fx, N) - np.bincount(j, fx, N)
+    Hp[1::2] = Vxy * px + Vyy * py + np.bincount(i, fy, N) - np.bincount(j, fy, N)
+    return Hp
+
+def hessian_to_normal_modes(H, qe=1.602E-19, m_e=9.11E-31):
+    """
+    Normal mode frequencies of electrons with Hessian H, evaluated at a minimum of the total energy.
+    :param H: 2N x 2N Hessian in eV/m**2
+    :return: Frequencies in Hz (sorted, unstable modes have negative frequencies), eigenvectors in the columns
+    """
+    evals, evecs = np.linalg.eigh(H)
+    return np.sign(evals) * np.sqrt(qe * np.abs(evals) / m_e) / (2 * np.pi), evecs
+
 def r2xy(r):
     """
     Reformat electron position array.
@@ -0,0 +1,187 @@
+"""
+Continuation of equilibrium electron configurations along a parameter path, such as a voltage sweep or a ladder of
+electron numbers. Each minimization is started from the minimum at the previous point of the path instead of a
+rectangular initial condition, which saves most of the iterations when the steps along the path are small.
+
+    def make_solver(voltages):
+        return TrapAreaSolver(x, y, -np.sum(voltages[:, np.newaxis, np.newaxis] * potentials, axis=0))
+
+    sweep = ContinuationSolver(make_solver).sweep(voltage_path, r0, hysteresis=True)
+"""
+import numpy as np
+from scipy.optimize import minimize
+from termcolor import cprint
+
+
+def insertion_energy(solver, r, xc, yc):
+    """
+    Energy required to add an electron at the candidate positions (xc, yc) to the configuration r, i.e. the external
+    potential plus the interaction with all electrons in r. At the positions of the electrons this is the chemical
+    potential of calculate_mu.
+    :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+    :param r: Electron positions r = [x0, y0, x1, y1, ...]
+    :param xc: 1D array of candidate x-coordinates
+    :param yc: 1D array of candidate y-coordinates
+    :return: 1D array of energies in eV
+    """
+    xc, yc = np.asarray(xc, dtype=np.float64), np.asarray(yc, dtype=np.float64)
+    V = solver.V(xc, yc)
+    if hasattr(solver, 'background_potential'):
+        V = V + solver.background_potential(xc, yc, order=0)[0]
+
+    dx = xc[:, np.newaxis] - r[np.newaxis, ::2]
+    dy = yc[:, np.newaxis] - r[np.newaxis, 1::2]
+    if hasattr(solver, 'box_y_length'):
+        dy -= solver.box_y_length * np.round(dy / solver.box_y_length)
+    Rij = np.maximum(np.sqrt(dx ** 2 + dy ** 2), 1E-15)
+    return V + np.sum(solver.pair_potential(Rij, order=0)[0], axis=1)
+
+
+def grid_extent(solver):
+    """
+    Region in which the potential of the solver is defined.
+    :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+    :return: ((xmin, xmax), (ymin, ymax)) in m. For the ResonatorSolver the y-range is one period.
+    """
+    if solver.interpolator is None:
+        # TrapAreaSolver with a reduced model
+        return solver.evaluator.domain
+    knots = solver.interpolator.get_knots()
+    if hasattr(solver, 'box_y_length'):
+        return (knots[0], knots[-1]), (-solver.box_y_length / 2., solver.box_y_length / 2.)
+    return (knots[0][0], knots[0][-1]), (knots[1][0], knots[1][-1])
+
+
+class ContinuationSolver:
+
+    def __init__(self, make_solver, minimizer_dict=None, extrapolate=True, jump_threshold=0.1E-6,
+                 energy_tolerance=1E-6, cache=None, verbose=True):
+        """
+        Warm-started minimization along a path of parameters.
+        :param make_solver: Function that takes a point of the parameter path (e.g. a vector of electrode voltages) and
+        returns a TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance.
+        :param minimizer_dict: Dictionary with optimizer options, see scipy.optimize.minimize. The cost function is
+        solver.Vtotal_and_grad with jac=True, so a 'jac' in minimizer_dict is ignored.
+        :param extrapolate: Predict the next starting point by linear extrapolation along the path from the last two
+        minima. If False, start from the last minimum.
+        :param jump_threshold: An electron that ends up further than this (in m) from the predicted starting point
+        signals a structural jump.
+        :param energy_tolerance: Energy difference in eV above which a forward and backward sweep are on different
+        branches (hysteresis).
+        :param cache: SolutionCache instance. Minimizations that were done before, e.g. the first part of a sweep that
+        is now extended, are loaded from the cache instead of being repeated.
+        :param verbose: Print a message for every structural jump and hysteresis point
+        """
+        self.make_solver = make_solver
+        self.minimizer_dict = {'method' : 'CG'} if minimizer_dict is None else dict(minimizer_dict)
+        self.minimizer_dict.pop('jac', None)
+        self.extrapolate = extrapolate
+        self.jump_threshold = jump_threshold
+        self.energy_tolerance = energy_tolerance
+        self.cache = cache
+        self.verbose = verbose
+
+    def minimize(self, solver, r0):
+        if self.cache is not None:
+            return self.cache.minimize(solver.Vtotal_and_grad, r0, jac=True, **self.minimizer_dict)
+        return minimize(solver.Vtotal_and_grad, r0, jac=True, **self.minimizer_dict)
+
+    def follow(self, parameters, r0):
+        """
+        Minimize at each point of the path, starting from the (extrapolated) minimum at the previous point.
+        :param parameters: List of points of the parameter path, see make_solver
+        :param r0: Initial condition at parameters[0], or output of scipy.optimize.minimize at parameters[0]
+        :return: List of outputs of scipy.optimize.minimize, one for each point. Each result also contains the
+        'parameter', the largest electron 'displacement' from the starting point and whether there was a 'jump'.
+        """
+        if isinstance(r0, dict):
+            r0 = r0['x']
+        r_start = np.array(r0, dtype=np.float64)
+
+        results = list()
+        for k, parameter in enumerate(parameters):
+            if k >= 2 and self.extrapolate:
+                # Secant predictor along the path, scaled by the step size in parameter space
+                p0, p1, p2 = [np.asarray(p, dtype=np.float64) for p in parameters[k - 2:k + 1]]
+                step_ratio = np.linalg.norm(p2 - p1) / max(np.linalg.norm(p1 - p0), 1E-300)
+                r_start = results[-1]['x'] + step_ratio * (results[-1]['x'] - results[-2]['x'])
+            elif k >= 1:
+                r_start = results[-1]['x']
+
+            res = self.minimize(self.make_solver(parameter), r_start)
+            displacement = np.sqrt((res['x'][::2] - r_start[::2]) ** 2 + (res['x'][1::2] - r_start[1::2]) ** 2)
+            res['parameter'] = parameter
+            res['displacement'] = np.max(displacement)
+            res['jump'] = k > 0 and res['displacement'] > self.jump_threshold
+            if res['jump'] and self.verbose:
+                cprint("\tStructural jump at point %d: electrons moved up to %.3f um" % (k, res['displacement'] * 1E6),
+                       "yellow")
+            results.append(res)
+
+        return results
+
+    def sweep(self, parameters, r0, hysteresis=False):
+        """
+        Follow the equilibrium configuration along the parameter path, and optionally back.
+        :param parameters: List of points of the parameter path, see make_solver
+        :param r0: Initial condition at parameters[0], or output of scipy.optimize.minimize at parameters[0]
+        :param hysteresis: If True, also sweep back along the path starting from the last minimum, and compare the
+        energies of both branches
+        :return: Dictionary with 'forward' and 'backward' (None if hysteresis is False) lists of results, see follow,
+        and 'hysteresis', a boolean array that is True where the branches differ. Both lists are in the order of
+        parameters.
+        """
+        forward = self.follow(parameters, r0)
+        sweep = {'forward' : forward, 'backward' : None, 'hysteresis' : np.zeros(len(parameters), dtype=bool)}
+        if not hysteresis:
+            return sweep
+
+        backward = self.follow(parameters[::-1], forward[-1])[::-1]
+        sweep['backward'] = backward
+        sweep['hysteresis'] = np.array([np.abs(f['fun'] - b['fun']) > self.energy_tolerance
+                                        for f, b in zip(forward, backward)])
+        if self.verbose and np.any(sweep['hysteresis']):
+            cprint("Hysteresis: forward and backward sweep differ at points %s" % np.where(sweep['hysteresis'])[0],
+                   "yellow")
+        return sweep
+
+    def add_electrons(self, parameter, r0, N_final, candidates=None, N_candidates=50):
+        """
+        Ladder of electron numbers: add electrons one at a time at the position with the lowest insertion energy
+        (see insertion_energy) and minimize again, starting from the previous minimum.
+        :param parameter: Point of the parameter path at which the electrons are added, see make_solver
+        :param r0: Initial configuration, or output of scipy.optimize.minimize
+        :param N_final: Final number of electrons
+        :param candidates: Tuple (xc, yc) of 1D arrays with candidate positions for the new electrons. By default a
+        N_candidates x N_candidates grid around the current configuration is used, or over the whole grid of the
+        solver if there are no electrons yet.
+        :param N_candidates: Number of candidate points in each direction for the default candidates
+        :return: List of outputs of scipy.optimize.minimize, for len(r0) / 2 + 1, ..., N_final electrons
+        """
+        if isinstance(r0, dict):
+            r0 = r0['x']
+        r = np.array(r0, dtype=np.float64)
+        solver = self.make_solver(parameter)
+
+        results = list()
+        while len(r) // 2 < N_final:
+            if candidates is None:
+                if len(r) == 0:
+                    (xmin, xmax), (ymin, ymax) = grid_extent(solver)
+                else:
+                    # Grid around the configuration, extended by the typical electron spacing on each side
+                    xi, yi = r[::2], r[1::2]
+                    pad = np.sqrt((np.ptp(xi) + 1E-6) * (np.ptp(yi) + 1E-6) / len(xi))
+                    xmin, xmax, ymin, ymax = np.min(xi) - pad, np.max(xi) + pad, np.min(yi) - pad, np.max(yi) + pad
+                Xc, Yc = np.meshgrid(np.linspace(xmin, xmax, N_candidates), np.linspace(ymin, ymax, N_candidates))
+                xc, yc = Xc.ravel(), Yc.ravel()
+            else:
+                xc, yc = candidates
+
+            best = np.argmin(insertion_energy(solver, r, xc, yc))
+            res = self.minimize(solver, np.concatenate((r, [xc[best], yc[best]])))
+            res['parameter'] = parameter
+            results.append(res)
+            r = res['x']
+
+        return results
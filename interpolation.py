@@ -0,0 +1,261 @@
+"""
+Fast evaluation of the spline representations of the electrostatic potential used in artificial_anneal.py and
+trap_analysis.py.
+
+scipy's RectBivariateSpline.ev and UnivariateSpline repeat the knot search and the evaluation of the B-spline basis
+for every derivative that is requested. The evaluators in this module locate the knot span of each point once and
+evaluate the value and all derivatives up to second order from the same local basis, in vectorized numpy.
+
+For small, smooth regions such as the trap, PolynomialEvaluator2D replaces the spline by a least-squares Chebyshev
+polynomial with the same interface.
+"""
+import numpy as np
+
+
+def bspline_basis(knots, k, x, nu=2, zero_outside=False):
+    """
+    Evaluate the k+1 non-zero B-spline basis functions of degree k and their derivatives up to order nu at points x.
+    Points outside the base interval [knots[k], knots[-k-1]] are clamped to the interval, as is done in FITPACK. The
+    spline is therefore constant outside the interval, but the derivatives are those at the nearest boundary point,
+    as returned by RectBivariateSpline.ev(..., dx=1).
+    :param knots: Full knot vector, including the boundary knots (e.g. from RectBivariateSpline.tck)
+    :param k: Degree of the spline
+    :param x: 1D array of evaluation points
+    :param nu: Highest derivative order to evaluate
+    :param zero_outside: If True, the derivatives vanish outside the interval instead, which corresponds to the
+    derivative of a UnivariateSpline with ext=3.
+    :return: span, basis. span is an integer array of length len(x) such that the non-zero basis functions at x[i]
+    are B_{span[i]-k}, ..., B_{span[i]}. basis[d] is an array of shape (len(x), k+1) with the d-th derivative of these
+    basis functions.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    outside = np.logical_or(x < knots[k], x > knots[-k - 1])
+    x = np.clip(x, knots[k], knots[-k - 1])
+    span = np.searchsorted(knots, x, side='right') - 1
+    span = np.clip(span, k, len(knots) - k - 2)
+
+    # ndu[j][r] holds the basis functions of degree j (upper triangle) and the knot differences (lower triangle),
+    # see algorithm A2.3 in Piegl & Tiller, The NURBS Book.
+    ndu = [[None] * (k + 1) for _ in range(k + 1)]
+    ndu[0][0] = np.ones_like(x)
+    left = [None] * (k + 1)
+    right = [None] * (k + 1)
+    for j in range(1, k + 1):
+        left[j] = x - knots[span + 1 - j]
+        right[j] = knots[span + j] - x
+        saved = np.zeros_like(x)
+        for r in range(j):
+            ndu[j][r] = right[r + 1] + left[j - r]
+            temp = ndu[r][j - 1] / ndu[j][r]
+            ndu[r][j] = saved + right[r + 1] * temp
+            saved = left[j - r] * temp
+        ndu[j][j] = saved
+
+    basis = [np.zeros((len(x), k + 1)) for _ in range(nu + 1)]
+    for j in range(k + 1):
+        basis[0][:, j] = ndu[j][k]
+
+    n = min(nu, k)
+    for r in range(k + 1):
+        a = [[None] * (k + 1), [None] * (k + 1)]
+        s1, s2 = 0, 1
+        a[s1][0] = np.ones_like(x)
+        for d in range(1, n + 1):
+            derivative = np.zeros_like(x)
+            rk, pk = r - d, k - d
+            if r >= d:
+                a[s2][0] = a[s1][0] / ndu[pk + 1][rk]
+                derivative += a[s2][0] * ndu[rk][pk]
+            j1 = 1 if rk >= -1 else -rk
+            j2 = d - 1 if r - 1 <= pk else k - r
+            for j in range(j1, j2 + 1):
+                a[s2][j] = (a[s1][j] - a[s1][j - 1]) / ndu[pk + 1][rk + j]
+                derivative += a[s2][j] * ndu[rk + j][pk]
+            if r <= pk:
+                a[s2][d] = -a[s1][d - 1] / ndu[pk + 1][r]
+                derivative += a[s2][d] * ndu[r][pk]
+            basis[d][:, r] = derivative
+            s1, s2 = s2, s1
+
+    factor = k
+    for d in range(1, n + 1):
+        basis[d] *= factor
+        factor *= (k - d)
+
+    if zero_outside:
+        for d in range(1, nu + 1):
+            basis[d][outside] = 0
+    return span, basis
+
+
+class SplineEvaluator2D:
+
+    def __init__(self, spline):
+        """
+        Evaluates a tensor product spline, its gradient and its Hessian in a single pass.
+        For the bicubic splines used by the solvers, each point only touches a 4x4 patch of spline coefficients.
+        :param spline: scipy.interpolate.RectBivariateSpline instance
+        """
+        (self.tx, self.ty, coefficients) = spline.tck
+        self.kx, self.ky = spline.degrees
+        self.coefficients = np.reshape(coefficients, (len(self.tx) - self.kx - 1, len(self.ty) - self.ky - 1))
+
+    def evaluate(self, x, y, order=2):
+        """
+        Evaluate the spline and its partial derivatives at points (x, y).
+        :param x: array or float
+        :param y: array or float, must broadcast with x
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :return: order = 0: (V,)
+                 order = 1: (V, dV/dx, dV/dy)
+                 order = 2: (V, dV/dx, dV/dy, d2V/dx2, d2V/dxdy, d2V/dy2)
+        All arrays have the broadcasted shape of x and y.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        x, y = x.ravel(), y.ravel()
+
+        span_x, Bx = bspline_basis(self.tx, self.kx, x, nu=order)
+        span_y, By = bspline_basis(self.ty, self.ky, y, nu=order)
+
+        idx_x = (span_x - self.kx)[:, np.newaxis] + np.arange(self.kx + 1)
+        idx_y = (span_y - self.ky)[:, np.newaxis] + np.arange(self.ky + 1)
+        patch = self.coefficients[idx_x[:, :, np.newaxis], idx_y[:, np.newaxis, :]]
+
+        # Contract the y-direction first, then combine with the x-basis for each requested derivative
+        Py = [np.einsum('nab,nb->na', patch, B) for B in By]
+        derivatives = [(0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2)][:{0: 1, 1: 3, 2: 6}[order]]
+        return tuple(np.einsum('na,na->n', Bx[dx], Py[dy]).reshape(shape) for dx, dy in derivatives)
+
+
+class SplineEvaluator1D:
+
+    def __init__(self, spline):
+        """
+        Evaluates a 1D spline and its first and second derivative in a single pass.
+        Points outside the data range return the boundary value and zero derivatives, which corresponds to ext=3 in
+        scipy.interpolate.UnivariateSpline and its derivative().
+        :param spline: scipy.interpolate.UnivariateSpline instance
+        """
+        self.t, coefficients, self.k = spline._eval_args
+        self.coefficients = np.asarray(coefficients)[:len(self.t) - self.k - 1]
+
+    def evaluate(self, x, order=2):
+        """
+        Evaluate the spline and its derivatives at points x.
+        :param x: array or float
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :return: (V,), (V, dV/dx) or (V, dV/dx, d2V/dx2), each with the shape of x.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        shape = x.shape
+        span, B = bspline_basis(self.t, self.k, x.ravel(), nu=order, zero_outside=True)
+        patch = self.coefficients[(span - self.k)[:, np.newaxis] + np.arange(self.k + 1)]
+        return tuple(np.einsum('na,na->n', b, patch).reshape(shape) for b in B)
+
+
+def chebyshev_basis(u, degree, nu=2):
+    """
+    Evaluate the Chebyshev polynomials T_0, ..., T_degree and their derivatives up to order nu at points u with the
+    three-term recurrence T_{n+1} = 2 u T_n - T_{n-1}.
+    :param u: 1D array of points in [-1, 1]
+    :param degree: Highest degree
+    :param nu: Highest derivative order to evaluate
+    :return: basis. basis[d] is an array of shape (len(u), degree + 1) with the d-th derivative of the polynomials.
+    """
+    basis = [np.zeros((len(u), degree + 1)) for _ in range(nu + 1)]
+    basis[0][:, 0] = 1
+    if degree >= 1:
+        basis[0][:, 1] = u
+        if nu >= 1:
+            basis[1][:, 1] = 1
+    for n in range(1, degree):
+        basis[0][:, n + 1] = 2 * u * basis[0][:, n] - basis[0][:, n - 1]
+        for d in range(1, nu + 1):
+            # Derivative of the recurrence: T^(d)_{n+1} = 2 d T^(d-1)_n + 2 u T^(d)_n - T^(d)_{n-1}
+            basis[d][:, n + 1] = 2 * d * basis[d - 1][:, n] + 2 * u * basis[d][:, n] - basis[d][:, n - 1]
+    return basis
+
+
+class PolynomialEvaluator2D:
+
+    def __init__(self, x, y, V, degree=6, domain=None):
+        """
+        Reduced-order model of a smooth potential: a least-squares fit of a 2D Chebyshev polynomial of total degree
+        `degree`. It evaluates the potential, its gradient and its Hessian like SplineEvaluator2D, but without knot
+        searches, and is meant for small regions such as the trap. Like the splines, points outside the fit domain are
+        clamped to the domain: the model is constant outside it, and the derivatives are those at the boundary.
+        The quality of the fit is stored in self.rms_residual and self.max_residual (units of V).
+        :param x: 1D array of x-data
+        :param y: 1D array of y-data
+        :param V: 2D array of shape (len(x), len(y)), as for RectBivariateSpline
+        :param degree: Total degree of the polynomial
+        :param domain: ((xmin, xmax), (ymin, ymax)). Only data inside this domain is fitted. Defaults to all data.
+        """
+        x, y, V = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), np.asarray(V, dtype=np.float64)
+        if domain is None:
+            domain = ((np.min(x), np.max(x)), (np.min(y), np.max(y)))
+        self.domain = domain
+        self.degree = degree
+        self.center = np.array([np.mean(domain[0]), np.mean(domain[1])])
+        self.scale = np.array([0.5 * (domain[0][1] - domain[0][0]), 0.5 * (domain[1][1] - domain[1][0])])
+
+        X, Y = np.meshgrid(x, y, indexing='ij')
+        inside = (X >= domain[0][0]) & (X <= domain[0][1]) & (Y >= domain[1][0]) & (Y <= domain[1][1])
+        u = (X[inside] - self.center[0]) / self.scale[0]
+        v = (Y[inside] - self.center[1]) / self.scale[1]
+
+        # Design matrix with the products T_i(u) T_j(v) for i + j <= degree
+        Tu, Tv = chebyshev_basis(u, degree, nu=0)[0], chebyshev_basis(v, degree, nu=0)[0]
+        i, j = np.where(np.add.outer(np.arange(degree + 1), np.arange(degree + 1)) <= degree)
+        coefficients, _, _, _ = np.linalg.lstsq(Tu[:, i] * Tv[:, j], V[inside], rcond=None)
+        self.coefficients = np.zeros((degree + 1, degree + 1))
+        self.coefficients[i, j] = coefficients
+
+        residuals = V[inside] - self.evaluate(X[inside], Y[inside], order=0)[0]
+        self.rms_residual = np.sqrt(np.mean(residuals ** 2))
+        self.max_residual = np.max(np.abs(residuals))
+
+    @staticmethod
+    def combine(models, coefficients):
+        """
+        Linear combination of models with the same degree and domain, e.g. fits of the potential of each electrode
+        combined with the electrode voltages.
+        :param models: List of PolynomialEvaluator2D instances
+        :param coefficients: List of weights, one for each model
+        :return: PolynomialEvaluator2D instance. Its max_residual is an upper bound.
+        """
+        for model in models[1:]:
+            if model.degree != models[0].degree or not np.allclose(model.domain, models[0].domain):
+                raise ValueError("Models can only be combined if they have the same degree and domain.")
+        combined = PolynomialEvaluator2D.__new__(PolynomialEvaluator2D)
+        combined.__dict__.update(models[0].__dict__)
+        combined.coefficients = sum(c * model.coefficients for c, model in zip(coefficients, models))
+        combined.rms_residual = None
+        combined.max_residual = sum(np.abs(c) * model.max_residual for c, model in zip(coefficients, models))
+        return combined
+
+    def evaluate(self, x, y, order=2):
+        """
+        Evaluate the polynomial and its partial derivatives at points (x, y).
+        :param x: array or float
+        :param y: array or float, must broadcast with x
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :return: order = 0: (V,)
+                 order = 1: (V, dV/dx, dV/dy)
+                 order = 2: (V, dV/dx, dV/dy, d2V/dx2, d2V/dxdy, d2V/dy2)
+        All arrays have the broadcasted shape of x and y.
+        """
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        u = (x.ravel() - self.center[0]) / self.scale[0]
+        v = (y.ravel() - self.center[1]) / self.scale[1]
+        Tu = chebyshev_basis(np.clip(u, -1, 1), self.degree, nu=order)
+        Tv = chebyshev_basis(np.clip(v, -1, 1), self.degree, nu=order)
+
+        # Contract the y-direction first, then combine with the x-basis for each requested derivative
+        Pv = [np.dot(T, self.coefficients.T) for T in Tv]
+        derivatives = [(0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2)][:{0: 1, 1: 3, 2: 6}[order]]
+        scale_x, scale_y = self.scale
+        return tuple((np.einsum('na,na->n', Tu[dx], Pv[dy]) / scale_x ** dx / scale_y ** dy).reshape(shape)
+                     for dx, dy in derivatives)
@@ -0,0 +1,200 @@
+"""
+Minimizers specialized for electron crystals, to be used with the solvers in artificial_anneal.py.
+
+All minimizers follow the calling convention of custom methods for scipy.optimize.minimize, such that they can be
+used as a drop-in replacement, e.g.
+
+    minimize(solver.Vtotal_and_grad, r0, jac=True, method=fire, options={'gtol' : 1E-3})
+
+or called directly as fire(solver.Vtotal_and_grad, r0, jac=True). They return a scipy.optimize.OptimizeResult.
+"""
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+
+def get_fun_and_grad(fun, jac, args=()):
+    """
+    Combine a cost function and its gradient in a single function that returns both.
+    :param fun: Cost function. If jac is True, fun returns the cost and its gradient.
+    :param jac: True or a function that returns the gradient of fun.
+    :param args: Extra arguments passed to fun and jac
+    :return: Function of x that returns fun(x), grad(x)
+    """
+    if jac is True:
+        return lambda x: fun(x, *args)
+    elif callable(jac):
+        return lambda x: (fun(x, *args), jac(x, *args))
+    else:
+        raise ValueError("This minimizer requires the gradient. Supply jac=True or jac=solver.grad_total.")
+
+
+def fire(fun, x0, args=(), jac=None, callback=None, gtol=1E-3, maxiter=None, max_step=20E-9, dt=None, dt_max=None,
+         N_min=5, f_inc=1.1, f_dec=0.5, alpha_start=0.1, f_alpha=0.99, **unknown_options):
+    """
+    Fast Inertial Relaxation Engine (Bitzek et al., PRL 97, 170201 (2006)). Damped dynamics that accelerates along
+    the force while the power F.v is positive and stops as soon as it turns negative. This handles the soft,
+    long-wavelength modes of large Wigner crystals better than conjugate gradients.
+    :param fun: Cost function, e.g. solver.Vtotal or solver.Vtotal_and_grad (with jac=True)
+    :param x0: Initial electron positions r = [x0, y0, x1, y1, ...]
+    :param args: Extra arguments passed to fun and jac
+    :param jac: True if fun returns the cost and its gradient, or a function that returns the gradient
+    :param callback: Called with the current positions after every iteration, e.g. ConvergenceMonitor.monitor_convergence
+    :param gtol: Convergence criterion: maximum force component (L-inf norm of the gradient) in eV/m
+    :param maxiter: Maximum number of iterations. Defaults to 1000 * number of electrons.
+    :param max_step: Maximum displacement of a single electron per iteration in m
+    :param dt: Initial time step. By default it is chosen such that the first step moves electrons by ~max_step / 10.
+    :param dt_max: Maximum time step. Defaults to 10 * dt.
+    :param N_min: Number of steps with positive power before the time step is increased
+    :param f_inc: Factor by which the time step is increased
+    :param f_dec: Factor by which the time step is decreased
+    :param alpha_start: Initial mixing of the velocity with the force direction
+    :param f_alpha: Factor by which alpha is decreased
+    :return: scipy.optimize.OptimizeResult
+    """
+    fun_and_grad = get_fun_and_grad(fun, jac, args)
+    x = np.array(x0, dtype=np.float64)
+    if maxiter is None:
+        maxiter = 500 * len(x)
+
+    f, g = fun_and_grad(x)
+    nfev = 1
+    v = np.zeros(len(x))
+
+    if dt is None:
+        dt = np.sqrt(0.1 * max_step / max(np.max(np.abs(g)), 1E-30))
+    if dt_max is None:
+        dt_max = 10 * dt
+    alpha = alpha_start
+    n_positive = 0
+
+    status, message = 1, "Maximum number of iterations has been exceeded."
+    for nit in range(1, maxiter + 1):
+        F = -g
+        if np.max(np.abs(F)) < gtol:
+            status, message = 0, "Optimization terminated successfully."
+            nit -= 1
+            break
+
+        P = np.dot(F, v)
+        if P > 0:
+            # Mix the velocity with the force direction and accelerate after N_min downhill steps
+            v = (1 - alpha) * v + alpha * np.linalg.norm(v) / np.linalg.norm(F) * F
+            if n_positive > N_min:
+                dt = min(dt * f_inc, dt_max)
+                alpha *= f_alpha
+            n_positive += 1
+        else:
+            # Overshoot: step back half a step, stop and decrease the time step
+            x -= 0.5 * dt * v
+            v[:] = 0
+            dt *= f_dec
+            alpha = alpha_start
+            n_positive = 0
+
+        # Semi-implicit Euler step, limiting the displacement of each electron to max_step
+        v += dt * F
+        step = dt * np.sqrt(v[::2] ** 2 + v[1::2] ** 2)
+        v *= np.repeat(np.minimum(1, max_step / np.maximum(step, 1E-30)), 2)
+        x += dt * v
+
+        f, g = fun_and_grad(x)
+        nfev += 1
+
+        if callback is not None:
+            callback(x)
+
+    return OptimizeResult(x=x, fun=f, jac=g, nit=nit, nfev=nfev, njev=nfev, status=status, success=status == 0,
+                          message=message)
+
+
+def fire_batch(fun_and_grad, X0, callback=None, gtol=1E-3, maxiter=None, max_step=20E-9, dt=None, dt_max=None,
+               N_min=5, f_inc=1.1, f_dec=0.5, alpha_start=0.1, f_alpha=0.99):
+    """
+    Relax K configurations in lockstep with FIRE, see fire. The energies and gradients of all configurations that
+    have not converged yet are evaluated in a single call, e.g. to solver.Vtotal_and_grad_batch. Each configuration
+    has its own time step and mixing parameter, such that the result for each configuration is the same as that of fire.
+    :param fun_and_grad: Function that takes a 2D array of shape (K, 2N) and returns K energies and a (K, 2N) array of
+    gradients, e.g. solver.Vtotal_and_grad_batch
+    :param X0: Initial electron positions, 2D array of shape (K, 2N). Each row is r = [x0, y0, x1, y1, ...]
+    :param callback: Called with the positions of all configurations after every iteration
+    :param gtol: Convergence criterion: maximum force component (L-inf norm of the gradient) in eV/m
+    :param maxiter: Maximum number of iterations. Defaults to 1000 * number of electrons.
+    :param max_step: Maximum displacement of a single electron per iteration in m
+    :param dt: Initial time step, see fire
+    :param dt_max: Maximum time step. Defaults to 10 * dt.
+    :param N_min: Number of steps with positive power before the time step is increased
+    :param f_inc: Factor by which the time step is increased
+    :param f_dec: Factor by which the time step is decreased
+    :param alpha_start: Initial mixing of the velocity with the force direction
+    :param f_alpha: Factor by which alpha is decreased
+    :return: List of K scipy.optimize.OptimizeResult, one for each configuration
+    """
+    X = np.array(X0, dtype=np.float64)
+    K = X.shape[0]
+    if maxiter is None:
+        maxiter = 500 * X.shape[1]
+
+    f, G = fun_and_grad(X)
+    f, G = np.array(f, dtype=np.float64), np.array(G, dtype=np.float64)
+    V = np.zeros(X.shape)
+
+    if dt is None:
+        dt = np.sqrt(0.1 * max_step / np.maximum(np.max(np.abs(G), axis=1), 1E-30))
+    dt = dt * np.ones(K)
+    if dt_max is None:
+        dt_max = 10 * dt
+    dt_max = dt_max * np.ones(K)
+    alpha = alpha_start * np.ones(K)
+    n_positive = np.zeros(K, dtype=int)
+    nit = np.zeros(K, dtype=int)
+    nfev = np.ones(K, dtype=int)
+    active = np.max(np.abs(G), axis=1) >= gtol
+
+    for iteration in range(maxiter):
+        if not np.any(active):
+            break
+        a = np.where(active)[0]
+        x, v, F = X[a], V[a], -G[a]
+
+        P = np.sum(F * v, axis=1)
+        downhill = P > 0
+        v_norm = np.linalg.norm(v, axis=1)
+        F_norm = np.maximum(np.linalg.norm(F, axis=1), 1E-30)
+
+        # Mix the velocity with the force direction and accelerate after N_min downhill steps
+        mixing = np.where(downhill, alpha[a], 0)
+        v = (1 - mixing)[:, np.newaxis] * v + (mixing * v_norm / F_norm)[:, np.newaxis] * F
+        accelerate = np.logical_and(downhill, n_positive[a] > N_min)
+        dt[a] = np.where(accelerate, np.minimum(dt[a] * f_inc, dt_max[a]), dt[a])
+        alpha[a] = np.where(accelerate, alpha[a] * f_alpha, alpha[a])
+        n_positive[a] = np.where(downhill, n_positive[a] + 1, 0)
+
+        # Overshoot: step back half a step, stop and decrease the time step
+        x -= np.where(downhill, 0, 0.5 * dt[a])[:, np.newaxis] * v
+        v[~downhill] = 0
+        dt[a] = np.where(downhill, dt[a], dt[a] * f_dec)
+        alpha[a] = np.where(downhill, alpha[a], alpha_start)
+
+        # Semi-implicit Euler step, limiting the displacement of each electron to max_step
+        v += dt[a, np.newaxis] * F
+        step = dt[a, np.newaxis] * np.sqrt(v[:, ::2] ** 2 + v[:, 1::2] ** 2)
+        v *= np.repeat(np.minimum(1, max_step / np.maximum(step, 1E-30)), 2, axis=1)
+        x += dt[a, np.newaxis] * v
+
+        X[a], V[a] = x, v
+        f[a], G[a] = fun_and_grad(x)
+        nit[a] += 1
+        nfev[a] += 1
+        active[a] = np.max(np.abs(G[a]), axis=1) >= gtol
+
+        if callback is not None:
+            callback(X)
+
+    results = list()
+    for k in range(K):
+        status = 1 if active[k] else 0
+        message = "Maximum number of iterations has been exceeded." if active[k] else \
+            "Optimization terminated successfully."
+        results.append(OptimizeResult(x=X[k], fun=f[k], jac=G[k], nit=nit[k], nfev=nfev[k], njev=nfev[k],
+                                      status=status, success=status == 0, message=message))
+    return results
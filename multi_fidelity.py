@@ -0,0 +1,230 @@
+"""
+Multi-fidelity minimization. Far from the minimum the optimizer only needs the rough direction of the forces, so the
+first iterations are done with a cheap approximation of the cost function: float32 pair sums, an interaction cutoff
+and a coarser, lower order spline of the potential. When the largest force on an electron drops below a threshold, the
+minimization continues with the exact solver.Vtotal_and_grad from where the approximate stage stopped.
+
+    res = MultiFidelitySolver(solver).solve(r0)
+    stages = [{'cutoff' : 5E-6, 'spline_order' : 1, 'coarsen' : 4, 'force_tolerance' : 1E4},
+              {'force_tolerance' : 1E3}]
+    res = MultiFidelitySolver(solver, stages=stages, minimizer_dict={'method' : 'L-BFGS-B'}).solve(r0)
+"""
+import time
+import numpy as np
+from scipy.optimize import minimize
+from scipy.interpolate import RectBivariateSpline, UnivariateSpline
+from termcolor import cprint
+from .interpolation import SplineEvaluator2D, SplineEvaluator1D
+
+
+def force_norm(gradient):
+    """
+    Largest force on a single electron.
+    :param gradient: Gradient of the total energy, [dV/dx0, dV/dy0, dV/dx1, ...] in eV/m
+    :return: max_i |F_i| in eV/m
+    """
+    return np.max(np.sqrt(gradient[::2] ** 2 + gradient[1::2] ** 2)) if len(gradient) else 0.
+
+
+class StageConverged(Exception):
+    """
+    Raised by the callback of an approximate stage when the force tolerance is reached.
+    """
+    def __init__(self, x):
+        Exception.__init__(self, "Force tolerance reached")
+        self.x = x
+
+
+class ApproximateModel:
+
+    def __init__(self, solver, dtype=np.float32, cutoff=None, spline_order=None, coarsen=1):
+        """
+        Cheap approximation of solver.Vtotal_and_grad.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param dtype: Floating point type of the pair sums, e.g. np.float32. The sums are done in coordinates relative
+        to the center of the configuration, such that the precision is not lost on the offset.
+        :param cutoff: Ignore pairs further apart than cutoff (in m), using the neighbor list of solver.pair_list. None
+        includes all pairs. The energy jumps when a pair crosses the cutoff, which is acceptable far from the minimum.
+        :param spline_order: Order of a new spline of the potential (1 = linear). None keeps the spline of the solver.
+        :param coarsen: The new spline is fitted to the potential of the solver on a grid that is this many times
+        coarser than the knots of the solver's spline.
+        """
+        self.solver = solver
+        self.dtype = dtype
+        self.cutoff = cutoff
+        self.periodic = hasattr(solver, 'box_y_length')
+        self.evaluator = solver.evaluator
+        if spline_order is not None or coarsen > 1:
+            self.evaluator = self.coarse_evaluator(spline_order, coarsen)
+
+        # Last evaluation, such that the callback doesn't evaluate the model again
+        self.last_x, self.last_gradient = None, None
+        self.nfev = 0
+
+    def coarse_evaluator(self, spline_order, coarsen):
+        """
+        Spline of order spline_order through the potential of the solver, sampled on a grid that is coarsen times
+        coarser than the knots of the solver's spline. Reduced models (PolynomialEvaluator2D) are kept as they are.
+        """
+        if isinstance(self.evaluator, SplineEvaluator1D):
+            t, k = self.evaluator.t, self.evaluator.k
+            order = k if spline_order is None else spline_order
+            x = np.linspace(t[0], t[-1], max((len(t) - k - 1) // coarsen, order + 1))
+            return SplineEvaluator1D(UnivariateSpline(x, self.evaluator.evaluate(x, order=0)[0], k=order, s=0, ext=3))
+        if isinstance(self.evaluator, SplineEvaluator2D):
+            tx, ty, kx, ky = self.evaluator.tx, self.evaluator.ty, self.evaluator.kx, self.evaluator.ky
+            kx, ky = (kx, ky) if spline_order is None else (spline_order, spline_order)
+            x = np.linspace(tx[0], tx[-1], max((len(tx) - self.evaluator.kx - 1) // coarsen, kx + 1))
+            y = np.linspace(ty[0], ty[-1], max((len(ty) - self.evaluator.ky - 1) // coarsen, ky + 1))
+            V = self.evaluator.evaluate(x[:, np.newaxis], y[np.newaxis, :], order=0)[0]
+            return SplineEvaluator2D(RectBivariateSpline(x, y, V, kx=kx, ky=ky, s=0))
+        return self.evaluator
+
+    def external(self, xi, yi):
+        """
+        External potential and its gradient, see the Vtotal_and_grad functions of the solvers.
+        :return: V, dV/dx, dV/dy in eV and eV/m
+        """
+        if self.periodic:
+            V, dVdx = self.evaluator.evaluate(xi, order=1)
+            V, dVdx, dVdy = V, dVdx, np.zeros(len(yi))
+        else:
+            V, dVdx, dVdy = self.evaluator.evaluate(xi, yi, order=1)
+        if hasattr(self.solver, 'background_potential'):
+            Vbg, dVbgdx, dVbgdy = self.solver.background_potential(xi, yi, order=1)
+            V, dVdx, dVdy = V + Vbg, dVdx + dVbgdx, dVdy + dVbgdy
+        return np.sum(V), dVdx, dVdy
+
+    def Vee_and_grad(self, xi, yi):
+        """
+        Electron-electron interaction energy and its gradient in reduced precision, optionally with a cutoff.
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        N = len(xi)
+        gradient = np.zeros(2 * N)
+        if self.cutoff is not None:
+            i, j, dx, dy, Rij = self.solver.pair_list(xi, yi, cutoff=self.cutoff)
+            phi, dphi = self.solver.pair_potential(Rij.astype(self.dtype), order=1)
+            gx, gy = dphi * dx.astype(self.dtype), dphi * dy.astype(self.dtype)
+            gradient[::2] = np.bincount(i, gx, minlength=N) - np.bincount(j, gx, minlength=N)
+            gradient[1::2] = np.bincount(i, gy, minlength=N) - np.bincount(j, gy, minlength=N)
+            return float(np.sum(phi, dtype=np.float64)), gradient
+
+        xs = (xi - np.mean(xi)).astype(self.dtype)
+        ys = (yi - np.mean(yi)).astype(self.dtype)
+        XiXj = xs[:, np.newaxis] - xs[np.newaxis, :]
+        YiYj = ys[:, np.newaxis] - ys[np.newaxis, :]
+        if self.periodic:
+            L = self.dtype(self.solver.box_y_length)
+            YiYj -= L * np.round(YiYj / L)
+        Rij = np.sqrt(XiXj ** 2 + YiYj ** 2)
+        np.fill_diagonal(Rij, 1)
+
+        phi, dphi = self.solver.pair_potential(Rij, order=1)
+        np.fill_diagonal(phi, 0)
+        np.fill_diagonal(dphi, 0)
+        gradient[::2] = np.sum(dphi * XiXj, axis=1)
+        gradient[1::2] = np.sum(dphi * YiYj, axis=1)
+        return 0.5 * float(np.sum(phi, dtype=np.float64)), gradient
+
+    def Vtotal_and_grad(self, r):
+        """
+        Approximate total energy and its gradient. Use as scipy.optimize.minimize(model.Vtotal_and_grad, r0, jac=True)
+        :param r: r = np.array([x0, y0, x1, y1, x2, y2, ... , xN, yN])
+        :return: Approximate Vtotal(r), grad_total(r)
+        """
+        xi, yi = r[::2], r[1::2]
+        V, dVdx, dVdy = self.external(xi, yi)
+        Vint, gradient = self.Vee_and_grad(xi, yi)
+        gradient[::2] += dVdx
+        gradient[1::2] += dVdy
+        self.last_x, self.last_gradient = np.array(r), gradient
+        self.nfev += 1
+        return V + Vint, gradient
+
+
+class MultiFidelitySolver:
+
+    def __init__(self, solver, stages=None, minimizer_dict=None, verbose=True):
+        """
+        Minimization with a sequence of increasingly accurate cost functions, finished with the exact one.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param stages: List of dictionaries, one for each approximate stage. Each contains the options of
+        ApproximateModel, the 'force_tolerance' (largest force on an electron in eV/m, see force_norm) at which the
+        next stage takes over, and optionally a 'minimizer_dict' for this stage. By default there is one stage with
+        float32 pair sums on a linear spline that is two times coarser than the solver's spline.
+        :param minimizer_dict: Dictionary with optimizer options, see scipy.optimize.minimize. The cost functions are
+        passed with jac=True. This is used for the exact stage and for approximate stages without their own options.
+        :param verbose: Print the time, the number of evaluations and the energy of each stage
+        """
+        self.solver = solver
+        self.stages = [{'dtype' : np.float32, 'spline_order' : 1, 'coarsen' : 2, 'force_tolerance' : 1E4}] \
+            if stages is None else stages
+        self.minimizer_dict = {'method' : 'CG'} if minimizer_dict is None else minimizer_dict
+        self.verbose = verbose
+
+    def run_stage(self, model, r0, force_tolerance, minimizer_dict):
+        """
+        Minimize the approximate model until the largest force on an electron drops below force_tolerance.
+        :return: Electron positions at the end of the stage, the number of iterations and whether the force tolerance
+        was reached
+        """
+        iterations = [0]
+
+        def callback(xk, *args):
+            iterations[0] += 1
+            if model.last_x is not None and np.array_equal(xk, model.last_x):
+                gradient = model.last_gradient
+            else:
+                gradient = model.Vtotal_and_grad(xk)[1]
+            if force_norm(gradient) < force_tolerance:
+                raise StageConverged(np.array(xk))
+
+        try:
+            res = minimize(model.Vtotal_and_grad, r0, jac=True, callback=callback, **minimizer_dict)
+            return res['x'], iterations[0], False
+        except StageConverged as converged:
+            return converged.x, iterations[0], True
+
+    def solve(self, r0):
+        """
+        Minimize the total energy, starting with the approximate stages and finishing with solver.Vtotal_and_grad.
+        :param r0: Initial condition, or output of scipy.optimize.minimize
+        :return: Output of scipy.optimize.minimize of the exact stage. It also contains 'stages', a list with a
+        dictionary for each stage with the 'time' in s, the number of function evaluations 'nfev', the number of
+        iterations 'nit', the exact energy 'fun' and the 'force' (see force_norm) at the end of the stage.
+        """
+        if isinstance(r0, dict):
+            r0 = r0['x']
+        r = np.array(r0, dtype=np.float64)
+
+        stages = list()
+        for k, stage in enumerate(self.stages):
+            options = dict((key, value) for key, value in stage.items()
+                           if key not in ('force_tolerance', 'minimizer_dict'))
+            t0 = time.time()
+            model = ApproximateModel(self.solver, **options)
+            r, nit, converged = self.run_stage(model, r, stage['force_tolerance'],
+                                               stage.get('minimizer_dict', self.minimizer_dict))
+            elapsed = time.time() - t0
+
+            E, gradient = self.solver.Vtotal_and_grad(r)
+            stages.append({'time' : elapsed, 'nfev' : model.nfev, 'nit' : nit, 'fun' : E,
+                           'force' : force_norm(gradient), 'options' : options})
+            if self.verbose:
+                cprint("\tStage %d: %.3f s, %d evaluations, %d iterations, E = %.8f eV, max. force %.2e eV/m%s"
+                       % (k, elapsed, model.nfev, nit, E, stages[-1]['force'],
+                          "" if converged else " (force tolerance not reached)"), "white")
+
+        t0 = time.time()
+        res = minimize(self.solver.Vtotal_and_grad, r, jac=True, **self.minimizer_dict)
+        elapsed = time.time() - t0
+        stages.append({'time' : elapsed, 'nfev' : res.get('nfev', 0), 'nit' : res.get('nit', 0), 'fun' : res['fun'],
+                       'force' : force_norm(self.solver.Vtotal_and_grad(res['x'])[1]), 'options' : None})
+        if self.verbose:
+            cprint("\tExact stage: %.3f s, %d evaluations, %d iterations, E = %.8f eV, max. force %.2e eV/m"
+                   % (elapsed, stages[-1]['nfev'], stages[-1]['nit'], res['fun'], stages[-1]['force']), "green")
+            cprint("\tTotal: %.3f s" % sum(stage['time'] for stage in stages), "green")
+
+        res['stages'] = stages
+        return res
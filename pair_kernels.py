@@ -0,0 +1,533 @@
+"""
+Tabulated interaction kernels for the solvers in artificial_anneal.py.
+
+PeriodicKernel sums the interaction of an electron pair with all periodic images along y, for the ResonatorSolver. The
+nearest image is evaluated analytically by the solver. The sum over all other images is a smooth function of the pair
+separation, which is tabulated once and looked up by bilinear interpolation:
+
+    kernel = PeriodicKernel(solver.pair_potential, solver.box_y_length, x_max=10E-6, regularize=True)
+    psi, dpsi_dx, dpsi_dy = kernel.evaluate(dx, dy)
+
+SortedBandInteraction is an interaction engine for long resonator channels, where the electrons form a few rows along
+y. The electrons are sorted by y, such that the pairs within a window along y are found in linear time. The
+interaction with electrons beyond the window is evaluated on a 1D mesh along the channel, with an expansion to second
+order in the separation across the channel.
+
+TabulatedKernel replaces the closed-form pair interaction of the solvers (bare or screened Coulomb) by an arbitrary
+central interaction phi(R), which is tabulated once and evaluated by cubic interpolation. The laws below describe the
+screening by metal planes and by a dielectric helium film; any function R -> (phi, dphi/dR) in eV can be used:
+
+    kernel = TabulatedKernel(helium_film_law(thickness=0.5E-6))
+    solver = TrapAreaSolver(x, y, -V, pair_kernel=kernel)
+"""
+import numpy as np
+
+# qe / (4 pi eps0) in eV m, with the constants of the solvers
+coulomb_constant = 1.602E-19 / (4 * np.pi * 8.85E-12)
+
+
+def coulomb_law(R):
+    """
+    Bare Coulomb interaction of two electrons.
+    :param R: Array of pair distances in m
+    :return: phi, dphi/dR in eV and eV/m
+    """
+    phi = coulomb_constant / R
+    return phi, -phi / R
+
+
+def closed_form_potential(Rij, out, screening_length=None):
+    """
+    The closed-form interaction of the solvers, exp(-R / screening_length) / R or 1 / R, evaluated into preallocated
+    arrays without temporary arrays, see the pair_potential of the solvers with out.
+    :param Rij: array of pair distances
+    :param out: List of 1, 2 or 3 arrays with the shape of Rij for phi, 1/R dphi/dR and d2phi/dR2
+    :param screening_length: Screening length in m, None for the bare Coulomb interaction
+    :return: tuple(out). Units eV, eV/m**2 and eV/m**2.
+    """
+    phi = out[0]
+    if screening_length is None:
+        np.divide(coulomb_constant, Rij, out=phi)
+    else:
+        np.divide(Rij, -screening_length, out=phi)
+        np.exp(phi, out=phi)
+        phi /= Rij
+        phi *= coulomb_constant
+    if len(out) > 1:
+        # -phi (R + screening_length) / (screening_length R**2), or -phi / R**2
+        dphi = out[1]
+        if screening_length is None:
+            np.divide(phi, Rij, out=dphi)
+        else:
+            np.add(Rij, screening_length, out=dphi)
+            dphi *= phi
+            dphi /= Rij
+            dphi /= -screening_length
+        dphi /= Rij
+        if screening_length is None:
+            np.negative(dphi, out=dphi)
+    if len(out) > 2:
+        # phi (R**2 + 2 screening_length R + 2 screening_length**2) / (screening_length R)**2, or 2 phi / R**2
+        d2phi = out[2]
+        if screening_length is None:
+            np.divide(phi, Rij, out=d2phi)
+            d2phi *= 2
+        else:
+            np.add(Rij, 2 * screening_length, out=d2phi)
+            d2phi *= Rij
+            d2phi += 2 * screening_length ** 2
+            d2phi *= phi
+            d2phi /= Rij
+            d2phi /= screening_length ** 2
+        d2phi /= Rij
+    return tuple(out)
+
+
+def screened_law(screening_length):
+    """
+    Exponentially screened Coulomb interaction exp(-R / screening_length) / R, as include_screening=True.
+    :param screening_length: Screening length in m
+    :return: Function R -> (phi, dphi/dR) in eV and eV/m
+    """
+    def law(R):
+        phi = coulomb_constant * np.exp(-R / screening_length) / R
+        return phi, -phi * (R + screening_length) / (screening_length * R)
+    return law
+
+
+def helium_film_law(thickness, eps_helium=1.0572, terms=32):
+    """
+    Interaction of two electrons on the surface of a helium film of the given thickness on a grounded metal. The
+    dielectric film and the image charges in the metal give the series
+        phi = k 2 / (1 + eps) sum_n c_n / sqrt(R**2 + (2 n thickness)**2),
+    with c_0 = 1, c_n = (-beta)**n - (-beta)**(n - 1) and beta = (eps - 1) / (eps + 1). For eps_helium = 1 this is
+    an electron and its image in a ground plane at distance thickness, k (1 / R - 1 / sqrt(R**2 + 4 thickness**2)).
+    Beyond a few film thicknesses the interaction decays as 1 / R**3.
+    :param thickness: Thickness of the helium film in m
+    :param eps_helium: Dielectric constant of liquid helium
+    :param terms: Number of image terms. The terms decrease as beta**n.
+    :return: Function R -> (phi, dphi/dR) in eV and eV/m
+    """
+    beta = (eps_helium - 1) / (eps_helium + 1)
+    c = np.array([1.] + [(-beta) ** n - (-beta) ** (n - 1) for n in range(1, terms)])
+    z = 2 * thickness * np.arange(terms)
+
+    def law(R):
+        phi, dphi = np.zeros(np.shape(R)), np.zeros(np.shape(R))
+        for c_n, z_n in zip(c, z):
+            inverse = 1 / np.sqrt(R ** 2 + z_n ** 2)
+            phi += c_n * inverse
+            dphi -= c_n * R * inverse ** 3
+        scale = coulomb_constant * 2 / (1 + eps_helium)
+        return scale * phi, scale * dphi
+    return law
+
+
+def gate_screened_law(distance_below, distance_above, images=1000):
+    """
+    Interaction of two electrons between two grounded metal planes, e.g. a ground plane below the helium and a top
+    gate. The electrons are distance_below above the lower plane, and the planes are D = distance_below +
+    distance_above apart. The images of each electron are +e at heights 2 n D and -e at 2 n D - 2 distance_below
+    relative to the electron, for all integers n. Beyond a separation of about D the interaction decays as
+    exp(-pi R / D).
+    :param distance_below: Distance of the electrons to the lower plane in m
+    :param distance_above: Distance of the electrons to the upper plane in m
+    :param images: Number of image pairs on each side. The sum of the terms n and -n decays as 1 / n**3.
+    :return: Function R -> (phi, dphi/dR) in eV and eV/m
+    """
+    D = distance_below + distance_above
+
+    def law(R):
+        phi, dphi = coulomb_law(R)
+        for n in range(-images, images + 1):
+            for z_n, sign in [(2 * n * D, 1.), (2 * n * D - 2 * distance_below, -1.)]:
+                if z_n == 0:
+                    continue
+                inverse = 1 / np.sqrt(R ** 2 + z_n ** 2)
+                phi = phi + sign * coulomb_constant * inverse
+                dphi = dphi - sign * coulomb_constant * R * inverse ** 3
+        return phi, dphi
+    return law
+
+
+class TabulatedKernel:
+
+    def __init__(self, law, r_min=1E-9, r_max=1E-2, points_per_octave=64):
+        """
+        Pair interaction phi(R) from a table, as a replacement of the pair_potential of the solvers. The table is
+        uniform within each octave 2**(e-1) <= R < 2**e, with points_per_octave cells per octave, such that the
+        relative resolution is the same at all distances. The cell of R follows from its binary exponent and mantissa
+        (np.frexp), without a logarithm, and phi is interpolated with a cubic Hermite polynomial through phi and
+        dphi/dR at the edges of the cell. Phi and its first derivative are continuous. With 64 points per octave the
+        relative error of phi is about 1E-8 for the image charge laws, and 2E-6 for screened_law within 10 screening
+        lengths. The second derivative, which is only used for the Hessian, is accurate to about 1E-3.
+        :param law: Function R -> (phi, dphi/dR) in eV and eV/m, e.g. screened_law(1E-6) or helium_film_law(0.5E-6).
+        It is only evaluated on the table.
+        :param r_min: Smallest tabulated distance in m. Below r_min the first cell is extrapolated.
+        :param r_max: Largest tabulated distance in m. Beyond r_max the interaction is zero.
+        :param points_per_octave: Number of cells per factor of two in R
+        """
+        self.law = law
+        self.points_per_octave = points_per_octave
+        self.e_min = int(np.frexp(r_min)[1])
+        self.e_max = int(np.frexp(r_max)[1])
+        self.r_max = r_max
+
+        K = points_per_octave
+        exponent = np.repeat(np.arange(self.e_min, self.e_max + 1), K)
+        width = np.ldexp(0.5 / K, exponent)
+        left = np.ldexp(0.5, exponent) + np.tile(np.arange(K), self.e_max - self.e_min + 1) * width
+        phi_left, dphi_left = law(left)
+        phi_right, dphi_right = law(left + width)
+
+        # Coefficients of c0 + c1 t + c2 t**2 + c3 t**3 in each cell, with t = (R - left) / width
+        m_left, m_right = dphi_left * width, dphi_right * width
+        self.coefficients = [phi_left, m_left, 3 * (phi_right - phi_left) - 2 * m_left - m_right,
+                             2 * (phi_left - phi_right) + m_left + m_right]
+        self.left = left
+        self.inverse_width = 1 / width
+        self.cells = len(left)
+
+    def __getstate__(self):
+        # The laws above are closures, which can't be pickled. The law is only needed to build the table.
+        state = dict(self.__dict__)
+        state['law'] = None
+        return state
+
+    def evaluate(self, Rij, order=2, out=None):
+        """
+        Interaction energy of two electrons separated by Rij and its derivatives, see the pair_potential of the solvers.
+        :param Rij: array of pair distances
+        :param order: 0, 1 or 2. Highest derivative order to return.
+        :param out: Optional tuple of order + 1 C-contiguous arrays with the shape of Rij, in which the results are
+        written
+        :return: (phi,), (phi, 1/R dphi/dR) or (phi, 1/R dphi/dR, d2phi/dR2). Units eV, eV/m**2 and eV/m**2.
+        """
+        shape = np.shape(Rij)
+        Rij = np.ravel(Rij)
+        if out is None:
+            out = [np.empty(len(Rij)) for k in range(order + 1)]
+        terms = [np.reshape(term, -1) for term in out[:order + 1]]
+        # Position in units of cells, R = mantissa * 2**exponent with 0.5 <= mantissa < 1
+        mantissa, exponent = np.frexp(Rij)
+        u = (exponent + (2 * mantissa - 1 - self.e_min)) * self.points_per_octave
+        cell = u.astype(np.intp)
+        t = u - cell
+        outside = (cell < 0) | (cell >= self.cells)
+        if np.any(outside):
+            cell = np.clip(cell, 0, self.cells - 1)
+            t[outside] = (Rij[outside] - self.left[cell[outside]]) * self.inverse_width[cell[outside]]
+
+        c0, c1, c2, c3 = [c[cell] for c in self.coefficients]
+        # Horner's scheme in place: phi = c0 + t (c1 + t (c2 + t c3))
+        phi = terms[0]
+        np.multiply(t, c3, out=phi)
+        phi += c2
+        phi *= t
+        phi += c1
+        phi *= t
+        phi += c0
+
+        if order >= 1:
+            inverse_width = self.inverse_width[cell]
+            # 1/R dphi/dR = (c1 + 2 t (c2 + 1.5 t c3)) / (width R)
+            dphi = terms[1]
+            np.multiply(t, c3, out=dphi)
+            dphi *= 1.5
+            dphi += c2
+            dphi *= t
+            dphi *= 2
+            dphi += c1
+            dphi *= inverse_width
+            dphi /= Rij
+        if order == 2:
+            # d2phi/dR2 = 2 (c2 + 3 t c3) / width**2
+            d2phi = terms[2]
+            np.multiply(t, c3, out=d2phi)
+            d2phi *= 3
+            d2phi += c2
+            d2phi *= 2
+            d2phi *= inverse_width
+            d2phi *= inverse_width
+
+        beyond = Rij >= self.r_max
+        if np.any(beyond):
+            for term in terms:
+                term[beyond] = 0
+        return tuple(np.reshape(term, shape) for term in terms)
+
+
+class PeriodicKernel:
+
+    def __init__(self, pair_potential, period, x_max, regularize=True, images=256, spacing=None):
+        """
+        Table of the interaction with all periodic images except the nearest one,
+            psi(dx, dy) = sum_{n != 0} phi(sqrt(dx**2 + (dy + n L)**2)) - c_n,
+        where dy is reduced to the nearest image, |dy| <= L/2. For the unscreened Coulomb interaction the sum diverges
+        logarithmically, and it is regularized with c_n = phi(|n| L). This only shifts the total energy by a constant
+        and doesn't change the forces. The images beyond n = images are included with the integral of the summand.
+        :param pair_potential: Function that returns (phi, 1/R dphi/dR) in eV for order=1, e.g. solver.pair_potential
+        :param period: Period L in m, e.g. solver.box_y_length
+        :param x_max: Largest separation |dx| in m of the table. Beyond x_max, psi is replaced by the far field of a
+        uniformly charged line, which is accurate to about 1E-6 for x_max >= 2 L.
+        :param regularize: True for the unscreened Coulomb interaction phi = k / R. If False the sum must converge
+        within images periods, e.g. for a screened interaction.
+        :param images: Number of images on each side that are summed explicitly
+        :param spacing: Spacing of the table in m. Defaults to L / 256.
+        """
+        self.pair_potential = pair_potential
+        self.period = period
+        self.regularize = regularize
+        spacing = period / 256. if spacing is None else spacing
+
+        self.nx = max(int(np.ceil(x_max / spacing)), 1) + 1
+        self.ny = max(int(np.ceil(period / 2. / spacing)), 1) + 1
+        self.x_max = x_max
+        self.hx = x_max / (self.nx - 1)
+        self.hy = period / 2. / (self.ny - 1)
+
+        rho = self.hx * np.arange(self.nx)[:, np.newaxis]
+        z = self.hy * np.arange(self.ny)[np.newaxis, :]
+        table = np.zeros((self.nx, self.ny))
+        for n in range(1, images + 1):
+            for image in [z + n * period, z - n * period]:
+                table += pair_potential(np.sqrt(rho ** 2 + image ** 2), order=0)[0]
+            if regularize:
+                table -= 2 * pair_potential(n * period, order=0)[0]
+
+        if regularize:
+            # Images beyond n = images, see the module documentation
+            k = pair_potential(period, order=0)[0] * period
+            U = images + 0.5
+            a, b = U * period + z, U * period - z
+            table += k / period * (np.log(2 * period / (a + np.sqrt(a ** 2 + rho ** 2))) +
+                                   np.log(2 * period / (b + np.sqrt(b ** 2 + rho ** 2))) + 2 * np.log(U))
+
+            # Far field of the total interaction: A - B log(dx)
+            self.B = 2 * k / period
+            R_edge = np.sqrt(x_max ** 2 + z[0] ** 2)
+            self.A = np.mean(table[-1, :] + pair_potential(R_edge, order=0)[0]) + self.B * np.log(x_max)
+
+        # Coefficients of the bilinear interpolant in each cell: c0 + c1 tx + c2 ty + c3 tx ty
+        v00, v01, v10, v11 = table[:-1, :-1], table[:-1, 1:], table[1:, :-1], table[1:, 1:]
+        self.coefficients = [np.ravel(c) for c in [v00, v10 - v00, v01 - v00, v11 - v10 - v01 + v00]]
+
+    def evaluate(self, dx, dy, out=None):
+        """
+        Interaction with all periodic images except the nearest, and its derivatives.
+        :param dx: Array of pair separations xi - xj
+        :param dy: Array of pair separations yi - yj of the nearest image, |dy| <= L/2, with the same shape as dx
+        :param out: Optional tuple of 3 arrays with the shape of dx, in which the results are written
+        :return: psi, dpsi/d(dx), dpsi/d(dy) in eV and eV/m, each with the shape of dx
+        """
+        u = np.abs(dx) * (1. / self.hx)
+        v = np.abs(dy) * (1. / self.hy)
+        ix = np.minimum(u.astype(np.intp), self.nx - 2)
+        iy = np.minimum(v.astype(np.intp), self.ny - 2)
+        tx = np.minimum(u - ix, 1)
+        ty = v - iy
+
+        index = ix * (self.ny - 1) + iy
+        c0, c1, c2, c3 = [c[index] for c in self.coefficients]
+        if out is None:
+            out = [np.empty(np.shape(dx)) for k in range(3)]
+        psi, dpsi_dx, dpsi_dy = out
+
+        # psi = c0 + tx (c1 + c3 ty) + c2 ty, written without temporary arrays
+        along_x = c1
+        np.multiply(c3, ty, out=dpsi_dx)
+        along_x += dpsi_dx
+        np.sign(dx, out=dpsi_dx)
+        dpsi_dx *= along_x
+        dpsi_dx *= 1. / self.hx
+        np.multiply(tx, along_x, out=psi)
+        psi += c0
+        np.multiply(c3, tx, out=dpsi_dy)
+        dpsi_dy += c2
+        c2 *= ty
+        psi += c2
+        np.sign(dy, out=ty)
+        dpsi_dy *= ty
+        dpsi_dy *= 1. / self.hy
+
+        outside = u > self.nx - 1
+        if np.any(outside):
+            if self.regularize:
+                R = np.sqrt(dx[outside] ** 2 + dy[outside] ** 2)
+                phi, dphi = self.pair_potential(R, order=1)
+                psi[outside] = self.A - self.B * np.log(np.abs(dx[outside])) - phi
+                dpsi_dx[outside] = -self.B / dx[outside] - dphi * dx[outside]
+                dpsi_dy[outside] = -dphi * dy[outside]
+            else:
+                psi[outside], dpsi_dx[outside], dpsi_dy[outside] = 0, 0, 0
+        return psi, dpsi_dx, dpsi_dy
+
+
+class SortedBandInteraction:
+
+    def __init__(self, pair_potential, period, window, far_field=True, periodic_kernel=None, mesh_spacing=None):
+        """
+        Interaction energy and gradient for electrons in a channel along y with period L, in O(N log N).
+        Pairs closer than window along y (near field) are summed directly, after sorting the electrons by y.
+        Pairs beyond the window interact through a 1D mesh along y. For |dx| << |dy| the interaction is expanded as
+            phi(R) = g0(dy) + 1/2 dx**2 g1(dy),    g0 = phi(|dy|), g1 = 1/R dphi/dR at R = |dy|,
+        and since dx**2 = xi**2 - 2 xi xj + xj**2, each term is a convolution of the electron density (or its first
+        and second moment in x) along y with g0 or g1. The electrons are assigned to the mesh with linear weights and
+        the convolutions are done by FFT. The mesh kernels vanish well inside the window, and for the few near pairs
+        that still reach the kernels through the linear weights the mesh interaction is subtracted exactly. The mesh
+        therefore only approximates the pairs beyond the window, with a relative error of order (dx / window)**4.
+        :param pair_potential: Function that returns (phi, 1/R dphi/dR) in eV for order=1, e.g. solver.pair_potential
+        :param period: Period L in m, e.g. solver.box_y_length
+        :param window: Width of the near field in m. Must be smaller than L/2 and a few times larger than the width of
+        the channel.
+        :param far_field: Include the pairs beyond the window with the mesh. If False they are neglected, which is only
+        accurate for a screened interaction and a window of many screening lengths.
+        :param periodic_kernel: PeriodicKernel instance, to include the interaction with all periodic images. The
+        images are included in g0 of the far field. None for the nearest image only.
+        :param mesh_spacing: Spacing of the far field mesh in m. Defaults to window / 64.
+        """
+        if window >= period / 2.:
+            raise ValueError("The window must be smaller than half the period.")
+        self.pair_potential = pair_potential
+        self.period = period
+        self.window = window
+        self.far_field = far_field
+        self.periodic_kernel = periodic_kernel
+
+        mesh_spacing = window / 64. if mesh_spacing is None else mesh_spacing
+        self.M = max(int(np.ceil(period / mesh_spacing)), 4)
+        self.h = period / self.M
+        if far_field:
+            if self.h >= window / 5.:
+                raise ValueError("The mesh spacing must be smaller than window / 5.")
+            # The kernels are zero below window - 2.5h, which a pair beyond the window never reaches with linear
+            # weights. Near pairs closer than window - 5h don't reach the kernels at all.
+            self.inner = window - 2.5 * self.h
+            m = np.arange(self.M)
+            z = self.h * np.minimum(m, self.M - m)
+            g0, g1 = pair_potential(np.maximum(z, self.inner), order=1)
+            if periodic_kernel is not None:
+                g0 = g0 + periodic_kernel.evaluate(np.zeros(self.M), z)[0]
+            inside = z < self.inner
+            g0[inside], g1[inside] = 0., 0.
+            self.G = [g0, g1]
+            self.G_hat = [np.fft.rfft(g) for g in self.G]
+            # G[d + M + 1 - k] for d in (-M, M) and k in {0, 1, 2}, such that the near pairs need no modulo
+            self.G_padded = [np.concatenate((g[-1:], g, g, g[:1])) for g in self.G]
+
+    def near_pairs(self, ys):
+        """
+        Pairs of electrons that are closer than window along y, each pair once.
+        :param ys: 1D array of y-coordinates in [-L/2, L/2), sorted in increasing order
+        :return: i, j (indices into ys), and yi - yj of the nearest image
+        """
+        N = len(ys)
+        i_list, j_list, dy_list = list(), list(), list()
+        active = np.arange(N)
+        k = 1
+        while len(active) and k < N:
+            j = active + k
+            wrapped = j >= N
+            j[wrapped] -= N
+            dy = ys[j] - ys[active] + self.period * wrapped
+            # Separations only grow with k, so electrons without partners in the window are done
+            within = dy < self.window
+            active, j, dy = active[within], j[within], dy[within]
+            i_list.append(active)
+            j_list.append(j)
+            dy_list.append(-dy)
+            k += 1
+        if not i_list:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        return np.concatenate(i_list), np.concatenate(j_list), np.concatenate(dy_list)
+
+    def mesh_pairs(self, d, fi, fj):
+        """
+        Mesh interaction of pairs of unit charges with linear weights through g0 and g1, and its derivatives.
+        :param d: Difference of the cell indices of the pairs, -M < d < M
+        :param fi: Fractional position of the first electron in its cell
+        :param fj: Fractional position of the second electron in its cell
+        :return: For g0 and g1: lists with the interaction, its derivative with respect to fi and with respect to fj
+        """
+        index = d + self.M
+        fifj = fi * fj
+        value, dfi, dfj = list(), list(), list()
+        for g in self.G_padded:
+            Gm, Gd, Gp = g[index], g[index + 1], g[index + 2]
+            A, B = Gp - Gd, Gm - Gd
+            C = -A - B
+            value.append(Gd + fi * A + fj * B + fifj * C)
+            dfi.append(A + fj * C)
+            dfj.append(B + fi * C)
+        return value, dfi, dfj
+
+    def Vee_and_grad(self, xi, yi):
+        """
+        Electron-electron interaction energy and its gradient.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        N = len(xi)
+        yi = -self.period / 2. + (yi + self.period / 2.) % self.period
+        # Electrons hardly change order between iterations, which makes the stable sort nearly linear
+        order = np.argsort(yi, kind='stable')
+        xs, ys = xi[order], yi[order]
+
+        i, j, dy = self.near_pairs(ys)
+        dx = xs[i] - xs[j]
+        phi, dphi = self.pair_potential(np.sqrt(dx ** 2 + dy ** 2), order=1)
+        Fx, Fy = dphi * dx, dphi * dy
+        if self.periodic_kernel is not None:
+            psi, dpsi_dx, dpsi_dy = self.periodic_kernel.evaluate(dx, dy)
+            phi, Fx, Fy = phi + psi, Fx + dpsi_dx, Fy + dpsi_dy
+        energy = np.sum(phi)
+        gx = np.zeros(N) + np.bincount(i, Fx, N) - np.bincount(j, Fx, N)
+        gy = np.zeros(N) + np.bincount(i, Fy, N) - np.bincount(j, Fy, N)
+
+        if self.far_field:
+            s = (ys + self.period / 2.) / self.h
+            cell = np.floor(s)
+            f = s - cell
+            cell = cell.astype(int) % self.M
+            right = (cell + 1) % self.M
+
+            # The expansion in dx is unbounded for electrons far outside the channel, which a line search can try. The
+            # mesh therefore uses x clipped to the channel, which leaves electrons inside the channel unchanged.
+            center = np.median(xs)
+            xm = np.clip(xs, center - 0.5 * self.window, center + 0.5 * self.window)
+            gx_mesh = np.zeros(N)
+
+            # Density and its first and second moment in x on the mesh
+            rho = [np.bincount(cell, (1 - f) * xm ** n, self.M) + np.bincount(right, f * xm ** n, self.M)
+                   for n in range(3)]
+            rho_hat = [np.fft.rfft(r) for r in rho]
+            Phi0 = np.fft.irfft(rho_hat[0] * self.G_hat[0], self.M)
+            Phi1 = np.fft.irfft(rho_hat[0] * self.G_hat[1], self.M)
+            Psi1 = np.fft.irfft(rho_hat[1] * self.G_hat[1], self.M)
+            Phi2 = np.fft.irfft(rho_hat[2] * self.G_hat[1], self.M)
+
+            # The kernels vanish at separations of 0 and h, so there is no interaction of an electron with itself
+            energy += 0.5 * np.dot(rho[0], Phi0) + 0.5 * np.dot(rho[2], Phi1) - 0.5 * np.dot(rho[1], Psi1)
+            gx_mesh += (1 - f) * (xm * Phi1[cell] - Psi1[cell]) + f * (xm * Phi1[right] - Psi1[right])
+            Q = [Phi0 + 0.5 * Phi2, Phi1, Psi1]
+            Q_left = Q[0][cell] + 0.5 * xm ** 2 * Q[1][cell] - xm * Q[2][cell]
+            Q_right = Q[0][right] + 0.5 * xm ** 2 * Q[1][right] - xm * Q[2][right]
+            gy += (Q_right - Q_left) / self.h
+
+            # Subtract the mesh interaction of the near pairs that reach the kernels, which were summed exactly
+            shell = np.abs(dy) > self.window - 5 * self.h
+            i, j = i[shell], j[shell]
+            value, dfi, dfj = self.mesh_pairs(cell[i] - cell[j], f[i], f[j])
+            dx = xm[i] - xm[j]
+            half_dx2 = 0.5 * dx ** 2
+            energy -= np.sum(value[0]) + np.dot(half_dx2, value[1])
+            Fx = dx * value[1]
+            gx_mesh -= np.bincount(i, Fx, N) - np.bincount(j, Fx, N)
+            gy -= (np.bincount(i, dfi[0] + half_dx2 * dfi[1], N) + np.bincount(j, dfj[0] + half_dx2 * dfj[1], N)) / self.h
+            gx += gx_mesh * (xm == xs)
+
+        gradient = np.zeros(2 * N)
+        gradient[2 * order] = gx
+        gradient[2 * order + 1] = gy
+        return energy, gradient
@@ -0,0 +1,169 @@
+"""
+Thread-parallel evaluation of the electron-electron interaction of a single configuration. SolverPool only helps with
+many independent minimizations, whereas here one evaluation of the interaction energy and its gradient is split into
+blocks of rows of the N x N pair matrices. The blocks are evaluated by a pool of threads: NumPy releases the GIL in
+most array operations on large arrays, such that the blocks can run concurrently. How well this scales with the number
+of threads depends on the memory bandwidth and on the pair potential, so measure it for your machine. A block contains
+all partners of its electrons, so every block writes its own slice of the gradient and there is no reduction over the
+threads. The energy alone (Vee) is evaluated without the derivatives of the pair potential.
+
+    solver = TrapAreaSolver(x, y, -V, threads=8)
+    res = minimize(solver.Vtotal_and_grad, r0, jac=True, method='CG')
+
+The block size is chosen such that the pair matrices of a block fit in the cache, which also makes the evaluation on a
+single thread faster than with the full N x N matrices for large N. All pair matrices of a block, including the
+interaction and its derivative, are written into buffers that each thread allocates once, so the evaluation of a block
+does not allocate arrays of the block size (except inside a TabulatedKernel or PeriodicKernel lookup).
+"""
+import os, threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class ThreadedInteraction:
+
+    def __init__(self, pair_potential, threads=None, block_pairs=2 ** 16, period=None, periodic_kernel=None):
+        """
+        Interaction energy and gradient from row blocks of the pair matrices, evaluated by a pool of threads.
+        :param pair_potential: Function that returns (phi, 1/R dphi/dR) in eV for order=1, e.g. solver.pair_potential.
+        It must accept out=(phi,) for order=0 and out=(phi, dphi) for order=1 to write the results into preallocated
+        arrays.
+        :param threads: Number of threads. Defaults to the number of cores.
+        :param block_pairs: Approximate number of pairs in a block. The number of rows of a block is block_pairs / N,
+        but there are at least 4 blocks for every thread, such that the threads finish at about the same time.
+        :param period: Period in the y-direction for the ResonatorSolver, where the separation in y is that of the
+        nearest image. None for no periodic boundary conditions.
+        :param periodic_kernel: PeriodicKernel instance, to include the interaction with all other periodic images
+        """
+        self.pair_potential = pair_potential
+        self.threads = os.cpu_count() if threads is None else threads
+        self.block_pairs = block_pairs
+        self.period = period
+        self.periodic_kernel = periodic_kernel
+        self.executor = None
+        # Preallocated pair matrices of each thread, see workspace
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # Threads and thread-local buffers can't be pickled, they are created again when needed
+        state = dict(self.__dict__)
+        state['executor'] = None
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def close(self):
+        """
+        Stop the threads. They are started again by the next evaluation.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def blocks(self, N):
+        """
+        Row ranges of the blocks for N electrons.
+        :return: List of (start, stop)
+        """
+        rows = max(1, min(self.block_pairs // max(N, 1), -(-N // (4 * self.threads))))
+        return [(start, min(start + rows, N)) for start in range(0, N, rows)]
+
+    def workspace(self, rows, N):
+        """
+        Pair matrices of the calling thread with shape (rows, N). They are allocated once per thread and only again
+        when the number of electrons or the block size changes.
+        """
+        if getattr(self.local, 'shape', None) != (rows, N):
+            self.local.shape = (rows, N)
+            # dx, dy, R, phi, dphi, a work matrix for products and psi, dpsi/d(dx), dpsi/d(dy) of the periodic kernel
+            self.local.matrices = [np.empty((rows, N)) for k in range(6 if self.periodic_kernel is None else 9)]
+        return self.local.matrices
+
+    def evaluate_block(self, xi, yi, start, stop, block_rows, gradient=None):
+        """
+        Interaction of the electrons start, ..., stop - 1 with all electrons. Their gradient is written to gradient.
+        :param block_rows: Largest number of rows of a block, which sets the size of the workspace
+        :param gradient: 1D array for the gradient of all electrons, or None to evaluate the energy only
+        :return: The energy of the block, half the interaction of its electrons
+        """
+        diagonal = np.arange(stop - start)
+        matrices = [matrix[:stop - start] for matrix in self.workspace(block_rows, len(xi))]
+        dx, dy, R, phi, dphi, work = matrices[:6]
+
+        np.subtract(xi[start:stop, np.newaxis], xi[np.newaxis, :], out=dx)
+        np.subtract(yi[start:stop, np.newaxis], yi[np.newaxis, :], out=dy)
+        if self.period is not None:
+            np.divide(dy, self.period, out=R)
+            np.round(R, out=R)
+            R *= self.period
+            dy -= R
+        np.multiply(dx, dx, out=R)
+        np.multiply(dy, dy, out=work)
+        R += work
+        np.sqrt(R, out=R)
+        R[diagonal, start + diagonal] = 1
+
+        if gradient is None:
+            self.pair_potential(R, order=0, out=(phi,))
+        else:
+            self.pair_potential(R, order=1, out=(phi, dphi))
+            dphi[diagonal, start + diagonal] = 0
+        phi[diagonal, start + diagonal] = 0
+
+        if self.periodic_kernel is not None:
+            # The interaction of an electron with its own images is a constant
+            psi, dpsi_dx, dpsi_dy = self.periodic_kernel.evaluate(dx, dy, out=matrices[6:])
+            for matrix in [psi, dpsi_dx, dpsi_dy]:
+                matrix[diagonal, start + diagonal] = 0
+            phi += psi
+        if gradient is None:
+            return 0.5 * np.sum(phi)
+
+        np.multiply(dphi, dx, out=work)
+        if self.periodic_kernel is not None:
+            work += dpsi_dx
+        np.sum(work, axis=1, out=gradient[2 * start:2 * stop:2])
+        np.multiply(dphi, dy, out=work)
+        if self.periodic_kernel is not None:
+            work += dpsi_dy
+        np.sum(work, axis=1, out=gradient[2 * start + 1:2 * stop:2])
+        return 0.5 * np.sum(phi)
+
+    def map_blocks(self, xi, yi, gradient=None):
+        """
+        Evaluate all blocks, on the pool of threads if there is more than one.
+        :return: Interaction energy (eV)
+        """
+        blocks = self.blocks(len(xi))
+        block_rows = blocks[0][1] if blocks else 0
+        if self.threads <= 1 or len(blocks) == 1:
+            return sum(self.evaluate_block(xi, yi, start, stop, block_rows, gradient) for start, stop in blocks)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        futures = [self.executor.submit(self.evaluate_block, xi, yi, start, stop, block_rows, gradient)
+                   for start, stop in blocks]
+        return sum(future.result() for future in futures)
+
+    def Vee(self, xi, yi):
+        """
+        Electron-electron interaction energy, without the gradient.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: Interaction energy (eV)
+        """
+        xi, yi = np.asarray(xi, dtype=np.float64), np.asarray(yi, dtype=np.float64)
+        return self.map_blocks(xi, yi)
+
+    def Vee_and_grad(self, xi, yi):
+        """
+        Electron-electron interaction energy and its gradient.
+        :param xi: a 1D array
+        :param yi: a 1D array
+        :return: Interaction energy (eV), 1D-array of size(xi) + size(yi) with the gradient (eV/m)
+        """
+        xi, yi = np.asarray(xi, dtype=np.float64), np.asarray(yi, dtype=np.float64)
+        gradient = np.zeros(2 * len(xi))
+        return self.map_blocks(xi, yi, gradient), gradient
@@ -0,0 +1,166 @@
+"""
+Asynchronous rendering of electron configurations, e.g. to make a movie of a minimization.
+
+The background potential and the electrode outline are rasterized once, when the renderer is started. After that only
+the electron positions are sent to a separate worker process, which updates the figure and either writes a PNG for
+every frame or pipes the raw frames straight into ffmpeg. The optimizer does not wait for matplotlib.
+
+    with FrameRenderer(save_path, xext, yext, Uext(Xext, Yext), filename_out="movie.mp4", fps=25) as renderer:
+        for xk in trajectory:
+            renderer.render(xk[::2], xk[1::2])
+"""
+import os, queue, subprocess, multiprocessing
+import numpy as np
+from termcolor import cprint
+
+
+def render_frames(frames, settings):
+    """
+    Worker process: draw every set of electron positions in frames until None is received.
+    :param frames: multiprocessing.Queue with tuples (frame number, x, y) in m
+    :param settings: Dictionary with the background, outline and figure options, see FrameRenderer
+    :return: None
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    try:
+        from Common import common
+        common.configure_axes(12)
+    except:
+        pass
+
+    fig = Figure(figsize=settings['figsize'], dpi=settings['dpi'])
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    if settings['background'] is not None:
+        xext, yext = settings['xext'], settings['yext']
+        mesh = ax.pcolormesh(xext * 1E6, yext * 1E6, settings['background'], cmap=settings['cmap'],
+                             vmin=settings['clim'][0], vmax=settings['clim'][1])
+        ax.set_xlim(np.min(xext) * 1E6, np.max(xext) * 1E6)
+        ax.set_ylim(np.min(yext) * 1E6, np.max(yext) * 1E6)
+        fig.colorbar(mesh, ax=ax)
+
+    for x, y in settings['outline']:
+        ax.plot(x, y, color='black', alpha=0.6, lw=0.5)
+
+    electrons, = ax.plot([], [], 'o', color='deepskyblue')
+    ax.set_xlabel("$x$ ($\mu$m)")
+    ax.set_ylabel("$y$ ($\mu$m)")
+
+    video = None
+    if settings['filename_out'] is not None:
+        # Raw RGBA frames go to ffmpeg's stdin. libx264 with yuv420p requires an even number of pixels.
+        width, height = canvas.get_width_height()
+        width, height = width - width % 2, height - height % 2
+        fig.set_size_inches((width + 0.5) / settings['dpi'], (height + 0.5) / settings['dpi'])
+        width, height = canvas.get_width_height()
+        command = [settings['ffmpeg'], '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                   '-s', '%dx%d' % (width, height), '-r', '%g' % settings['fps'], '-i', '-',
+                   '-an', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', settings['filename_out']]
+        video = subprocess.Popen(command, stdin=subprocess.PIPE, cwd=settings['save_path'])
+    fig.tight_layout()
+
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        number, x, y = frame
+        electrons.set_data(x * 1E6, y * 1E6)
+        canvas.draw()
+        if video is not None:
+            video.stdin.write(canvas.buffer_rgba())
+        else:
+            fig.savefig(os.path.join(settings['save_path'], settings['filenames'] % number), dpi=settings['dpi'])
+
+    if video is not None:
+        video.stdin.close()
+        video.wait()
+
+
+class FrameRenderer:
+
+    def __init__(self, save_path, xext=None, yext=None, background=None, outline=None, filename_out=None, fps=10,
+                 filenames="%05d.png", figsize=(6.5, 3.), dpi=150, clim=(-0.75, 0), cmap='RdYlBu', max_queued=1000,
+                 ffmpeg='ffmpeg'):
+        """
+        Starts a worker process that renders frames of electron positions on top of a fixed background.
+        :param save_path: Directory in which the frames or the movie are saved
+        :param xext: 1D array with the x-coordinates of the background in m
+        :param yext: 1D array with the y-coordinates of the background in m
+        :param background: 2D array of shape (len(yext), len(xext)) with the potential in eV, e.g. Uext(Xext, Yext).
+        None for no background.
+        :param outline: List of (x, y) arrays with the electrode outline in um, e.g. from get_dxf_polylines
+        :param filename_out: File name of the movie, e.g. "movie.mp4". The frames are piped into ffmpeg and no PNGs are
+        written. If None, every frame is saved as a PNG with file name filenames % frame number.
+        :param fps: Frames per second of the movie
+        :param filenames: Signature of the file names of the PNGs, e.g. "%05d.png"
+        :param figsize: Figure size in inches
+        :param dpi: Resolution of the frames
+        :param clim: Color limits of the background in eV
+        :param cmap: Name of the colormap of the background
+        :param max_queued: Maximum number of frames waiting to be rendered. If the worker falls behind further, new
+        frames are dropped instead of slowing down the optimizer. None for no limit, which is only safe for short
+        runs since the queued frames are kept in memory.
+        :param ffmpeg: ffmpeg executable
+        """
+        self.save_path = save_path
+        self.filename_out = filename_out
+        self.dropped_frames = 0
+        self.frame_counter = 0
+        self.frames = multiprocessing.Queue(0 if max_queued is None else max_queued)
+
+        settings = {'save_path' : save_path, 'xext' : xext, 'yext' : yext, 'background' : background,
+                    'outline' : list() if outline is None else outline, 'filename_out' : filename_out, 'fps' : fps,
+                    'filenames' : filenames, 'figsize' : figsize, 'dpi' : dpi, 'clim' : clim, 'cmap' : cmap,
+                    'ffmpeg' : ffmpeg}
+        self.process = multiprocessing.Process(target=render_frames, args=(self.frames, settings))
+        self.process.daemon = True
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def render(self, x, y, frame=None):
+        """
+        Queue a frame with electrons at (x, y). Returns immediately.
+        :param x: 1D array of electron x-coordinates in m
+        :param y: 1D array of electron y-coordinates in m
+        :param frame: Frame number, used for the file name of the PNG. Defaults to a counter.
+        :return: None
+        """
+        if self.process is None:
+            raise RuntimeError("The renderer has already been closed.")
+        if not self.process.is_alive():
+            raise RuntimeError("The rendering process exited with code %s" % self.process.exitcode)
+        frame = self.frame_counter if frame is None else frame
+        self.frame_counter += 1
+        try:
+            self.frames.put_nowait((frame, np.array(x, dtype=np.float64), np.array(y, dtype=np.float64)))
+        except queue.Full:
+            self.dropped_frames += 1
+
+    def close(self):
+        """
+        Wait until all queued frames are rendered and the movie is written, and stop the worker process.
+        """
+        if self.process is None:
+            return
+        while self.process.is_alive():
+            try:
+                self.frames.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.process.join()
+        if self.process.exitcode != 0:
+            # Nobody reads the frames that are still queued, don't wait for them to be flushed at exit
+            self.frames.cancel_join_thread()
+            cprint("Rendering process exited with code %d" % self.process.exitcode, "red")
+        if self.dropped_frames:
+            cprint("%d frames were dropped because rendering fell behind" % self.dropped_frames, "yellow")
+        self.process = None
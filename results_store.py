@@ -0,0 +1,285 @@
+"""
+Append-only store for simulation results, e.g. the equilibrium configurations of a voltage sweep.
+
+Scalar parameters (voltages, number of electrons, temperature, energy, ...) are kept in an indexed SQLite table. Arrays,
+such as the electron positions, are appended to one binary file per name and are only read, as memory maps, when they
+are requested. Appending a result takes constant time, and queries only touch the table:
+
+    store = ResultsStore(save_path)
+    store.append(N=200, T=0.1, resV=0.6, trapV=0.3, energy=res['fun'], positions=res['x'])
+    ids = store.query(order_by='energy', N=200)
+    positions = store.load('positions', ids)
+"""
+import os, re, sqlite3
+import numpy as np
+
+# Storage classes for the scalar columns
+sqlite_types = {int : 'INTEGER', float : 'REAL', str : 'TEXT'}
+
+
+def to_scalar(value):
+    """
+    Convert value to a Python int, float or str, or return None if it should be stored as an array.
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return float(value)
+    if isinstance(value, str):
+        return value
+    if isinstance(value, np.ndarray) and value.ndim == 0 and value.dtype.kind in 'biuf':
+        return to_scalar(value[()])
+    return None
+
+
+def quote(name):
+    """
+    Quote a column name for SQL, such that names like order or index can be used.
+    """
+    return '"%s"' % name
+
+
+class ResultsStore:
+
+    def __init__(self, path, index_length=8):
+        """
+        Open or create a results store in the directory path.
+        :param path: Directory of the store. It contains results.sqlite and a <name>.bin file for every array name.
+        :param index_length: 1D arrays of at most this many numbers, such as a vector of electrode voltages, are also
+        stored as indexed scalar columns <name>_0, <name>_1, ... such that they can be queried.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.index_length = index_length
+        self.connection = sqlite3.connect(os.path.join(path, 'results.sqlite'))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS arrays (id INTEGER, name TEXT, offset INTEGER, "
+                                "dtype TEXT, shape TEXT, PRIMARY KEY (name, id))")
+        self.connection.commit()
+
+        # Column names in SQLite are case insensitive: the keys are lower-cased, the values are the names as created
+        self.columns = dict((row[1].lower(), row[1]) for row in self.connection.execute("PRAGMA table_info(results)"))
+        self.arrays = set(row[0].lower() for row in self.connection.execute("SELECT DISTINCT name FROM arrays"))
+        self.files = dict()
+        self.maps = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        """
+        Commit and close the database and the array files.
+        """
+        for f in self.files.values():
+            f.close()
+        self.files, self.maps = dict(), dict()
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+    def check_name(self, name):
+        if not name.isidentifier():
+            raise ValueError("%s is not a valid name for a result. Use letters, digits and underscores." % name)
+
+    def add_column(self, name, value):
+        self.check_name(name)
+        self.connection.execute("ALTER TABLE results ADD COLUMN %s %s" % (quote(name), sqlite_types[type(value)]))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS %s ON results (%s)" % (quote('index_' + name), quote(name)))
+        self.columns[name.lower()] = name
+
+    def append_array(self, result_id, name, value):
+        self.check_name(name)
+        value = np.ascontiguousarray(value)
+        if value.dtype.hasobject:
+            raise ValueError("Can not store %s, arrays of Python objects are not supported." % name)
+        if name not in self.files:
+            self.files[name] = open(os.path.join(self.path, '%s.bin' % name), 'ab')
+        f = self.files[name]
+        # Align every array to 8 bytes, such that it can be viewed without copying
+        offset = f.seek(0, os.SEEK_END)
+        if offset % 8:
+            f.write(b'\0' * (8 - offset % 8))
+            offset += 8 - offset % 8
+        f.write(value.tobytes())
+        f.flush()
+        self.arrays.add(name.lower())
+        self.connection.execute("INSERT INTO arrays (id, name, offset, dtype, shape) VALUES (?, ?, ?, ?, ?)",
+                                (result_id, name, offset, value.dtype.str, ','.join('%d' % n for n in value.shape)))
+
+    def append(self, **kwargs):
+        """
+        Append a result. Scalars (int, float, bool, str) are stored in indexed columns. Everything else is converted to
+        a numpy array and appended to <name>.bin.
+        :param kwargs: Parameters and data of the result, e.g. N=200, energy=res['fun'], positions=res['x']
+        :return: id of the result
+        """
+        scalars, arrays = dict(), dict()
+        for name, value in kwargs.items():
+            self.check_name(name)
+            if name.lower() == 'id':
+                raise ValueError("id is reserved for the id of the result.")
+            scalar = to_scalar(value)
+            if scalar is not None:
+                scalars[name] = scalar
+            else:
+                arrays[name] = np.asarray(value)
+
+        # The columns <name>_0, <name>_1, ... are reserved for the array name
+        array_names = self.arrays | set(name.lower() for name in arrays)
+        for name in scalars:
+            array_column = re.match(r'(\w+)_\d+$', name)
+            if array_column is not None and array_column.group(1).lower() in array_names:
+                raise ValueError("%s collides with the indexed columns of the array %s." %
+                                 (name, array_column.group(1)))
+        for name, value in arrays.items():
+            if value.ndim == 1 and value.dtype.kind in 'biuf' and len(value) <= self.index_length:
+                for k, element in enumerate(value):
+                    column = '%s_%d' % (name, k)
+                    if column.lower() in self.columns and name.lower() not in self.arrays:
+                        raise ValueError("The indexed columns of the array %s collide with the column %s." %
+                                         (name, self.columns[column.lower()]))
+                    scalars[column] = to_scalar(element)
+
+        # Column names are case insensitive
+        columns = dict()
+        for name in scalars:
+            if name.lower() in columns:
+                raise ValueError("%s and %s are stored in the same column." % (columns[name.lower()], name))
+            columns[name.lower()] = name
+
+        for name, value in scalars.items():
+            if name.lower() not in self.columns:
+                self.add_column(name, value)
+
+        names = list(scalars.keys())
+        cursor = self.connection.execute("INSERT INTO results (%s) VALUES (%s)" %
+                                         (', '.join(quote(name) for name in names), ', '.join('?' for name in names))
+                                         if names else
+                                         "INSERT INTO results DEFAULT VALUES", [scalars[name] for name in names])
+        result_id = cursor.lastrowid
+        for name, value in arrays.items():
+            self.append_array(result_id, name, value)
+        self.connection.commit()
+        return result_id
+
+    def query(self, where=None, arguments=(), order_by=None, descending=False, limit=None, **equal):
+        """
+        Find results by their scalar parameters. Only the indexed table is read.
+        :param where: SQL condition on the columns, e.g. "T < ? AND energy < ?"
+        :param arguments: Values for the placeholders in where
+        :param order_by: Name of the column to sort by, e.g. 'energy'
+        :param descending: Sort in descending order
+        :param limit: Maximum number of results
+        :param equal: Columns that must be equal to a value, e.g. N=200
+        :return: List of ids of the results
+        """
+        conditions, values = list(), list()
+        if where is not None:
+            conditions.append("(%s)" % where)
+            values += list(arguments)
+        for name, value in equal.items():
+            if name.lower() not in self.columns:
+                return list()
+            conditions.append("%s = ?" % quote(name))
+            values.append(to_scalar(value))
+
+        sql = "SELECT id FROM results"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if order_by is not None:
+            self.check_name(order_by)
+            sql += " ORDER BY %s %s" % (quote(order_by), "DESC" if descending else "ASC")
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        return [row[0] for row in self.connection.execute(sql, values)]
+
+    def parameters(self, ids=None, names=None):
+        """
+        Load scalar columns.
+        :param ids: List of ids, e.g. from query. None for all results.
+        :param names: List of column names. None for all columns.
+        :return: Dictionary with an array for every column, in the order of ids
+        """
+        names = ['id'] + [name for name in (sorted(self.columns.values()) if names is None else names)
+                          if name.lower() != 'id']
+        for name in names:
+            self.check_name(name)
+        rows = dict((row[0], row) for row in self.connection.execute("SELECT %s FROM results" %
+                                                                     ', '.join(quote(name) for name in names)))
+        ids = sorted(rows.keys()) if ids is None else ids
+        return dict((name, np.array([rows[result_id][k] for result_id in ids]))
+                    for k, name in enumerate(names))
+
+    def array_map(self, name, size):
+        # Memory map of <name>.bin. It is opened again if the file has grown since it was mapped.
+        if name not in self.maps or len(self.maps[name]) < size:
+            self.maps[name] = np.memmap(os.path.join(self.path, '%s.bin' % name), dtype=np.uint8, mode='r')
+        return self.maps[name]
+
+    def load(self, name, ids):
+        """
+        Load an array for a list of results. Only these arrays are read from disk.
+        :param name: Name of the array, e.g. 'positions'
+        :param ids: List of ids, e.g. from query
+        :return: List of read-only arrays, in the order of ids. None for results without this array.
+        """
+        self.check_name(name)
+        rows = dict()
+        for chunk in range(0, len(ids), 500):
+            chunk_ids = list(ids[chunk:chunk + 500])
+            rows.update((row[0], row[1:]) for row in self.connection.execute(
+                "SELECT id, offset, dtype, shape FROM arrays WHERE name = ? AND id IN (%s)" %
+                ', '.join('?' for result_id in chunk_ids), [name] + chunk_ids))
+
+        arrays = list()
+        for result_id in ids:
+            if result_id not in rows:
+                arrays.append(None)
+                continue
+            offset, dtype, shape = rows[result_id]
+            dtype = np.dtype(dtype)
+            shape = tuple(int(n) for n in shape.split(',')) if shape else ()
+            nbytes = dtype.itemsize * int(np.prod(shape))
+            data = self.array_map(name, offset + nbytes)[offset:offset + nbytes]
+            arrays.append(data.view(dtype).reshape(shape))
+        return arrays
+
+    def get(self, result_id):
+        """
+        Load all parameters and arrays of a single result.
+        :param result_id: id of the result
+        :return: Dictionary with the parameters and arrays
+        """
+        names = sorted(self.columns.values())
+        row = self.connection.execute("SELECT %s FROM results WHERE id = ?" % ', '.join(quote(name) for name in names),
+                                      (result_id,)).fetchone()
+        if row is None:
+            raise KeyError("No result with id %d" % result_id)
+        result = dict((name, value) for name, value in zip(names, row) if value is not None)
+        for (name,) in self.connection.execute("SELECT name FROM arrays WHERE id = ?", (result_id,)).fetchall():
+            result[name] = self.load(name, [result_id])[0]
+        return result
+
+    def import_npz(self, filenames):
+        """
+        Append results that were saved as separate .npz files, e.g. by an older version of PostProcess.write2file.
+        :param filenames: List of .npz file names
+        :return: List of ids of the new results
+        """
+        ids = list()
+        for filename in filenames:
+            with np.load(filename) as data:
+                ids.append(self.append(**dict((name, data[name]) for name in data.files)))
+        return ids
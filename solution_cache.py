@@ -0,0 +1,196 @@
+"""
+Memoization of minimizations on local disk. Results are stored under a hash of everything that determines them: the
+potential data and parameters of the solver, the initial condition and the minimizer options. Running the same
+minimization again, in another notebook or in another job that shares the cache directory, returns the stored result.
+
+    cache = SolutionCache(cache_path)
+    res = cache.minimize(solver.Vtotal, r0, method='CG', jac=solver.grad_total)
+    res = cache.call(solver.parallel_perturb_and_solve, solver.Vtotal, 100, 0.1, res,
+                     {'method' : 'CG', 'jac' : solver.grad_total}, pool=pool, seed=0)
+
+The least recently used results are deleted when the cache grows beyond max_size.
+"""
+import os, types, pickle, hashlib
+import numpy as np
+from scipy.optimize import minimize
+from termcolor import cprint
+
+# Change this when the results of the solvers change, such that old results are not used anymore
+cache_version = 1
+
+# Attributes of the solvers that are caches of intermediate results or only change how they are evaluated, not
+# parameters of the problem
+transient_attributes = {'hessian_cache', 'threaded'}
+
+# Arguments that do not change the result, such as a SolverPool
+ignored_arguments = {'pool', 'verbose', 'callback'}
+
+
+def update_fingerprint(digest, obj, visited):
+    """
+    Feed a description of obj into the hashlib object digest. Arrays are hashed by dtype, shape and content, functions
+    by their name and code, bound methods by their name and their object, and other objects by their attributes.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        digest.update(('%s:%r;' % (type(obj).__name__, obj)).encode())
+    elif isinstance(obj, np.ndarray):
+        digest.update(('ndarray:%s:%s;' % (obj.dtype.str, obj.shape)).encode())
+        if obj.dtype.hasobject:
+            for element in obj.ravel():
+                update_fingerprint(digest, element, visited)
+        else:
+            digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        digest.update(('%s:%d;' % (type(obj).__name__, len(obj))).encode())
+        for element in obj:
+            update_fingerprint(digest, element, visited)
+    elif isinstance(obj, dict):
+        digest.update(('dict:%d;' % len(obj)).encode())
+        for key in sorted(obj.keys(), key=repr):
+            update_fingerprint(digest, key, visited)
+            update_fingerprint(digest, obj[key], visited)
+    elif isinstance(obj, types.MethodType):
+        digest.update(('method:%s;' % obj.__name__).encode())
+        update_fingerprint(digest, obj.__self__, visited)
+    elif isinstance(obj, types.FunctionType):
+        digest.update(('function:%s.%s;' % (obj.__module__, obj.__qualname__)).encode())
+        digest.update(obj.__code__.co_code)
+        update_fingerprint(digest, [c for c in obj.__code__.co_consts if not isinstance(c, types.CodeType)], visited)
+        if obj.__closure__ is not None:
+            update_fingerprint(digest, [cell.cell_contents for cell in obj.__closure__], visited)
+    elif isinstance(obj, (types.BuiltinFunctionType, type)):
+        digest.update(('callable:%s.%s;' % (getattr(obj, '__module__', ''), obj.__qualname__)).encode())
+    elif id(obj) in visited:
+        digest.update(b'cycle;')
+    elif hasattr(obj, '__dict__'):
+        visited.add(id(obj))
+        attributes = dict((key, value) for key, value in vars(obj).items() if key not in transient_attributes)
+        digest.update(('object:%s;' % type(obj).__name__).encode())
+        update_fingerprint(digest, attributes, visited)
+    else:
+        digest.update(('%s:%r;' % (type(obj).__name__, obj)).encode())
+
+
+def fingerprint(*objects):
+    """
+    Hash of a set of objects, e.g. a solver, an initial condition and minimizer options, see update_fingerprint.
+    :return: Hexadecimal string
+    """
+    digest = hashlib.sha256(('solution_cache %d;' % cache_version).encode())
+    update_fingerprint(digest, objects, set())
+    return digest.hexdigest()
+
+
+class SolutionCache:
+
+    def __init__(self, path, max_size=1E9, verbose=False):
+        """
+        Cache of minimization results on disk.
+        :param path: Directory of the cache. It can be shared between processes and notebooks.
+        :param max_size: Maximum size of the cache in bytes. The least recently used results are deleted above this.
+        :param verbose: Print a message for every result that is loaded from the cache
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size
+        self.verbose = verbose
+        self.hits, self.misses = 0, 0
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self):
+        return [entry for entry in os.scandir(self.path) if entry.name.endswith('.pkl')]
+
+    def filename(self, key):
+        return os.path.join(self.path, '%s.pkl' % key)
+
+    def get(self, key):
+        """
+        Load the result stored under key.
+        :param key: Key, see fingerprint
+        :return: The result, or None if there is no result for this key
+        """
+        try:
+            with open(self.filename(key), 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # The modification time of a file is the time it was last used, see evict
+        try:
+            os.utime(self.filename(key))
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """
+        Store result under key, and delete the least recently used results if the cache is too large.
+        :param key: Key, see fingerprint
+        :param result: Result, e.g. output of scipy.optimize.minimize. It must be picklable.
+        :return: None
+        """
+        # Write to a temporary file first, such that other processes never read a partial result
+        temporary = self.filename(key) + '.%d.tmp' % os.getpid()
+        with open(temporary, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.size += os.path.getsize(temporary)
+        os.replace(temporary, self.filename(key))
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used results until the cache is smaller than max_size.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Delete all results in the cache.
+        """
+        for entry in self.entries():
+            os.remove(entry.path)
+        self.size = 0
+
+    def call(self, function, *args, **kwargs):
+        """
+        Evaluate function(*args, **kwargs), or load the result if it was evaluated before with the same arguments.
+        Solvers in the arguments, also as the object of a bound method like solver.Vtotal, are compared by their
+        potential data and parameters. The keyword arguments pool, verbose and callback are not part of the key.
+        Functions with random trials, such as perturb_and_solve, return the stored result of the first call.
+        :param function: Function to evaluate, e.g. scipy.optimize.minimize or solver.parallel_perturb_and_solve
+        :return: Return value of function
+        """
+        key = fingerprint(function, args, dict((name, value) for name, value in kwargs.items()
+                                               if name not in ignored_arguments))
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            if self.verbose:
+                cprint("\tLoaded result from the cache (%s)" % key[:12], "white")
+            return result
+
+        self.misses += 1
+        result = function(*args, **kwargs)
+        self.put(key, result)
+        return result
+
+    def minimize(self, fun, x0, **minimizer_options):
+        """
+        Memoized scipy.optimize.minimize, see call.
+        :param fun: Cost function, e.g. solver.Vtotal
+        :param x0: Initial electron positions r = [x0, y0, x1, y1, ...]
+        :param minimizer_options: Options for scipy.optimize.minimize
+        :return: output of scipy.optimize.minimize
+        """
+        return self.call(minimize, fun, np.asarray(x0, dtype=np.float64), **minimizer_options)
@@ -0,0 +1,246 @@
+"""
+Persistent worker pool for perturbing and re-minimizing electron configurations in parallel.
+
+The solver is sent to the workers only once, when the pool is started. Large numpy arrays of the solver, such as the
+potential grid and the spline coefficients, are placed in shared memory instead of being copied into every worker.
+Tasks only carry the reference positions, the kick amplitudes, a random seed and the minimizer options, and they are
+handed out as workers become available.
+
+    with SolverPool(solver) as pool:
+        res = pool.perturb_and_solve(solver.Vtotal, res, kick, 100, {'method' : 'CG', 'jac' : solver.grad_total},
+                                     time_budget=60, patience=20)
+"""
+import io, time, pickle, queue, multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from scipy.optimize import minimize
+from termcolor import cprint
+
+# Solver and shared memory segments of a worker process, set by initialize_worker
+worker_state = {}
+
+
+class SharedArrayPickler(pickle.Pickler):
+
+    def __init__(self, file, min_size):
+        """
+        Pickler that stores numpy arrays of at least min_size bytes in shared memory instead of in the pickle.
+        :param file: File-like object to write to
+        :param min_size: Minimum size of an array in bytes to be placed in shared memory
+        """
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.min_size = min_size
+        self.segments = list()
+        self.shared = dict()
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject or obj.nbytes < max(self.min_size, 1):
+            return None
+        if id(obj) not in self.shared:
+            segment = shared_memory.SharedMemory(create=True, size=obj.nbytes)
+            np.ndarray(obj.shape, dtype=obj.dtype, buffer=segment.buf)[...] = obj
+            self.segments.append(segment)
+            # Keep a reference to obj, such that its id can not be reused by another array while pickling
+            self.shared[id(obj)] = ((segment.name, obj.shape, obj.dtype.str), obj)
+        return self.shared[id(obj)][0]
+
+
+class SharedArrayUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        name, shape, dtype = pid
+        segment = shared_memory.SharedMemory(name=name)
+        worker_state['segments'].append(segment)
+        return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+
+def initialize_worker(payload, current_run):
+    worker_state['segments'] = list()
+    worker_state['solver'] = SharedArrayUnpickler(io.BytesIO(payload)).load()
+    worker_state['current_run'] = current_run
+
+
+def resolve(f):
+    """
+    Replace a reference to a solver method, see SolverPool.encode, by the method of the solver in this worker.
+    """
+    if isinstance(f, tuple) and len(f) == 2 and f[0] == 'solver':
+        return getattr(worker_state['solver'], f[1])
+    return f
+
+
+def perturb_and_minimize(run, r0, kick, seed, cost_function, minimizer_dict):
+    """
+    Task executed by the workers: apply a random kick to the electron positions r0 and minimize the cost function.
+    :return: output of scipy.optimize.minimize, or None if the run was cancelled before the task started.
+    """
+    if worker_state['current_run'].value != run:
+        return None
+    rng = np.random.default_rng(seed)
+    minimizer_dict = dict((key, resolve(value)) for key, value in minimizer_dict.items())
+    return minimize(resolve(cost_function), r0 + kick * rng.standard_normal(len(r0)), **minimizer_dict)
+
+
+def call_with_solver(function, args):
+    return function(worker_state['solver'], *args)
+
+
+class SolverPool:
+
+    def __init__(self, solver, processes=None, seed=None, min_shared_size=65536):
+        """
+        Starts a pool of worker processes that each hold a copy of solver. The workers are reused for all calls to
+        perturb_and_solve until close is called. Changes to the solver after the pool was started, such as
+        CombinedModelSolver.precompute_background, are not seen by the workers.
+        :param solver: TrapAreaSolver, ResonatorSolver or CombinedModelSolver instance
+        :param processes: Number of worker processes. Defaults to the number of cores of your CPU.
+        :param seed: Seed for the random kicks. Every trial gets an independent stream from np.random.SeedSequence.
+        :param min_shared_size: Numpy arrays of the solver that are at least this many bytes are placed in shared memory
+        """
+        self.solver = solver
+        self.processes = multiprocessing.cpu_count() if processes is None else processes
+        self.seed_sequence = np.random.SeedSequence(seed)
+
+        buffer = io.BytesIO()
+        pickler = SharedArrayPickler(buffer, min_shared_size)
+        pickler.dump(solver)
+        self.segments = pickler.segments
+        self.payload = buffer.getvalue()
+
+        self.current_run = multiprocessing.Value('i', 0)
+        self.pool = None
+        self.start_workers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start_workers(self):
+        """
+        Start the worker processes, or restart them if they are running. The shared memory is reused.
+        """
+        self.stop_workers()
+        self.pool = multiprocessing.Pool(self.processes, initializer=initialize_worker,
+                                         initargs=(self.payload, self.current_run))
+
+    def stop_workers(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def close(self):
+        """
+        Stops the worker processes and releases the shared memory.
+        """
+        self.stop_workers()
+        for segment in self.segments:
+            segment.close()
+            segment.unlink()
+        self.segments = list()
+
+    def encode(self, f):
+        # Methods of the solver are sent by name, such that the solver is not pickled with every task
+        if getattr(f, '__self__', None) is self.solver:
+            return ('solver', f.__name__)
+        return f
+
+    def map(self, function, arguments):
+        """
+        Evaluate function(solver, *args) in the workers for every tuple args in arguments.
+        :param function: Function that takes the solver as first argument. It must be defined at module level.
+        :param arguments: List of argument tuples
+        :return: List of return values, in the order of arguments
+        """
+        return self.pool.starmap(call_with_solver, [(function, args) for args in arguments])
+
+    def perturb_and_solve(self, cost_function, solution_data_reference, kick, N_perturbations, minimizer_dict,
+                          time_budget=None, patience=None, verbose=False):
+        """
+        This function is to be run after a minimization by scipy.optimize.minimize has already occured.
+        It takes the output of that function in solution_data_reference and tries to find a lower energy state
+        by perturbing the electron positions r = [x0, y0, x1, y1, ...] with normally distributed kicks and minimizing
+        the cost function again. Trials are handed to the workers as they become available.
+        :param cost_function: A function that takes the electron positions and returns the total energy
+        :param solution_data_reference: output of scipy.optimize.minimize
+        :param kick: Standard deviation of the kick for each coordinate in r, e.g. from the thermal_kick functions
+        :param N_perturbations: Integer, maximum number of perturbations to find a new minimum
+        :param minimizer_dict: Dictionary with optimizer options. See scipy.optimize.minimize
+        :param time_budget: Stop after this many seconds. Trials that have not started are skipped, and the workers
+        that are still busy with a trial are restarted, such that the next call starts with idle workers.
+        :param patience: Stop after this many consecutive trials that did not lower the cost function. Trials that are
+        still running finish in the background, their results are discarded.
+        :param verbose: Print a message for each trial that finds a new minimum or doesn't converge
+        :return: output of minimize with the lowest evaluated cost function
+        """
+        best_result = solution_data_reference
+        r0 = np.asarray(solution_data_reference['x'], dtype=np.float64)
+        kick = np.asarray(kick, dtype=np.float64) * np.ones(len(r0))
+        cost_function = self.encode(cost_function)
+        minimizer_dict = dict((key, self.encode(value)) for key, value in minimizer_dict.items())
+
+        with self.current_run.get_lock():
+            self.current_run.value += 1
+            run = self.current_run.value
+
+        results = queue.Queue()
+        submitted, completed, non_improving = 0, 0, 0
+
+        def submit():
+            task = (run, r0, kick, self.seed_sequence.spawn(1)[0], cost_function, minimizer_dict)
+            self.pool.apply_async(perturb_and_minimize, task, callback=results.put, error_callback=results.put)
+
+        t0 = time.time()
+        while submitted < min(N_perturbations, 2 * self.processes):
+            submit()
+            submitted += 1
+
+        stop_reason = None
+        while completed < submitted:
+            if time_budget is None:
+                timeout = None
+            else:
+                timeout = time_budget - (time.time() - t0)
+                if timeout <= 0:
+                    stop_reason = "time budget"
+                    break
+            try:
+                res = results.get(timeout=timeout)
+            except queue.Empty:
+                stop_reason = "time budget"
+                break
+
+            completed += 1
+            if isinstance(res, BaseException):
+                raise res
+
+            if res['status'] == 0 and res['fun'] < best_result['fun']:
+                if verbose:
+                    cprint("\tNew minimum was found after perturbing!", "green")
+                best_result = res
+                non_improving = 0
+            else:
+                non_improving += 1
+                if verbose and res['status'] != 0 and res['fun'] < best_result['fun']:
+                    cprint("\tThere is a lower state, but minimizer didn't converge!", "red")
+
+            if patience is not None and non_improving >= patience:
+                stop_reason = "%d trials without improvement" % patience
+                break
+
+            if submitted < N_perturbations:
+                submit()
+                submitted += 1
+
+        # Trials of this run that have not started yet are skipped by the workers
+        with self.current_run.get_lock():
+            self.current_run.value += 1
+        if stop_reason == "time budget" and completed < submitted:
+            self.start_workers()
+
+        if stop_reason is not None and verbose:
+            cprint("\tStopped after %d of %d trials (%s)" % (completed, N_perturbations, stop_reason), "white")
+
+        return best_result
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+aa = pytest.importorskip("TrapAnalysis.artificial_anneal")
+
+
+def make_solver():
+    x = np.linspace(-3E-6, 3E-6, 61)
+    y = np.linspace(-2E-6, 2E-6, 41)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    U = 0.2E12 * X ** 2 + 0.1E12 * Y ** 2
+    resonator_electrons = aa.xy2r(np.full(10, 5E-6), np.linspace(-2E-6, 2E-6, 10))
+    return aa.CombinedModelSolver(x, y, U, resonator_electrons)
+
+
+def test_precompute_background_fold_then_refined_grid():
+    r = aa.xy2r(np.array([-0.5E-6, 0.1E-6, 0.7E-6]), np.array([0.2E-6, -0.4E-6, 0.3E-6]))
+    direct = make_solver()
+    E_direct, grad_direct = direct.Vtotal_and_grad(r)
+
+    solver = make_solver()
+    solver.precompute_background()
+    solver.precompute_background(np.linspace(-2E-6, 2E-6, 81), np.linspace(-1.5E-6, 1.5E-6, 61))
+    E, grad = solver.Vtotal_and_grad(r)
+
+    assert not solver.background_folded
+    assert np.isclose(E, E_direct, rtol=1E-6)
+    assert np.max(np.abs(grad - grad_direct)) < 1E-3 * np.max(np.abs(grad_direct))
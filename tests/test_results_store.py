@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+rs = pytest.importorskip("TrapAnalysis.results_store")
+
+
+def test_sql_keywords_as_names(tmp_path):
+    with rs.ResultsStore(str(tmp_path)) as store:
+        result_id = store.append(order=1, group='a', index=2.0, positions=np.zeros(20))
+        assert store.query(order_by='order', group='a', index=2.0) == [result_id]
+        result = store.get(result_id)
+        assert result['order'] == 1 and result['group'] == 'a' and result['index'] == 2.0
+
+
+def test_case_insensitive_columns(tmp_path):
+    with rs.ResultsStore(str(tmp_path)) as store:
+        with pytest.raises(ValueError):
+            store.append(T=0.1, t=0.2)
+        first = store.append(T=0.1)
+        second = store.append(t=0.2)
+        assert store.query(t=0.2) == [second]
+        assert list(store.parameters([first, second])['T']) == [0.1, 0.2]
+
+
+def test_reserved_names(tmp_path):
+    with rs.ResultsStore(str(tmp_path)) as store:
+        with pytest.raises(ValueError):
+            store.append(id=3)
+        with pytest.raises(ValueError):
+            store.append(x=np.zeros(2), x_0=1.0)
+        store.append(V=np.array([1., 2.]))
+        with pytest.raises(ValueError):
+            store.append(V_1=3.0)
+        store.append(y_0=1.0)
+        with pytest.raises(ValueError):
+            store.append(y=np.ones(2))
+        assert len(store) == 2
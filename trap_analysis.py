@@ -12,8 +12,10 @@ Typical workflow:
 from tabulate import tabulate
 import numpy as np
 from matplotlib import pyplot as plt
+from scipy.interpolate import RectBivariateSpline
 from .import_data import load_dsp, load_maxwell_data, select_domain
 from .resonator_analysis import get_resonator_constants
+from .interpolation import SplineEvaluator2D, PolynomialEvaluator2D
 
 try:
     from Common import kfit, common
@@ -57,6 +59,7 @@ class TrapSolver:
         self.use_FEM_data = use_FEM_data
         self.physical_constants = get_constants()
         self.resonator_constants = get_resonator_constants()
+        self.potential_evaluator = None
 
     def load_potentials(self, fn_resonator, fn_currentloop, fn_resguard, fn_centerguard, fn_trapguard):
         """
@@ -378,7 +381,60 @@ class TrapSolver:
             output.append(self.Ey_data[row,col])
         return np.array(output)
 
+    def setup_potential_evaluator(self, x, y, V, spline_order_x=3, spline_order_y=3, smoothing=0):
+        """
+        Interpolate the combined DC potential with a spline. After calling this method, curv_xx, curv_yy, curv_xy and
+        curvatures evaluate the spline Hessian at the electron positions, instead of looking up the nearest point in
+        self.curv_xx_data, self.curv_yy_data and self.curv_xy_data.
+        :param x: 1D array of x-data, unit m
+        :param y: 1D array of y-data, unit m
+        :param V: 2D array of shape (len(y), len(x)) with the DC potential in V, as returned by crop_potentials and
+        get_combined_potential
+        :param spline_order_x: Order of the interpolation in the x-direction (1 = linear, 3 = cubic)
+        :param spline_order_y: Order of the interpolation in the y-direction (1 = linear, 3 = cubic)
+        :param smoothing: Absolute smoothing. Effect depends on scale of V.
+        :return: None
+        """
+        spline = RectBivariateSpline(x, y, np.transpose(V), kx=spline_order_x, ky=spline_order_y, s=smoothing)
+        self.potential_evaluator = SplineEvaluator2D(spline)
+
+    def setup_reduced_model(self, x, y, V, degree=6, xdomain=None, ydomain=None, verbose=True):
+        """
+        Fit a polynomial of total degree `degree` to the combined DC potential in the trap region, see
+        PolynomialEvaluator2D. Like setup_potential_evaluator, after calling this method curv_xx, curv_yy, curv_xy and
+        curvatures evaluate the Hessian of the polynomial instead of a spline.
+        :param x: 1D array of x-data, unit m
+        :param y: 1D array of y-data, unit m
+        :param V: 2D array of shape (len(y), len(x)) with the DC potential in V, as returned by crop_potentials and
+        get_combined_potential
+        :param degree: Total degree of the polynomial
+        :param xdomain: Tuple (xmin, xmax) of the fit region. Defaults to all x-data.
+        :param ydomain: Tuple (ymin, ymax) of the fit region. Defaults to all y-data.
+        :param verbose: Print the residuals of the fit
+        :return: rms and maximum residual of the fit in V
+        """
+        domain = (xdomain if xdomain is not None else (np.min(x), np.max(x)),
+                  ydomain if ydomain is not None else (np.min(y), np.max(y)))
+        self.potential_evaluator = PolynomialEvaluator2D(x, y, np.transpose(V), degree=degree, domain=domain)
+        if verbose:
+            print("Polynomial of degree %d: rms residual %.2e V, max. residual %.2e V"
+                  % (degree, self.potential_evaluator.rms_residual, self.potential_evaluator.max_residual))
+        return self.potential_evaluator.rms_residual, self.potential_evaluator.max_residual
+
+    def curvatures(self, xe, ye):
+        """
+        Curvatures a1 of the DC potential V_DC = a0 + a1 * x**2 in the xx, yy and xy directions at the electron
+        positions, evaluated in a single interpolation pass. Requires setup_potential_evaluator or setup_reduced_model.
+        :param xe: 1D array of electron x-coordinates
+        :param ye: 1D array of electron y-coordinates
+        :return: curv_xx, curv_yy, curv_xy (units: V/m**2)
+        """
+        V, dVdx, dVdy, ddVdx, ddVdxdy, ddVdy = self.potential_evaluator.evaluate(xe, ye, order=2)
+        return ddVdx / 2., ddVdy / 2., ddVdxdy / 2.
+
     def curv_xy(self, xe, ye):
+        if self.potential_evaluator is not None:
+            return self.curvatures(xe, ye)[2]
         output = list()
         for xi, yi in zip(xe, ye):
             row, col = self.find_nearest_point(xi, yi)
@@ -386,6 +442,8 @@ class TrapSolver:
         return np.array(output)
 
     def curv_xx(self, xe, ye):
+        if self.potential_evaluator is not None:
+            return self.curvatures(xe, ye)[0]
         output = list()
         for xi, yi in zip(xe, ye):
             row, col = self.find_nearest_point(xi, yi)
@@ -393,6 +451,8 @@ class TrapSolver:
         return np.array(output)
 
     def curv_yy(self, xe, ye):
+        if self.potential_evaluator is not None:
+            return self.curvatures(xe, ye)[1]
         output = list()
         for xi, yi in zip(xe, ye):
             row, col = self.find_nearest_point(xi, yi)
@@ -454,9 +514,14 @@ class TrapSolver:
         np.fill_diagonal(kij_minus, 0)
         np.fill_diagonal(lij, 0)
 
-        Kij_plus = -kij_plus + np.diag(2*c['e']*self.curv_xx(xe, ye) + np.sum(kij_plus, axis=1))
-        Kij_minus = -kij_minus + np.diag(2*c['e']*self.curv_yy(xe, ye) + np.sum(kij_minus, axis=1))
-        Lij = -lij + np.diag(2*c['e']*self.curv_xy(xe, ye) + np.sum(lij, axis=1))
+        if self.potential_evaluator is not None:
+            curv_xx, curv_yy, curv_xy = self.curvatures(xe, ye)
+        else:
+            curv_xx, curv_yy, curv_xy = self.curv_xx(xe, ye), self.curv_yy(xe, ye), self.curv_xy(xe, ye)
+
+        Kij_plus = -kij_plus + np.diag(2*c['e']*curv_xx + np.sum(kij_plus, axis=1))
+        Kij_minus = -kij_minus + np.diag(2*c['e']*curv_yy + np.sum(kij_minus, axis=1))
+        Lij = -lij + np.diag(2*c['e']*curv_xy + np.sum(lij, axis=1))
 
         K[1:num_electrons+1,1:num_electrons+1] = Kij_plus
         K[num_electrons+1:2*num_electrons+1, num_electrons+1:2*num_electrons+1] = Kij_minus